@@ -1,13 +1,25 @@
 # In[]:
 # Import required libraries
+import atexit
+import os
+import time
+
 import dash
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction, \
+    MATCH, ALL
+from dash.exceptions import PreventUpdate
 import dash_html_components as html
 import dash_core_components as dcc
 from dash_daq import StopButton, Indicator, DarkThemeProvider, ToggleSwitch
-import plotly.graph_objs as go
 
 from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+from dash_daq_drivers.acquisition import AcquisitionEngine
+from dash_daq_drivers.decimation import TraceDecimator, parse_view, \
+    current_utc_offset
+from dash_daq_drivers.push import SampleBroadcaster, register_push_route
+from dash_daq_drivers.shared_store import DataPlane, plane_directory
+from dash_daq_drivers.historian import Historian
+from dash_daq_drivers.query import register_query_route
 
 # line colors
 LINE_COLORS = ['#19d3f3', '#e763fa', '#00cc96', '#EF553B']
@@ -23,28 +35,53 @@ PRESSURE_GAUGE = MGC4000(mock=True)
 # set the gauge inside the lab's instrument rack
 INSTRUMENT_RACK = [PRESSURE_GAUGE]
 
+# time between two measures of the selected channels, in seconds
+ACQUISITION_PERIOD = 0.5
 
-def grey_out(style_dict, pwr_status):
-    if style_dict is None:
-        answer = {}
-    else:
-        answer = style_dict
-    if pwr_status:
-        answer['opacity'] = 1
-    else:
-        answer['opacity'] = 0.3
-    return answer
+# shares the measures between the processes serving the app
+DATA_PLANE = DataPlane(INSTRUMENT_RACK, directory=plane_directory('app_mock'))
+
+# the acquisition engine polls the rack independently of the callbacks, it
+# only runs in the process writing the data plane
+ACQUISITION = AcquisitionEngine(
+    INSTRUMENT_RACK,
+    period=ACQUISITION_PERIOD,
+    selected_channels=DATA_PLANE.selected_channels,
+    port_requests=DATA_PLANE.port_requests
+)
+
+# pushes the new measures to the browsers as soon as they are taken
+BROADCASTER = SampleBroadcaster()
+ACQUISITION.add_listener(BROADCASTER.publish_measures)
+DATA_PLANE.add_listener(BROADCASTER.publish_measures)
+
+# keeps every measure on disk, the graph shows the history of the channels
+# beyond the samples kept in memory, also across restarts of the app
+HISTORY_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'history-mock'
+)
+# only the process running the acquisition writes the history, and restores
+# the latest samples, the others read it
+HISTORIAN = Historian(HISTORY_DIRECTORY, writable=DATA_PLANE.is_writer)
+for instr in INSTRUMENT_RACK:
+    HISTORIAN.attach(instr, restore=DATA_PLANE.is_writer)
+ACQUISITION.add_listener(HISTORIAN.record_measures)
+DATA_PLANE.add_promotion_listener(HISTORIAN.promote)
+# the queued measures are written when the app stops
+atexit.register(HISTORIAN.close)
+
+DATA_PLANE.start_acquisition(ACQUISITION)
+
+# reduces the traces to the resolution of the graph before sending them
+DECIMATOR = TraceDecimator()
 
+# maximum number of points per trace once new samples are streamed
+STREAM_MAX_POINTS = 10000
 
-def is_instrument_port(port_name):
-    """test if a string can be a com of gpib port"""
-    answer = False
-    if isinstance(port_name, str):
-        ports = ['COM', 'com', 'GPIB0::', 'gpib0::']
-        for port in ports:
-            if port in port_name:
-                answer = not (port == port_name)
-    return answer
+# time between two renewals of the channels leased by a page, in seconds,
+# well within acquisition.LEASE_DURATION
+LEASE_RENEWAL = 3.
 
 
 # Create controls using a function
@@ -67,12 +104,6 @@ def generate_lab_layout(instr_list, theme='light'):
                             children=rack,
                             style={'width': '100%'}
                         ),
-                        # This div is used as a an output of a callback which wouldn't need output
-                        html.Div(
-                            id='event-output-div',
-                            children='',
-                            style={'display': 'none'}
-                        ),
                         # Control panel for the data acquisition
                         html.Div(
                             id='measure-div',
@@ -136,8 +167,9 @@ def generate_lab_layout(instr_list, theme='light'):
 
 This is an app to show the graphic elements of Dash DAQ used to create an
 interface for the pressure gauges from Kurt J. Lesker multi gauges controller
-MGC4000. This mock demo does not actually connect to a physical instrument
-the values displayed are generated randomly for demonstration purposes.
+MGC4000. This mock demo does not actually connect to a physical instrument,
+the values displayed are simulated from a model of a pumped vacuum chamber
+(pump-downs, vents and leaks) for demonstration purposes.
 
 **How to use the app**
 
@@ -178,7 +210,16 @@ dashdaq.io](https://www.dashdaq.io/)''')
 root_layout = html.Div(
     [
         dcc.Location(id='url', refresh=False),
-        dcc.Interval(id='interval', interval=500),
+        # width and x-axis window of the graph, reported by the browser
+        dcc.Store(id='graph-view'),
+        # channels drawn on the graph and time of their last sample
+        dcc.Store(id='graph-traces'),
+        # only reads the samples pushed to the browser, it does not reach
+        # the server
+        dcc.Interval(id='interval', interval=100),
+        # renews the lease of the channels the page displays
+        dcc.Interval(id='lease-interval', interval=LEASE_RENEWAL * 1000),
+        dcc.Store(id='lease'),
         html.Div(
             id='header',
             children=[
@@ -232,12 +273,35 @@ app.layout = root_layout
 
 # In[]:
 # Create callbacks
-# generate the callbacks between the instrument and the app
-for instr in INSTRUMENT_RACK:
-    instr.generate_callbacks(
-        app,
-        inputs=[Input('interval', 'n_intervals')]
-    )
+# the new measures are pushed to the browsers which update the gauges and
+# extend the graph's traces without polling the server
+register_push_route(app, BROADCASTER, INSTRUMENT_RACK)
+register_query_route(app, INSTRUMENT_RACK)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='push_gauges'),
+    Output({'type': 'gauge', 'instr': ALL, 'chan': ALL}, 'value'),
+    [Input('interval', 'n_intervals')],
+    [
+        State({'type': 'gauge', 'instr': ALL, 'chan': ALL}, 'id'),
+        State({'type': 'gauge', 'instr': ALL, 'chan': ALL}, 'value')
+    ]
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='push_graph'),
+    Output('graph', 'extendData'),
+    [Input('interval', 'n_intervals')],
+    [State('graph-traces', 'data')]
+)
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='graph_view'),
+    Output('graph-view', 'data'),
+    [Input('graph', 'relayoutData')],
+    [State('graph-view', 'data')]
+)
 
 
 @app.callback(Output('page-content', 'children'),
@@ -250,80 +314,91 @@ def page_layout(value):
         return generate_lab_layout(INSTRUMENT_RACK, 'light')
 
 
-@app.callback(
+# the callbacks which only change the display are run by the browser, their
+# functions are in assets/dash_daq_clientside.js
+app.clientside_callback(
+    ClientsideFunction(
+        namespace='daq_pressure',
+        function_name='trigger_measure'
+    ),
     Output('measuring', 'value'),
     [Input('measureButton', 'n_clicks')],
     [State('measuring', 'value')]
 )
-def trigger_measure(n_clicks, is_measuring):
-    if n_clicks is None:
-        return is_measuring
-    else:
-        return not is_measuring
 
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(
+        namespace='daq_pressure',
+        function_name='change_measure_btn_label'
+    ),
     Output('measureButton', 'buttonText'),
     [Input('measureButton', 'n_clicks')],
     [State('measuring', 'value')]
 )
-def change_measure_btn_label(n_clicks, is_measuring):
-    answer = 'Start'
-
-    if n_clicks is not None:
-        if not is_measuring:
-            answer = 'Stop'
-    return answer
 
-
-@app.callback(
-    Output('%s_controls_div' % PRESSURE_GAUGE.unique_id(), 'style'),
-    [Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')],
-    [State('%s_controls_div' % PRESSURE_GAUGE.unique_id(), 'style')],
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='grey_out'),
+    Output({'type': 'controls_div', 'instr': MATCH}, 'style'),
+    [Input({'type': 'power_button', 'instr': MATCH}, 'on')],
+    [State({'type': 'controls_div', 'instr': MATCH}, 'style')],
 )
-def grey_out_controls_div(pwr_status, style_dict):
-    return grey_out(style_dict, pwr_status)
 
-
-@app.callback(
-    Output('%s_gauges_div' % PRESSURE_GAUGE.unique_id(), 'style'),
-    [Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')],
-    [State('%s_gauges_div' % PRESSURE_GAUGE.unique_id(), 'style')],
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='grey_out'),
+    Output({'type': 'gauges_div', 'instr': MATCH}, 'style'),
+    [Input({'type': 'power_button', 'instr': MATCH}, 'on')],
+    [State({'type': 'gauges_div', 'instr': MATCH}, 'style')],
 )
-def grey_out_gauges_div(pwr_status, style_dict):
-    return grey_out(style_dict, pwr_status)
 
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace='daq_pressure', function_name='grey_out_any'),
     Output('measure-div', 'style'),
-    [Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')],
+    [Input({'type': 'power_button', 'instr': ALL}, 'on')],
     [State('measure-div', 'style')],
 )
-def grey_out_measuring_div(pwr_status, style_dict):
-    return grey_out(style_dict, pwr_status)
 
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(
+        namespace='daq_pressure',
+        function_name='disable_when_all_off'
+    ),
     Output('measureButton', 'disabled'),
-    [Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')]
+    [Input({'type': 'power_button', 'instr': ALL}, 'on')]
 )
-def enable_measure_btn(pwr_status):
-    return not pwr_status
 
+app.clientside_callback(
+    ClientsideFunction(
+        namespace='daq_pressure',
+        function_name='disable_when_off'
+    ),
+    Output({'type': 'instr_port', 'instr': MATCH}, 'disabled'),
+    [Input({'type': 'power_button', 'instr': MATCH}, 'on')],
+)
 
-@app.callback(
-    Output('%s_instr_port' % PRESSURE_GAUGE.unique_id(), 'value'),
+app.clientside_callback(
+    ClientsideFunction(
+        namespace='daq_pressure',
+        function_name='instrument_port_btn_update'
+    ),
+    Output({'type': 'instr_port_btn', 'instr': MATCH}, 'disabled'),
     [
-        Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on'),
-        Input('interval', 'n_intervals')
+        Input({'type': 'power_button', 'instr': MATCH}, 'on'),
+        Input({'type': 'instr_port', 'instr': MATCH}, 'value')
     ],
+    [State({'type': 'instr_port', 'instr': MATCH}, 'placeholder')]
+)
+
+
+@app.callback(
+    Output({'type': 'instr_port', 'instr': MATCH}, 'value'),
+    [Input({'type': 'power_button', 'instr': MATCH}, 'on')],
     [
-        State('%s_instr_port' % (PRESSURE_GAUGE.unique_id()), 'value'),
-        State('%s_instr_port' % (PRESSURE_GAUGE.unique_id()), 'placeholder')
+        State({'type': 'instr_port', 'instr': MATCH}, 'value'),
+        State({'type': 'instr_port', 'instr': MATCH}, 'placeholder')
     ]
 )
-def instrument_port_prevent_reset(pwr_status, _, text, placeholder):
-    """prevents the input box's value to be reset by dcc.Interval"""
+def instrument_port_prevent_reset(pwr_status, text, placeholder):
+    """clears the input box when the instrument is switched off"""
     if pwr_status:
         return text
     else:
@@ -331,61 +406,94 @@ def instrument_port_prevent_reset(pwr_status, _, text, placeholder):
 
 
 @app.callback(
-    Output('%s_instr_port' % PRESSURE_GAUGE.unique_id(), 'disabled'),
-    [Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')],
+    Output({'type': 'port_event', 'instr': MATCH}, 'children'),
+    [Input({'type': 'instr_port_btn', 'instr': MATCH}, 'n_clicks')],
+    [State({'type': 'instr_port', 'instr': MATCH}, 'value')]
 )
-def enable_instrument_port_input(pwr_status):
-    return not pwr_status
+def instrument_port_btn_click(n_clicks, text):
+    """reconnect the instrument to the new com port, this was handeled by an Event"""
+    if n_clicks is None:
+        raise PreventUpdate
+    instr_key = dash.callback_context.outputs_list['id']['instr']
+    # the worker running the acquisition connects it before its next poll
+    ACQUISITION.request_port(ACQUISITION.instruments[instr_key], text)
+    return text
 
 
-@app.callback(
-    Output('%s_instr_port_btn' % PRESSURE_GAUGE.unique_id(), 'disabled'),
-    [
-        Input('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on'),
-        Input('%s_instr_port' % (PRESSURE_GAUGE.unique_id()), 'value')
-    ],
-    [State('%s_instr_port' % (PRESSURE_GAUGE.unique_id()), 'placeholder')]
-)
-def instrument_port_btn_update(pwr_status, text, placeholder):
-    """enable or disable the connect button depending on the port name"""
-    answer = True
+def lease_channels(is_measuring, channel_items, selected_params,
+                   power_items, pwr_statuses):
+    """leases the channels a page displays to the acquisition engine, the
+        channels of the other pages are still measured
+        Returns the leased channels, indexed per instrument key
+    """
+    channels = {}
+    if not is_measuring:
+        return channels
+
+    powers = {}
+    for item, value in zip(power_items, pwr_statuses):
+        powers[item['id']['instr']] = value
+    for item, value in zip(channel_items, selected_params):
+        instr_key = item['id']['instr']
+        if powers.get(instr_key) and value:
+            channels[instr_key] = value
 
-    if text != placeholder:
-        if is_instrument_port(text):
-            answer = not pwr_status
-    return answer
+    for instr in INSTRUMENT_RACK:
+        if instr.instr_key in channels:
+            ACQUISITION.lease_channels(instr, channels[instr.instr_key])
+    return channels
 
 
 @app.callback(
-    Output('event-output-div', 'children'),
-    [Input('%s_instr_port_btn' % PRESSURE_GAUGE.unique_id(), 'n_clicks')],
-    [State('%s_instr_port' % (PRESSURE_GAUGE.unique_id()), 'value')]
+    Output('lease', 'data'),
+    [Input('lease-interval', 'n_intervals')],
+    [
+        State('measuring', 'value'),
+        State({'type': 'channel', 'instr': ALL}, 'value'),
+        State({'type': 'power_button', 'instr': ALL}, 'on')
+    ]
 )
-def instrument_port_btn_click(_, text):
-    """reconnect the instrument to the new com port, this was handeled by an Event"""
-    PRESSURE_GAUGE.connect(text)
-    return text
+def renew_lease(n_intervals, is_measuring, selected_params, pwr_statuses):
+    """keeps the channels of the page measured while it displays them, they
+        are dropped once no page renews their lease
+    """
+    ctx = dash.callback_context
+    lease_channels(
+        is_measuring,
+        ctx.states_list[1],
+        selected_params,
+        ctx.states_list[2],
+        pwr_statuses
+    )
+    # nothing is sent back to the page
+    raise PreventUpdate
 
 
 @app.callback(
-    Output('graph', 'figure'),
     [
-        Input('interval', 'n_intervals'),
+        Output('graph', 'figure'),
+        Output('graph-traces', 'data')
+    ],
+    [
         Input('measuring', 'value'),
-        Input('%s_channel' % (PRESSURE_GAUGE.unique_id()), 'value'),
-        Input('toggleTheme', 'value')
+        Input({'type': 'channel', 'instr': ALL}, 'value'),
+        Input('toggleTheme', 'value'),
+        Input('graph-view', 'data')
     ],
     [
-        State('%s_power_button' % PRESSURE_GAUGE.unique_id(), 'on')
+        State({'type': 'power_button', 'instr': ALL}, 'on')
     ]
 )
 def update_graph(
-        _,
         is_measuring,
         selected_params,
         is_dark_theme,
-        pwr_status
+        graph_view,
+        pwr_statuses
 ):
+    """redraws the whole graph, the new samples are then pushed to the
+        browser until the selection, the theme or the view changes
+    """
 
     if is_dark_theme:
         theme = 'dark'
@@ -393,34 +501,60 @@ def update_graph(
         theme = 'light'
     # here one should write the script of what the instrument do
     data_for_graph = []
+    # the channel of each trace and the time of its last sample (ms), the
+    # browser extends the traces with the samples pushed after that time
+    traces = {
+        'revision': time.time(),
+        'channels': [],
+        'last_times': [],
+        'max_points': STREAM_MAX_POINTS,
+        # the pushed samples are displayed in local time, as the traces
+        'utc_offset': current_utc_offset()
+    }
 
-    if pwr_status and is_measuring:
-        for instr in INSTRUMENT_RACK:
-
-            # triggers the measure on the selected channels
-            if is_measuring:
-                for instr_channel in selected_params:
-                    instr.measure(instr_param='%s' % instr_channel)
-
-            # collects the data measured by all channels to update the graph
-            for instr_chan in selected_params:
-
-                if instr.measured_data[instr_chan]:
-                    xdata = instr.measured_data['%s_time' % instr_chan]
-                    ydata = instr.measured_data[instr_chan]
-                    data_for_graph.append(
-                        dict(
-                            x=xdata,
-                            y=ydata,
-                            mode='lines+markers',
-                            name='%s:%s' % (instr, instr_chan),
-                            line={
-                                'width': 2
-                            }
-                        )
-                    )
+    # the number of points sent is limited by the width of the graph
+    width, t_start, t_stop = parse_view(graph_view)
+
+    # tells the acquisition engine which channels this page displays
+    ctx = dash.callback_context
+    channels = lease_channels(
+        is_measuring,
+        ctx.inputs_list[1],
+        selected_params,
+        ctx.states_list[0],
+        pwr_statuses
+    )
 
-    return {
+    for instr in INSTRUMENT_RACK:
+
+        # collects the data measured by all channels to update the graph
+        for instr_chan in channels.get(instr.instr_key, []):
+
+            traces['channels'].append([instr.instr_key, instr_chan])
+            last_time = instr.measured_data[instr_chan].last()[0]
+            traces['last_times'].append(
+                None if last_time is None else last_time / 1e6
+            )
+            xdata, ydata = DECIMATOR.decimate(
+                instr,
+                instr_chan,
+                width,
+                t_start,
+                t_stop
+            )
+            data_for_graph.append(
+                dict(
+                    x=xdata,
+                    y=ydata,
+                    mode='lines+markers',
+                    name='%s:%s' % (instr, instr_chan),
+                    line={
+                        'width': 2
+                    }
+                )
+            )
+
+    figure = {
         'data': data_for_graph,
         'layout': dict(
             xaxis={
@@ -431,6 +565,7 @@ def update_graph(
             },
             yaxis={
                 'title': 'Pressure (mbar)',
+                'type': 'log',
                 'gridcolor': GRID_COLOR[theme]
             },
             font=dict(
@@ -438,11 +573,15 @@ def update_graph(
                 size=15,
             ),
             margin={'l': 100, 'b': 100, 't': 50, 'r': 20, 'pad': 0},
+            # keeps the zoom of the user when the data is refreshed
+            uirevision='graph',
             plot_bgcolor=BKG_COLOR[theme],
             paper_bgcolor=BKG_COLOR[theme]
         )
     }
 
+    return figure, traces
+
 
 # In[]:
 # Main
@@ -0,0 +1,235 @@
+/* Callbacks run in the browser, they do not need a round-trip to the server */
+(function () {
+    /* route of the stream of new samples (dash_daq_drivers/push.py) */
+    var PUSH_ROUTE = '_push/samples';
+    /* number of pushed samples kept per channel until they are displayed */
+    var MAX_PENDING = 10000;
+    /* time before opening the stream again once the server refused it (ms),
+       as RETRY_AFTER in push.py */
+    var RETRY_DELAY = 30000;
+
+    /* samples pushed by the server, indexed per [instrument, channel] */
+    var push = {
+        source: null,
+        retry_at: 0,
+        last: {},
+        pending: {},
+        revision: null,
+        cursors: []
+    };
+
+    function channel_key(instr, chan) {
+        return JSON.stringify([instr, chan]);
+    }
+
+    /* opens the stream of samples the first time it is needed */
+    function connect_push() {
+        if (push.source !== null || typeof EventSource === 'undefined'
+                || Date.now() < push.retry_at) {
+            return;
+        }
+        push.source = new EventSource(PUSH_ROUTE);
+        push.source.onerror = function () {
+            /* the browser only reconnects by itself after a network error,
+               not when the server is full (503) */
+            if (push.source.readyState === EventSource.CLOSED) {
+                push.source = null;
+                push.retry_at = Date.now() + RETRY_DELAY;
+            }
+        };
+        push.source.onmessage = function (message) {
+            var event = JSON.parse(message.data);
+            Object.keys(event.samples).forEach(function (chan) {
+                var key = channel_key(event.instr, chan);
+                var sample = event.samples[chan];
+                var pending = push.pending[key] || [];
+
+                push.last[key] = sample[1];
+                pending.push(sample);
+                if (pending.length > MAX_PENDING) {
+                    pending.splice(0, pending.length - MAX_PENDING);
+                }
+                push.pending[key] = pending;
+            });
+        };
+    }
+
+    /* same format as the times of the traces sent by the server, in its
+       local time */
+    function to_date(time_ms, utc_offset) {
+        return new Date(time_ms + (utc_offset || 0)).toISOString().replace(
+            'Z',
+            ''
+        );
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        daq_pressure: {
+            /* displays the last pushed value of each gauge */
+            push_gauges: function (n_intervals, gauge_ids, values) {
+                var changed = false;
+                var answer;
+
+                connect_push();
+                answer = gauge_ids.map(function (gauge_id, i) {
+                    var value = push.last[
+                        channel_key(gauge_id.instr, gauge_id.chan)
+                    ];
+                    if (value === undefined || value === null
+                            || value === values[i]) {
+                        return values[i];
+                    }
+                    changed = true;
+                    return value;
+                });
+                if (!changed) {
+                    return window.dash_clientside.no_update;
+                }
+                return answer;
+            },
+
+            /* extends the traces of the graph with the samples pushed since it
+               was drawn by the server */
+            push_graph: function (n_intervals, traces) {
+                var update_data = {x: [], y: []};
+                var trace_indexes = [];
+
+                connect_push();
+                if (!traces || !traces.channels.length) {
+                    return window.dash_clientside.no_update;
+                }
+                if (push.revision !== traces.revision) {
+                    push.revision = traces.revision;
+                    push.cursors = traces.last_times.slice();
+                }
+
+                traces.channels.forEach(function (channel, i) {
+                    var key = channel_key(channel[0], channel[1]);
+                    var pending = push.pending[key] || [];
+                    var xdata = [];
+                    var ydata = [];
+
+                    pending.forEach(function (sample) {
+                        if (sample[0] > push.cursors[i]) {
+                            xdata.push(to_date(sample[0], traces.utc_offset));
+                            ydata.push(sample[1]);
+                            push.cursors[i] = sample[0];
+                        }
+                    });
+                    if (xdata.length) {
+                        update_data.x.push(xdata);
+                        update_data.y.push(ydata);
+                        trace_indexes.push(i);
+                    }
+                    /* the displayed samples are not needed anymore */
+                    push.pending[key] = [];
+                });
+
+                if (!trace_indexes.length) {
+                    return window.dash_clientside.no_update;
+                }
+                return [update_data, trace_indexes, traces.max_points];
+            },
+
+            /* dims a component when the instrument is switched off */
+            grey_out: function (pwr_status, style) {
+                var answer = Object.assign({}, style);
+                answer.opacity = pwr_status ? 1 : 0.3;
+                return answer;
+            },
+
+            /* dims a component when all the instruments are switched off */
+            grey_out_any: function (pwr_statuses, style) {
+                return window.dash_clientside.daq_pressure.grey_out(
+                    pwr_statuses.some(Boolean),
+                    style
+                );
+            },
+
+            /* disables a component when the instrument is switched off */
+            disable_when_off: function (pwr_status) {
+                return !pwr_status;
+            },
+
+            /* disables a component when all the instruments are switched off */
+            disable_when_all_off: function (pwr_statuses) {
+                return !pwr_statuses.some(Boolean);
+            },
+
+            trigger_measure: function (n_clicks, is_measuring) {
+                if (n_clicks === null || n_clicks === undefined) {
+                    return is_measuring;
+                }
+                return !is_measuring;
+            },
+
+            change_measure_btn_label: function (n_clicks, is_measuring) {
+                var answer = 'Start';
+
+                if (n_clicks !== null && n_clicks !== undefined) {
+                    if (!is_measuring) {
+                        answer = 'Stop';
+                    }
+                }
+                return answer;
+            },
+
+            /* tests if a string can be a com or gpib port */
+            is_instrument_port: function (port_name) {
+                var answer = false;
+                if (typeof port_name === 'string') {
+                    ['COM', 'com', 'GPIB0::', 'gpib0::'].forEach(function (port) {
+                        if (port_name.indexOf(port) !== -1) {
+                            answer = port !== port_name;
+                        }
+                    });
+                }
+                return answer;
+            },
+
+            /* enables the connect button depending on the port name */
+            instrument_port_btn_update: function (pwr_status, text, placeholder) {
+                var answer = true;
+
+                if (text !== placeholder) {
+                    if (window.dash_clientside.daq_pressure.is_instrument_port(
+                            text)) {
+                        answer = !pwr_status;
+                    }
+                }
+                return answer;
+            },
+
+            /* reports the width in pixels and the x-axis window of the graph so
+               the server only sends the points which can be displayed */
+            graph_view: function (relayout_data, view) {
+                var graph = document.getElementById('graph');
+                var next = {
+                    width: graph ? graph.offsetWidth : null,
+                    xrange: view ? view.xrange : null
+                };
+
+                if (relayout_data) {
+                    if (relayout_data['xaxis.range[0]'] !== undefined) {
+                        next.xrange = [
+                            relayout_data['xaxis.range[0]'],
+                            relayout_data['xaxis.range[1]']
+                        ];
+                    } else if (relayout_data['xaxis.range']) {
+                        next.xrange = relayout_data['xaxis.range'];
+                    } else if (relayout_data['xaxis.autorange']) {
+                        next.xrange = null;
+                    }
+                }
+                /* a zoom on the y-axis or a redraw at the same size needs
+                   no other points */
+                if (view && view.width === next.width
+                        && JSON.stringify(view.xrange)
+                        === JSON.stringify(next.xrange)) {
+                    return window.dash_clientside.no_update;
+                }
+                return next;
+            }
+        }
+    });
+}());
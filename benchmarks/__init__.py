@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the drivers and of the app, run from the root of the
+repository, i.e.
+    $ python -m benchmarks.bench_drivers --output results.json
+"""
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency and memory benchmarks of the instrument drivers
+
+The acquisition is measured in mock mode (cost of the driver and of the
+storage alone) and through the pseudo-terminal MGC4000 simulator (the real
+serial path, framing and status handling included), i.e.
+    $ python -m benchmarks.bench_drivers --samples 2000 --output run.json
+    $ python -m benchmarks.bench_drivers --compare run.json
+
+Python has no counter of the allocations made, so the memory figures are
+the blocks and bytes still allocated after the samples were taken
+(retained) and the peak of the memory used meanwhile (transient).
+"""
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from dash_daq_drivers.channel_store import ChannelStore, now_ns
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+from .common import percentiles, run_context, save_results, compare
+
+
+def memory_use(function, repeat):
+    """runs a function repeat times and returns the memory it retained and
+        the peak it used, per call
+    """
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        for i in range(repeat):
+            function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    return {
+        'retained_blocks_per_call': (
+            (sys.getallocatedblocks() - blocks) / float(repeat)
+        ),
+        'retained_bytes_per_call': current / float(repeat),
+        'peak_transient_bytes': peak - current
+    }
+
+
+def throughput(function, repeat):
+    """returns the duration of each of the repeat calls of a function"""
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_store(samples, capacity):
+    """appends samples to a ring buffer, one by one and by blocks"""
+    store = ChannelStore(['CG1'], capacity=capacity)
+    values = np.random.random(samples)
+    timestamp = now_ns()
+
+    start = time.perf_counter()
+    for value in values:
+        store.append('CG1', value, timestamp)
+    single = time.perf_counter() - start
+
+    times = np.full(samples, timestamp, dtype=np.int64)
+    start = time.perf_counter()
+    for i in range(0, samples, 1000):
+        store['CG1'].extend(values[i:i + 1000], times[i:i + 1000])
+    block = time.perf_counter() - start
+
+    memory = memory_use(lambda: store.append('CG1', 1., timestamp), samples)
+    return {
+        'append_samples_per_s': samples / single,
+        'extend_samples_per_s': samples / block,
+        'memory_growth_per_million_samples_bytes': (
+            memory['retained_bytes_per_call'] * 1e6
+        ),
+        'memory': memory
+    }
+
+
+def bench_acquisition(instr, samples):
+    """measures all the channels of an instrument samples times"""
+    channels = len(instr.measure_params)
+    durations = throughput(instr.measure_all, samples)
+    memory = memory_use(instr.measure_all, samples)
+    total = sum(durations)
+    return {
+        'channels': channels,
+        'samples_per_s_per_channel': samples / total,
+        'measure_all': percentiles(durations),
+        'memory_growth_per_million_samples_bytes': (
+            memory['retained_bytes_per_call'] / channels * 1e6
+        ),
+        'memory_per_sample': dict(
+            (key, value / channels) for key, value in memory.items()
+        )
+    }
+
+
+def bench_mock(samples, capacity):
+    """acquisition in mock mode, without any communication"""
+    instr = MGC4000(mock=True, data_capacity=capacity)
+    return bench_acquisition(instr, samples)
+
+
+def bench_simulator(samples, capacity, baud_rate, jitter, drop_rate):
+    """acquisition through the pseudo-terminal simulator"""
+    try:
+        from dash_daq_drivers.simulator import MGC4000Simulator
+        simulator = MGC4000Simulator(
+            baud_rate=baud_rate,
+            jitter=jitter,
+            drop_rate=drop_rate,
+            seed=0
+        )
+    except (ImportError, AttributeError, OSError) as err:
+        # no pseudo-terminals on this platform
+        return {'skipped': str(err)}
+
+    simulator.start()
+    instr = MGC4000(
+        simulator.port_name,
+        data_capacity=capacity,
+        timeout=1.
+    )
+    try:
+        answer = {
+            'baud_rate': baud_rate,
+            'jitter_s': jitter,
+            'drop_rate': drop_rate,
+            'ask': percentiles(
+                throughput(lambda: instr.ask('#  RDCG1'), samples)
+            ),
+            'ask_memory': memory_use(lambda: instr.ask('#  RDCG1'), samples)
+        }
+        answer.update(bench_acquisition(instr, samples))
+        answer['dropped_bytes'] = simulator.dropped
+    finally:
+        instr.disconnect()
+        simulator.stop()
+    return answer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the acquisition of the instrument drivers'
+    )
+    parser.add_argument(
+        '--samples', type=int, default=1000,
+        help='number of samples per channel and per benchmark'
+    )
+    parser.add_argument(
+        '--store-samples', type=int, default=200000,
+        help='number of samples appended in the storage benchmark'
+    )
+    parser.add_argument('--capacity', type=int, default=100000)
+    parser.add_argument(
+        '--baud-rate', type=int, default=19200,
+        help='speed of the simulated link, 0 for replies without delay'
+    )
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--drop-rate', type=float, default=0.)
+    parser.add_argument('--no-simulator', action='store_true')
+    parser.add_argument('--output', help='JSON file to save the results in')
+    parser.add_argument(
+        '--compare', help='JSON file of a previous run to compare with'
+    )
+    args = parser.parse_args()
+
+    results = {
+        'store': bench_store(args.store_samples, args.capacity),
+        'mock': bench_mock(args.samples, args.capacity)
+    }
+    if not args.no_simulator:
+        results['simulator'] = bench_simulator(
+            args.samples,
+            args.capacity,
+            args.baud_rate,
+            args.jitter,
+            args.drop_rate
+        )
+
+    results = {'context': run_context(), 'results': results}
+    save_results(results, args.output)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmarks: timing statistics, context of a run and
+JSON results which can be compared between runs
+"""
+
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+
+def percentiles(durations):
+    """returns the statistics of a list of durations (s) in milliseconds"""
+    durations = np.asarray(durations, dtype=np.float64) * 1e3
+    if not len(durations):
+        return {}
+    return {
+        'count': int(len(durations)),
+        'mean_ms': float(durations.mean()),
+        'p50_ms': float(np.percentile(durations, 50)),
+        'p90_ms': float(np.percentile(durations, 90)),
+        'p99_ms': float(np.percentile(durations, 99)),
+        'max_ms': float(durations.max())
+    }
+
+
+def git_revision():
+    """returns the commit the benchmark ran on, None outside of git"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_context():
+    """returns what is needed to know if two runs are comparable"""
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'argv': sys.argv[1:]
+    }
+
+
+def save_results(results, path=None):
+    """prints the results as JSON and writes them to a file if a path is
+        provided
+    """
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as json_file:
+            json_file.write(text + '\n')
+    print(text)
+
+
+def flatten(results, prefix=''):
+    """returns the numbers of nested results indexed by their path"""
+    answer = {}
+    for key, value in results.items():
+        path = '%s.%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            answer.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            answer[path] = value
+    return answer
+
+
+def compare(previous_path, results):
+    """prints the ratio of each number of the results to the ones of a
+        previous run
+    """
+    with open(previous_path) as json_file:
+        previous = flatten(json.load(json_file).get('results', {}))
+    current = flatten(results.get('results', {}))
+
+    print('%-60s %14s %14s %8s' % ('metric', 'previous', 'current', 'ratio'))
+    for path in sorted(current):
+        if path not in previous:
+            continue
+        before = previous[path]
+        after = current[path]
+        ratio = after / before if before else float('nan')
+        print('%-60s %14.6g %14.6g %8.3f' % (path, before, after, ratio))
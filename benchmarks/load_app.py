@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the dash app with simulated dashboard clients
+
+Each client loads the page like a browser (index, layout, dependencies and
+the first callbacks), then replays what a user does: zooming or resizing the
+graph, changing the selected channels, toggling the theme or the
+measurement, with a random think time between two actions. The clients are
+ramped up by stages and the latency and the payload sizes of the requests
+are reported per callback.
+
+Since the measures are pushed to the browsers (see push.py), the interval
+ticks are handled in the browser and never reach the server, the graph view
+updates are the most frequent requests instead.
+
+The app is either loaded in this process and called through the test client
+of its server
+    $ python -m benchmarks.load_app --app app_mock --clients 1,5,10,20
+or reached over the network, i.e. when served by gunicorn
+    $ python -m benchmarks.load_app --url http://127.0.0.1:8050 --push
+"""
+
+import argparse
+import datetime
+import http.client
+import importlib
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from .common import percentiles, run_context, save_results, compare
+
+UPDATE_ROUTE = '_dash-update-component'
+
+# relative frequency of the actions of a user
+ACTIONS = {
+    'graph_view': 0.6,
+    'channels': 0.2,
+    'theme': 0.1,
+    'measuring': 0.1
+}
+
+
+def prop_id(component_id, prop):
+    """returns the identifier of a property as dash writes it"""
+    if isinstance(component_id, dict):
+        component_id = json.dumps(
+            component_id, sort_keys=True, separators=(',', ':')
+        )
+    return '%s.%s' % (component_id, prop)
+
+
+def find_ids(layout, component_type):
+    """returns the pattern-matching ids of a type found in a layout"""
+    answer = []
+    if isinstance(layout, dict):
+        props = layout.get('props', {})
+        component_id = props.get('id')
+        if isinstance(component_id, dict) \
+                and component_id.get('type') == component_type:
+            answer.append(component_id)
+        for value in props.values():
+            answer.extend(find_ids(value, component_type))
+    elif isinstance(layout, list):
+        for item in layout:
+            answer.extend(find_ids(item, component_type))
+    return answer
+
+
+class InProcessTransport(object):
+    """sends the requests to the flask server of an app in this process"""
+
+    def __init__(self, server, prefix='/'):
+        self.client = server.test_client()
+        self.prefix = prefix
+
+    def get(self, path):
+        response = self.client.get(self.prefix + path)
+        return response.status_code, response.data
+
+    def post(self, path, body):
+        response = self.client.post(
+            self.prefix + path,
+            data=body,
+            content_type='application/json'
+        )
+        return response.status_code, response.data
+
+    def close(self):
+        pass
+
+
+class HttpTransport(object):
+    """sends the requests to a running server over a kept-alive connexion"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/') + '/'
+        self.connexion = http.client.HTTPConnection(self.host, self.port)
+
+    def request(self, method, path, body=None, headers=None):
+        self.connexion.request(
+            method, self.prefix + path, body=body, headers=headers or {}
+        )
+        response = self.connexion.getresponse()
+        return response.status, response.read()
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, body):
+        return self.request(
+            'POST', path, body, {'Content-Type': 'application/json'}
+        )
+
+    def open_push(self, route, stop_event):
+        """keeps the stream of the measures open as a browser page does"""
+        connexion = http.client.HTTPConnection(self.host, self.port)
+        connexion.request('GET', self.prefix + route)
+        response = connexion.getresponse()
+        while not stop_event.is_set():
+            if not response.read1(65536):
+                break
+        connexion.close()
+
+    def close(self):
+        self.connexion.close()
+
+
+class Recorder(object):
+    """collects the latency and the sizes of the requests per name"""
+
+    def __init__(self):
+        self.records = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, status, sent, received):
+        with self._lock:
+            self.records.setdefault(name, []).append(
+                (duration, sent, received)
+            )
+            if status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, elapsed):
+        answer = {}
+        total = 0
+        for name, records in sorted(self.records.items()):
+            total += len(records)
+            durations = [record[0] for record in records]
+            received = [record[2] for record in records]
+            answer[name] = {
+                'latency': percentiles(durations),
+                'request_bytes_mean': (
+                    sum(record[1] for record in records)
+                    / float(len(records))
+                ),
+                'response_bytes_mean': sum(received) / float(len(received)),
+                'response_bytes_max': max(received),
+                'errors': self.errors.get(name, 0)
+            }
+        return {
+            'requests': total,
+            'requests_per_s': total / elapsed if elapsed else 0.,
+            'errors': sum(self.errors.values()),
+            'callbacks': answer
+        }
+
+
+class DashboardClient(object):
+    """replays the requests of a browser showing the dashboard"""
+
+    def __init__(self, transport, recorder, rng, think_time=1.):
+
+        self.transport = transport
+        self.recorder = recorder
+        self.random = rng
+        # mean time between two actions of the user, in seconds
+        self.think_time = think_time
+
+        # state of the page, as the browser would send it
+        self.dark_theme = False
+        self.measuring = True
+        self.graph_view = None
+        self.channels = {}
+        self.powers = {}
+        self.callbacks = {}
+
+    def get(self, path, name=None):
+        start = time.perf_counter()
+        status, data = self.transport.get(path)
+        self.recorder.add(
+            name or path or 'index',
+            time.perf_counter() - start,
+            status,
+            0,
+            len(data)
+        )
+        return status, data
+
+    def call(self, name, payload):
+        """sends a callback request, returns the decoded response"""
+        body = json.dumps(payload).encode('utf-8')
+        start = time.perf_counter()
+        status, data = self.transport.post(UPDATE_ROUTE, body)
+        self.recorder.add(
+            name, time.perf_counter() - start, status, len(body), len(data)
+        )
+        if status == 200 and data:
+            return json.loads(data.decode('utf-8'))
+        return None
+
+    def load_page(self):
+        """loads the page, its layout and its first callbacks"""
+        self.get('')
+        self.get('_dash-layout')
+        status, data = self.get('_dash-dependencies')
+        for dependency in json.loads(data.decode('utf-8')):
+            output = dependency['output']
+            if 'graph.figure' in output:
+                self.callbacks['update_graph'] = output
+            elif 'page-content.children' in output:
+                self.callbacks['page_layout'] = output
+        self.change_theme(toggle=False)
+
+    def change_theme(self, toggle=True):
+        """the theme rebuilds the instruments' layout and the graph"""
+        if toggle:
+            self.dark_theme = not self.dark_theme
+        response = self.call('page_layout', {
+            'output': self.callbacks['page_layout'],
+            'outputs': {'id': 'page-content', 'property': 'children'},
+            'inputs': [{
+                'id': 'toggleTheme',
+                'property': 'value',
+                'value': self.dark_theme
+            }],
+            'changedPropIds': ['toggleTheme.value']
+        })
+        if response is not None:
+            layout = response['response']['page-content']['children']
+            # the components are reset to the values of the new layout
+            self.channels = dict(
+                (component_id['instr'], ['CG1', 'CG2', 'CG3', 'CG4'])
+                for component_id in find_ids(layout, 'channel')
+            )
+            self.powers = dict(
+                (component_id['instr'], True)
+                for component_id in find_ids(layout, 'power_button')
+            )
+        self.update_graph(prop_id('toggleTheme', 'value'))
+
+    def update_graph(self, changed):
+        inputs = [
+            {'id': 'measuring', 'property': 'value', 'value': self.measuring},
+            [
+                {
+                    'id': {'type': 'channel', 'instr': instr_key},
+                    'property': 'value',
+                    'value': channels
+                }
+                for instr_key, channels in self.channels.items()
+            ],
+            {
+                'id': 'toggleTheme',
+                'property': 'value',
+                'value': self.dark_theme
+            },
+            {'id': 'graph-view', 'property': 'data', 'value': self.graph_view}
+        ]
+        state = [[
+            {
+                'id': {'type': 'power_button', 'instr': instr_key},
+                'property': 'on',
+                'value': power
+            }
+            for instr_key, power in self.powers.items()
+        ]]
+        self.call('update_graph', {
+            'output': self.callbacks['update_graph'],
+            'outputs': [
+                {'id': 'graph', 'property': 'figure'},
+                {'id': 'graph-traces', 'property': 'data'}
+            ],
+            'inputs': inputs,
+            'state': state,
+            'changedPropIds': [changed]
+        })
+
+    def change_view(self):
+        """zooms on a random window of the last minutes or resizes"""
+        if self.random.random() < 0.2:
+            # back to the full trace
+            xrange = None
+        else:
+            now = datetime.datetime.utcnow()
+            start = now - datetime.timedelta(
+                seconds=self.random.uniform(10, 600)
+            )
+            xrange = [
+                start.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                now.strftime('%Y-%m-%d %H:%M:%S.%f')
+            ]
+        self.graph_view = {
+            'width': self.random.choice([640, 800, 1024, 1280, 1920]),
+            'xrange': xrange
+        }
+        self.update_graph(prop_id('graph-view', 'data'))
+
+    def change_channels(self):
+        if not self.channels:
+            return
+        instr_key = self.random.choice(sorted(self.channels))
+        channels = ['CG1', 'CG2', 'CG3', 'CG4']
+        self.channels[instr_key] = sorted(
+            self.random.sample(channels, self.random.randint(1, 4))
+        )
+        self.update_graph(
+            prop_id({'type': 'channel', 'instr': instr_key}, 'value')
+        )
+
+    def toggle_measuring(self):
+        self.measuring = not self.measuring
+        self.update_graph(prop_id('measuring', 'value'))
+
+    def act(self):
+        """does a random action of a user"""
+        action = self.random.choices(
+            list(ACTIONS), weights=list(ACTIONS.values())
+        )[0]
+        if action == 'graph_view':
+            self.change_view()
+        elif action == 'channels':
+            self.change_channels()
+        elif action == 'theme':
+            self.change_theme()
+        else:
+            self.toggle_measuring()
+
+    def run(self, deadline):
+        self.load_page()
+        while time.time() < deadline:
+            time.sleep(self.random.expovariate(1. / self.think_time))
+            self.act()
+
+
+def run_stage(make_transport, clients, duration, think_time, seed,
+              push_route=None):
+    """runs a number of clients for a duration and returns the summary of
+        their requests
+    """
+    recorder = Recorder()
+    deadline = time.time() + duration
+    stop_event = threading.Event()
+    failures = []
+
+    def client_thread(index):
+        transport = make_transport()
+        if push_route is not None:
+            push = threading.Thread(
+                target=transport.open_push, args=(push_route, stop_event)
+            )
+            push.daemon = True
+            push.start()
+        try:
+            DashboardClient(
+                transport,
+                recorder,
+                random.Random(seed + index),
+                think_time
+            ).run(deadline)
+        except Exception as err:
+            failures.append(repr(err))
+        finally:
+            transport.close()
+
+    start = time.time()
+    threads = [
+        threading.Thread(target=client_thread, args=(index,))
+        for index in range(clients)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop_event.set()
+
+    answer = recorder.summary(time.time() - start)
+    answer['clients'] = clients
+    answer['client_failures'] = failures
+    return answer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test of the dash app with simulated clients'
+    )
+    parser.add_argument(
+        '--app', default='app_mock',
+        help='module of the app to load in this process'
+    )
+    parser.add_argument(
+        '--url', help='url of a running app, instead of loading it'
+    )
+    parser.add_argument(
+        '--clients', default='1,5,10,20',
+        help='number of clients of each stage of the ramp'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=30.,
+        help='duration of each stage, in seconds'
+    )
+    parser.add_argument(
+        '--think-time', type=float, default=1.,
+        help='mean time between two actions of a client, in seconds'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--push', action='store_true',
+        help='keeps the stream of the measures open per client (--url only)'
+    )
+    parser.add_argument('--output', help='JSON file to save the results in')
+    parser.add_argument(
+        '--compare', help='JSON file of a previous run to compare with'
+    )
+    args = parser.parse_args()
+
+    push_route = None
+    if args.url:
+        def make_transport():
+            return HttpTransport(args.url)
+        if args.push:
+            from dash_daq_drivers.push import PUSH_ROUTE
+            push_route = PUSH_ROUTE
+    else:
+        module = importlib.import_module(args.app)
+        prefix = module.app.config.requests_pathname_prefix
+
+        def make_transport():
+            return InProcessTransport(module.app.server, prefix)
+
+    stages = {}
+    for clients in [int(n) for n in args.clients.split(',')]:
+        stages['clients_%03i' % clients] = run_stage(
+            make_transport,
+            clients,
+            args.duration,
+            args.think_time,
+            args.seed,
+            push_route
+        )
+
+    results = {'context': run_context(), 'results': stages}
+    save_results(results, args.output)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Background acquisition of the instruments of a lab's rack
+
+The engine owns the instruments and polls their selected channels at a fixed
+rate, independently of how many clients display the data and how often they
+refresh it. The dash callbacks only read what was already measured, and
+request the changes of port, which the engine applies before its next poll.
+
+Each client leases the channels it displays for LEASE_DURATION seconds and
+renews the lease while it displays them, the engine polls the channels of
+all the leases. A client opening, stopping or closing its page thus never
+stops the channels of the others.
+"""
+
+import asyncio
+import math
+import threading
+import time
+import traceback
+
+# default time between two acquisitions of the same channel, in seconds
+DEFAULT_PERIOD = 1.0
+# time during which the channels leased by a client are polled (s)
+LEASE_DURATION = 10.
+
+
+class ChannelSelection(object):
+    """channels to poll, indexed per instrument key like a dict of lists
+        A channel is polled until the time it is leased to, or until it is
+        deselected if it was selected for the whole rack
+    """
+
+    def __init__(self):
+
+        # time (as time.time) until which each channel is polled, inf once
+        # selected, indexed per (instrument key, channel)
+        self.expiries = {}
+        self._lock = threading.Lock()
+
+    def channels(self):
+        """returns the (instrument key, channel) which can be polled"""
+        return list(self.expiries)
+
+    def get_expiry(self, instr_key, chan):
+        return self.expiries.get((instr_key, chan), 0.)
+
+    def set_expiry(self, instr_key, chan, expiry):
+        self.expiries[(instr_key, chan)] = expiry
+
+    def __setitem__(self, instr_key, channels):
+        """selects the channels of an instrument until deselected"""
+        with self._lock:
+            for key, chan in self.channels():
+                if key == instr_key and chan not in channels \
+                        and self.get_expiry(key, chan) == math.inf:
+                    self.set_expiry(key, chan, 0.)
+            for chan in channels:
+                self.set_expiry(instr_key, chan, math.inf)
+
+    def lease(self, instr_key, channels, until):
+        """polls channels of an instrument at least until a time"""
+        with self._lock:
+            for chan in channels:
+                self.set_expiry(
+                    instr_key,
+                    chan,
+                    max(self.get_expiry(instr_key, chan), until)
+                )
+
+    def __getitem__(self, instr_key):
+        now = time.time()
+        return [
+            chan for key, chan in self.channels()
+            if key == instr_key and self.get_expiry(key, chan) > now
+        ]
+
+    def items(self):
+        instr_keys = []
+        for key, chan in self.channels():
+            if key not in instr_keys:
+                instr_keys.append(key)
+        return [(key, self[key]) for key in instr_keys]
+
+
+class PortRequests(object):
+    """ports the instruments were asked to connect to, indexed per
+        instrument key
+        Each request has a version, so the same port can be requested again
+        to reconnect
+    """
+
+    def __init__(self):
+
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def request(self, instr_key, port):
+        """asks for an instrument to be connected to a port"""
+        with self._lock:
+            version, _ = self.get(instr_key)
+            self.requests[instr_key] = (version + 1, port)
+
+    def get(self, instr_key):
+        """returns the version and the port of the last request, version 0
+            without request
+        """
+        return self.requests.get(instr_key, (0, None))
+
+
+class AcquisitionEngine(threading.Thread):
+    """polls the selected channels of a list of instruments in a thread"""
+
+    def __init__(self, instr_list, period=DEFAULT_PERIOD,
+                 selected_channels=None, port_requests=None,
+                 concurrent=False):
+
+        super(AcquisitionEngine, self).__init__(name='acquisition')
+        self.daemon = True
+
+        # instruments owned by the engine, indexed per instrument key
+        self.instruments = {}
+        for instr in instr_list:
+            self.instruments[instr.instr_key] = instr
+
+        # time between two polls of the rack, in seconds
+        self.period = period
+        # polls the instruments concurrently from an event loop (see
+        # async_poll) rather than one after another
+        self.concurrent = concurrent
+
+        # channels to poll, indexed per instrument key, can be shared with
+        # other processes (see shared_store.SharedSelection)
+        if selected_channels is None:
+            selected_channels = ChannelSelection()
+        self.selected_channels = selected_channels
+
+        # ports to connect the instruments to, can be shared with other
+        # processes (see shared_store.SharedPortRequests)
+        if port_requests is None:
+            port_requests = PortRequests()
+        self.port_requests = port_requests
+        # version of the last port request applied, per instrument key
+        self._port_versions = {}
+
+        # functions called with (instr, channels) after each measure
+        self.listeners = []
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def select_channels(self, instr, channels=None):
+        """sets the channels the engine polls on an instrument
+            An empty list (or None) stops the acquisition on this instrument
+        """
+        if channels is None:
+            channels = []
+
+        with self._lock:
+            self.selected_channels[instr.instr_key] = [
+                chan for chan in channels if chan in instr.measure_params
+            ]
+
+    def lease_channels(self, instr, channels, duration=LEASE_DURATION):
+        """polls channels of an instrument for duration seconds, along with
+            the channels selected and leased by the other clients
+        """
+        self.selected_channels.lease(
+            instr.instr_key,
+            [chan for chan in channels if chan in instr.measure_params],
+            time.time() + duration
+        )
+
+    def request_port(self, instr, port):
+        """asks for an instrument to be connected to a port, by the process
+            running the acquisition, before its next poll
+        """
+        self.port_requests.request(instr.instr_key, port)
+
+    def apply_port_requests(self):
+        """connects the instruments to the ports requested since the last
+            poll
+        """
+        for instr_id, instr in self.instruments.items():
+            version, port = self.port_requests.get(instr_id)
+            if version == self._port_versions.get(instr_id, 0):
+                continue
+            self._port_versions[instr_id] = version
+            try:
+                instr.connect(port)
+            except (IOError, OSError, ValueError) as err:
+                print("Connexion of %s to %s failed : %s" % (instr, port, err))
+
+    def add_listener(self, listener):
+        """registers a function called with the instrument and the list of
+            channels each time they are measured
+        """
+        self.listeners.append(listener)
+
+    def notify(self, instr, channels):
+        """calls the listeners once channels of an instrument were measured"""
+        for listener in self.listeners:
+            try:
+                listener(instr, channels)
+            except Exception as err:
+                # a faulty listener should not stop the acquisition
+                print("Listener %s failed : %s" % (listener, err))
+
+    def poll(self):
+        """measures once every selected channel of the rack"""
+
+        self.apply_port_requests()
+        with self._lock:
+            selection = list(self.selected_channels.items())
+
+        for instr_id, channels in selection:
+            instr = self.instruments.get(instr_id)
+            if instr is None or not channels:
+                continue
+            try:
+                # the instrument reads all its channels in one transaction
+                instr.measure_all(channels)
+            except (IOError, ValueError) as err:
+                # a failed measure should not stop the acquisition
+                print(
+                    "Acquisition of %s on %s failed : %s"
+                    % (', '.join(channels), instr, err)
+                )
+            except Exception:
+                # nor should a bug of a driver stop the other instruments
+                print(
+                    "Unexpected error in the acquisition of %s on %s :\n%s"
+                    % (', '.join(channels), instr, traceback.format_exc())
+                )
+            else:
+                self.notify(instr, channels)
+
+    async def async_poll(self):
+        """measures once every selected channel of the rack from an event loop
+            The instruments are polled concurrently, each on its own port
+        """
+
+        self.apply_port_requests()
+        with self._lock:
+            selection = list(self.selected_channels.items())
+
+        polled = []
+        polls = []
+        for instr_id, channels in selection:
+            instr = self.instruments.get(instr_id)
+            if instr is not None and channels:
+                polled.append((instr, channels))
+                polls.append(instr.async_measure_all(channels))
+
+        results = await asyncio.gather(*polls, return_exceptions=True)
+        for (instr, channels), result in zip(polled, results):
+            if isinstance(result, Exception):
+                # a failed measure should not stop the acquisition
+                print("Acquisition of %s failed : %s" % (instr, result))
+            else:
+                self.notify(instr, channels)
+
+    def poll_safely(self):
+        """polls the rack, an unexpected error is reported and the next poll
+            is made as usual, the thread would otherwise die silently
+        """
+        try:
+            self.poll()
+        except Exception:
+            print(
+                "Unexpected error in the acquisition :\n%s"
+                % traceback.format_exc()
+            )
+
+    def run(self):
+        """polls the rack every period until the engine is stopped"""
+        if self.concurrent:
+            # the thread has its own event loop
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.async_run())
+            finally:
+                loop.close()
+            return
+
+        while not self._stop_event.is_set():
+            start = time.time()
+            self.poll_safely()
+            elapsed = time.time() - start
+            self._stop_event.wait(max(0., self.period - elapsed))
+
+    async def async_run(self):
+        """polls the rack every period from an event loop until the engine
+            is stopped
+        """
+        loop = asyncio.get_event_loop()
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                await self.async_poll()
+            except Exception:
+                print(
+                    "Unexpected error in the acquisition :\n%s"
+                    % traceback.format_exc()
+                )
+            elapsed = time.time() - start
+            # the stop is noticed while waiting, without blocking the loop
+            await loop.run_in_executor(
+                None,
+                self._stop_event.wait,
+                max(0., self.period - elapsed)
+            )
+
+    def stop(self, timeout=None):
+        """stops the acquisition thread"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio access to the serial connexions of the instruments
+
+The transport watches the file descriptor of the port from the event loop
+instead of blocking a thread on it, so a single loop can talk to many
+instruments at once. Connexions without a file descriptor (pyvisa, serial
+ports on Windows) fall back on the default executor of the loop.
+
+A command also holds the thread lock of the port (see concurrency.py) while
+it is exchanged, so the commands sent from the loop and from the threads
+(i.e. the dash callbacks) are never interleaved on the wire.
+"""
+
+import asyncio
+import os
+
+# time between two attempts to take the thread lock of a port, which is
+# doubled up to the maximum while the port is used by another thread (s)
+LOCK_POLL_MIN = 0.0005
+LOCK_POLL_MAX = 0.01
+
+
+def running_loop():
+    """returns the event loop running the current coroutine"""
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # python < 3.7
+        return asyncio.get_event_loop()
+
+
+class AsyncTransport(object):
+    """reads and writes an instrument connexion from an asyncio event loop"""
+
+    def __init__(self, connexion, loop=None):
+
+        # the connexion handle of the instrument (i.e. serial.Serial)
+        self.connexion = connexion
+        # the event loop the transport is bound to, the running one if None
+        self.loop = loop
+
+        # only one coroutine at a time can send a command on the port, the
+        # lock belongs to the loop it was created in
+        self.lock = None
+        self._lock_loop = None
+
+        # bytes received from the port but not consumed yet
+        self.buffer = bytearray()
+
+        try:
+            self.fd = connexion.fileno()
+        except (AttributeError, IOError, ValueError):
+            self.fd = None
+
+    def get_loop(self):
+        """returns the event loop the transport is used from, which can
+            change between calls (i.e. successive asyncio.run)
+        """
+        if self.loop is not None:
+            return self.loop
+        return running_loop()
+
+    def get_lock(self):
+        """returns the lock serializing the coroutines sending commands on
+            the port, created again when the loop changes
+        """
+        loop = self.get_loop()
+        if self.lock is None or self._lock_loop is not loop:
+            self.lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self.lock
+
+    async def acquire(self, port_lock=None):
+        """waits until the port is free, for the coroutines of the loop and
+            for the threads sharing the thread lock of the port
+        """
+        lock = self.get_lock()
+        await lock.acquire()
+        if port_lock is None:
+            return
+        try:
+            delay = LOCK_POLL_MIN
+            # the loop must not block while a thread uses the port
+            while not port_lock.acquire(blocking=False):
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, LOCK_POLL_MAX)
+        except BaseException:
+            # i.e. the command was cancelled while waiting
+            lock.release()
+            raise
+
+    def release(self, port_lock=None):
+        """frees the port taken with acquire"""
+        if port_lock is not None:
+            port_lock.release()
+        self.lock.release()
+
+    async def _wait_fd(self, add_watcher, remove_watcher):
+        """waits until the file descriptor is ready to be read or written"""
+        loop = self.get_loop()
+        ready = loop.create_future()
+
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        add_watcher(self.fd, on_ready)
+        try:
+            await ready
+        finally:
+            remove_watcher(self.fd)
+
+    async def write(self, data):
+        """writes all the data to the port"""
+
+        if isinstance(data, str):
+            data = data.encode('ascii')
+
+        if self.fd is None:
+            return await self.get_loop().run_in_executor(
+                None, self.connexion.write, data
+            )
+
+        loop = self.get_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.fd, view)
+            except BlockingIOError:
+                written = 0
+            view = view[written:]
+            if view:
+                await self._wait_fd(loop.add_writer, loop.remove_writer)
+        return len(data)
+
+    async def read(self, num_bytes=None, terminator=b'\n'):
+        """reads num_bytes from the port, or up to the terminator if None"""
+
+        if self.fd is None:
+            if num_bytes is not None:
+                return await self.get_loop().run_in_executor(
+                    None, self.connexion.read, num_bytes
+                )
+            return await self.get_loop().run_in_executor(
+                None, self.connexion.readline
+            )
+
+        loop = self.get_loop()
+        while True:
+            if num_bytes is not None:
+                if len(self.buffer) >= num_bytes:
+                    answer = bytes(self.buffer[:num_bytes])
+                    del self.buffer[:num_bytes]
+                    return answer
+            else:
+                index = self.buffer.find(terminator)
+                if index >= 0:
+                    index += len(terminator)
+                    answer = bytes(self.buffer[:index])
+                    del self.buffer[:index]
+                    return answer
+
+            await self._wait_fd(loop.add_reader, loop.remove_reader)
+            try:
+                chunk = os.read(self.fd, 4096)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                raise IOError("The port was closed while reading")
+            self.buffer.extend(chunk)
+
+    def flush_input(self):
+        """drops the bytes already received, i.e. after a timeout"""
+        del self.buffer[:]
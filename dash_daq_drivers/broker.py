@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Local broker owning the connexions to the instruments
+
+Only one process can open a serial port. The broker is a daemon which opens
+the ports of the instruments and serves the commands of the other processes
+(web workers, command line tools) over a Unix socket, so they all share the
+same connexions without contending for the ports. A command and its reply
+are exchanged under a lock of the port, so the frames of two clients are
+never interleaved.
+
+The requests and the replies are JSON objects, one per line, i.e.
+    {"method": "ask", "port": "COM3", "args": ["#  RDCG1\\r", 13]}
+    {"result": {"bytes": "*   1.00E-03\\r"}}
+
+An instrument uses the broker with the INTF_BROKER interface, the broker
+itself is started with
+    $ python -m dash_daq_drivers.broker [--mock] [--socket PATH]
+The socket can only be used by the user running the broker, and a broker
+does not start on the socket of another one still running.
+In mock mode, each port opened is answered by a simulated MGC4000 controller
+behind a pseudo-terminal (see simulator.py) instead of hardware.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+# path of the socket of the broker when none is provided
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'dash-daq-broker.sock')
+# read timeout of the serial ports opened by the broker (s), a lost byte
+# must not block the port and its lock forever
+PORT_TIMEOUT = 1.
+# time a client waits for the reply of the broker (s)
+REPLY_TIMEOUT = 10.
+
+
+def encode_value(value):
+    """returns a JSON compatible version of the arguments and the replies
+        The bytes are wrapped in a dict and decoded as latin-1, which maps
+        each byte to a single character
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': bytes(value).decode('latin-1')}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    return value
+
+
+def decode_value(value):
+    """reverts encode_value"""
+    if isinstance(value, dict) and 'bytes' in value:
+        return value['bytes'].encode('latin-1')
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def broker_listens(path):
+    """tells if a broker answers on the socket at path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class BrokerPort(object):
+    """an instrument connexion opened by the broker and its clients"""
+
+    def __init__(self, instr, simulator=None):
+
+        # the generic instrument owning the connexion
+        self.instr = instr
+        # the simulated controller answering the port in mock mode
+        self.simulator = simulator
+        # number of clients using the port, it is closed with the last one
+        self.clients = 0
+        # serializes the commands of all the clients
+        self.lock = threading.Lock()
+
+
+class InstrumentBroker(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """serves the commands of the clients on the instruments' connexions"""
+
+    daemon_threads = True
+
+    # commands of the clients, run under the lock of the port
+    port_methods = ('write', 'read', 'ask', 'ask_many')
+
+    def __init__(self, path=DEFAULT_SOCKET, mock=False):
+
+        self.path = path
+        # ports are answered by simulated controllers, without hardware
+        self.mock = mock
+        # opened connexions, indexed per port name
+        self.ports = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            if broker_listens(path):
+                raise IOError(
+                    "An instrument broker already listens on %s" % path
+                )
+            # a socket left by a broker which did not stop cleanly
+            os.remove(path)
+
+        socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+
+    def server_bind(self):
+        # only the user running the broker can drive the instruments
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+
+    def open_port(self, port, intf=None, **kwargs):
+        """opens a connexion to a port or shares the one already opened
+            The first client sets the arguments of the connexion, a serial
+            port has a read timeout of PORT_TIMEOUT unless it sets one
+        """
+        # imported here as the instruments use the client of the broker
+        from .generic_instruments import Instrument, INTF_SERIAL
+
+        with self._lock:
+            broker_port = self.ports.get(port)
+            if broker_port is None:
+                simulator = None
+                port_name = port
+                if self.mock:
+                    # the commands are sent as to a real controller, on the
+                    # pseudo-terminal of the simulator
+                    from .simulator import MGC4000Simulator
+                    simulator = MGC4000Simulator()
+                    simulator.start()
+                    port_name = simulator.port_name
+                    intf = INTF_SERIAL
+                if (intf or INTF_SERIAL) == INTF_SERIAL:
+                    kwargs.setdefault('timeout', PORT_TIMEOUT)
+                try:
+                    instr = Instrument(
+                        instr_port_name=port_name,
+                        instr_id_name='broker',
+                        instr_intf=intf or INTF_SERIAL,
+                        instr_mesurands=[],
+                        **kwargs
+                    )
+                except Exception:
+                    if simulator is not None:
+                        simulator.stop()
+                    raise
+                broker_port = BrokerPort(instr, simulator)
+                self.ports[port] = broker_port
+            broker_port.clients += 1
+        return port
+
+    def close_port(self, port):
+        """releases a port, the connexion is closed with its last client"""
+        with self._lock:
+            broker_port = self.ports.get(port)
+            if broker_port is None:
+                return
+            broker_port.clients -= 1
+            if broker_port.clients <= 0:
+                del self.ports[port]
+                self.release(broker_port)
+
+    def release(self, broker_port):
+        """closes the connexion of a port and its simulator"""
+        broker_port.instr.disconnect()
+        if broker_port.simulator is not None:
+            broker_port.simulator.stop()
+
+    def call(self, method, port=None, args=(), kwargs=None):
+        """runs a request of a client and returns its result"""
+        if kwargs is None:
+            kwargs = {}
+
+        if method == 'connect':
+            return self.open_port(port, **kwargs)
+        elif method == 'disconnect':
+            return self.close_port(port)
+        elif method == 'status':
+            with self._lock:
+                return dict(
+                    (name, broker_port.clients)
+                    for name, broker_port in self.ports.items()
+                )
+        elif method in self.port_methods:
+            broker_port = self.ports.get(port)
+            if broker_port is None:
+                raise IOError("The port %s is not opened by the broker" % port)
+            with broker_port.lock:
+                return getattr(broker_port.instr, method)(*args, **kwargs)
+        else:
+            raise ValueError("Unknown broker method %s" % method)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        with self._lock:
+            for broker_port in self.ports.values():
+                self.release(broker_port)
+            self.ports = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """serves the requests of a client until it closes its socket"""
+
+    def handle(self):
+
+        # ports opened by this client, released if it leaves without closing
+        # them
+        opened = []
+
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    port = request.get('port')
+                    result = self.server.call(
+                        request['method'],
+                        port,
+                        decode_value(request.get('args', [])),
+                        request.get('kwargs')
+                    )
+                    if request['method'] == 'connect':
+                        opened.append(port)
+                    elif request['method'] == 'disconnect' and port in opened:
+                        opened.remove(port)
+                    reply = {'result': encode_value(result)}
+                except Exception as err:
+                    reply = {'error': str(err), 'type': type(err).__name__}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        finally:
+            for port in opened:
+                self.server.close_port(port)
+
+
+class BrokerConnexion(object):
+    """connexion to an instrument's port through the broker
+        Behaves like the connexion handle of a serial instrument, with ask
+        and ask_many methods which send a command and read its reply
+        atomically
+    """
+
+    def __init__(self, port, broker_path=DEFAULT_SOCKET, intf=None,
+                 timeout=PORT_TIMEOUT, reply_timeout=REPLY_TIMEOUT,
+                 **kwargs):
+
+        self.port = port
+        self.path = broker_path
+
+        # the timeout is the one of the port opened by the broker, a reply
+        # may also wait for the commands of the other clients
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+
+        if intf is not None:
+            kwargs['intf'] = intf
+        # the arguments of the port, sent again on a new socket
+        self.port_kwargs = kwargs
+        self.reply_timeout = reply_timeout
+
+        self.sock = None
+        self.stream = None
+        # a request and its reply must not be interleaved with another one
+        self._lock = threading.Lock()
+
+        self.call('connect', kwargs=kwargs)
+
+    def open_socket(self):
+        """connects to the broker"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.reply_timeout)
+        try:
+            sock.connect(self.path)
+        except (IOError, OSError) as err:
+            sock.close()
+            raise IOError(
+                "Cannot reach the instrument broker on %s : %s"
+                % (self.path, err)
+            )
+        self.sock = sock
+        self.stream = sock.makefile('rwb')
+
+    def close_socket(self):
+        """closes the socket, the broker then releases the port"""
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except (IOError, OSError):
+                pass
+            self.sock.close()
+        self.sock = None
+        self.stream = None
+
+    def exchange(self, method, args=(), kwargs=None):
+        """sends a request to the broker and returns its reply
+            Without reply the socket is closed, as the late reply would be
+            read as the one of the next request
+        """
+        request = {
+            'method': method,
+            'port': self.port,
+            'args': encode_value(args),
+            'kwargs': kwargs or {}
+        }
+        try:
+            self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.stream.flush()
+            line = self.stream.readline()
+        except (IOError, OSError) as err:
+            self.close_socket()
+            raise IOError(
+                "No reply of the instrument broker to %s : %s"
+                % (method, err)
+            )
+
+        if not line:
+            self.close_socket()
+            raise IOError("The instrument broker closed the connexion")
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise IOError(
+                "The instrument broker failed on %s : %s"
+                % (method, reply['error'])
+            )
+        return decode_value(reply['result'])
+
+    def call(self, method, args=(), kwargs=None):
+        """sends a request to the broker and returns its result
+            After a lost reply, the socket is opened again and the port
+            connected again before the request
+        """
+        with self._lock:
+            if self.stream is None:
+                self.open_socket()
+                if method != 'connect':
+                    self.exchange('connect', kwargs=self.port_kwargs)
+            return self.exchange(method, args, kwargs)
+
+    def write(self, msg):
+        return self.call('write', [msg])
+
+    def read(self, num_bytes=None):
+        return self.call('read', [num_bytes])
+
+    def readline(self):
+        return self.call('read')
+
+    def ask(self, msg, num_bytes=None):
+        """writes a command and reads its reply without any other client
+            using the port in between
+        """
+        return self.call('ask', [msg, num_bytes])
+
+    def ask_many(self, msgs, num_bytes=None):
+        """writes several commands and reads their replies at once"""
+        return self.call('ask_many', [list(msgs), num_bytes])
+
+    def status(self):
+        """returns the number of clients of each port opened by the broker"""
+        return self.call('status')
+
+    def close(self):
+        with self._lock:
+            if self.stream is not None:
+                try:
+                    self.exchange('disconnect')
+                except (IOError, OSError, ValueError):
+                    # the broker is already gone
+                    pass
+            self.close_socket()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Shares the connexions to the instruments'
+    )
+    parser.add_argument(
+        '--socket',
+        default=DEFAULT_SOCKET,
+        help='path of the Unix socket of the broker'
+    )
+    parser.add_argument(
+        '--mock',
+        action='store_true',
+        help='answers the ports with simulated MGC4000, without hardware'
+    )
+    args = parser.parse_args()
+
+    broker = InstrumentBroker(args.socket, mock=args.mock)
+    print("Instrument broker listening on %s" % args.socket)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Server callbacks updating the components of the instruments
+
+The apps of this repository update the gauges in the browser with the
+samples pushed to it (see push.py), which costs no request at all. For an app
+which does not stream the measures, make_gauges_callback registers a single
+multi-output callback updating every gauge of a rack, so each refresh costs
+one request whatever the number of gauges or instruments.
+"""
+
+import dash
+from dash.dependencies import Output, ALL
+
+
+def gauge_values(instruments, outputs_list):
+    """returns the last measure of the gauges of a callback's outputs
+        instruments are indexed per instrument key, the gauges of the
+        instruments of another rack are not updated
+    """
+    answer = []
+    for output in outputs_list:
+        instr = instruments.get(output['id']['instr'])
+        if instr is None:
+            answer.append(dash.no_update)
+        else:
+            answer.append(instr.last_measure[output['id']['chan']])
+    return answer
+
+
+def make_gauges_callback(instr_list, app, inputs):
+    """generates a single callback updating the gauges of all the instruments
+        of a rack
+        The gauges are matched with pattern-matching ids of type 'gauge'
+    """
+    instruments = dict((instr.instr_key, instr) for instr in instr_list)
+
+    @app.callback(
+        Output({'type': 'gauge', 'instr': ALL, 'chan': ALL}, 'value'),
+        inputs)
+    def update_gauges(*_):
+        return gauge_values(
+            instruments,
+            dash.callback_context.outputs_list
+        )
+
+    return update_gauges
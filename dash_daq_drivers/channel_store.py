@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the measured data in fixed capacity ring buffers
+
+Each channel keeps its values (float64) and the time at which they were
+taken (int64, nanoseconds since epoch) in preallocated numpy arrays, so the
+memory used by a long acquisition is bounded. Every sample is written twice,
+one capacity apart, which keeps the latest samples contiguous in memory, so
+readers copy them with a single slice.
+
+The buffer is written by the acquisition thread while the callbacks read it,
+and a full buffer overwrites its oldest samples in place: the readers get
+copies, retried until no sample was written meanwhile (seqlock), as a view
+could change under them.
+"""
+
+import time
+
+import numpy as np
+
+# default number of samples kept per channel
+DEFAULT_CAPACITY = 100000
+
+
+def now_ns():
+    """returns the current time in nanoseconds since epoch"""
+    return int(time.time() * 1e9)
+
+
+class RingBuffer(object):
+    """fixed capacity buffer of timestamped values"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+
+        if capacity < 1:
+            raise ValueError("The capacity of a RingBuffer must be positive")
+
+        self.capacity = capacity
+        # total number of samples ever appended
+        self.count = 0
+        # incremented before and after each write, odd while writing
+        self._sequence = 0
+
+        self._values = np.full(2 * capacity, np.nan, dtype=np.float64)
+        self._times = np.zeros(2 * capacity, dtype=np.int64)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def begin_write(self):
+        """marks the samples as being written"""
+        self._sequence += 1
+
+    def end_write(self):
+        """marks the samples as written"""
+        self._sequence += 1
+
+    def sequence(self):
+        """returns the sequence number, odd while samples are written"""
+        return self._sequence
+
+    def consistent(self, read):
+        """returns read() called until no sample was written meanwhile, the
+            result must be a copy of the samples
+        """
+        while True:
+            seq = self.sequence()
+            if seq % 2 == 0:
+                answer = read()
+                if self.sequence() == seq:
+                    return answer
+            # the writer is appending samples
+            time.sleep(0)
+
+    def append(self, value, timestamp=None):
+        """adds a sample, overwriting the oldest one once full"""
+
+        if timestamp is None:
+            timestamp = now_ns()
+
+        self.begin_write()
+        try:
+            i = self.count % self.capacity
+            self._values[i] = value
+            self._values[i + self.capacity] = value
+            self._times[i] = timestamp
+            self._times[i + self.capacity] = timestamp
+            # the sample is only visible to the readers once fully written
+            self.count += 1
+        finally:
+            self.end_write()
+
+    def extend(self, values, timestamps):
+        """adds several samples at once"""
+
+        values = np.asarray(values, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if values.shape != timestamps.shape:
+            raise ValueError("values and timestamps must have the same shape")
+
+        # only the last capacity samples would be kept anyway
+        skipped = max(0, len(values) - self.capacity)
+        values = values[skipped:]
+        timestamps = timestamps[skipped:]
+
+        npoints = len(values)
+        self.begin_write()
+        try:
+            indexes = (self.count + skipped + np.arange(npoints)) \
+                % self.capacity
+            self._values[indexes] = values
+            self._values[indexes + self.capacity] = values
+            self._times[indexes] = timestamps
+            self._times[indexes + self.capacity] = timestamps
+            self.count += skipped + npoints
+        finally:
+            self.end_write()
+
+    def _bounds(self, npoints, count=None):
+        """returns the slice of the internal arrays holding the latest
+            npoints samples when count samples were appended
+        """
+        if count is None:
+            count = self.count
+        end = (count - 1) % self.capacity + 1 + self.capacity
+        return slice(end - npoints, end)
+
+    def latest(self, npoints=None):
+        """returns copies of the times and values of the latest samples"""
+
+        def read():
+            size = len(self)
+            count = npoints
+            if count is None or count > size:
+                count = size
+            bounds = self._bounds(count)
+            return self._times[bounds].copy(), self._values[bounds].copy()
+        return self.consistent(read)
+
+    def since(self, cursor):
+        """returns copies of the samples appended after the cursor, which is
+            the total number of samples a reader already got, and the new
+            cursor of the reader
+            Samples overwritten before being read are skipped
+        """
+        def read():
+            count = self.count
+            npoints = min(max(count - cursor, 0), self.capacity)
+            bounds = self._bounds(npoints, count)
+            return (
+                self._times[bounds].copy(),
+                self._values[bounds].copy(),
+                count
+            )
+        return self.consistent(read)
+
+    def window(self, t_start=None, t_stop=None):
+        """returns copies of the times and values of the latest samples taken
+            within [t_start, t_stop) (ns since epoch), found by binary search
+            Only the samples within the window are copied
+        """
+        def read():
+            bounds = self._bounds(len(self))
+            times = self._times[bounds]
+            start = 0
+            stop = len(times)
+            if t_start is not None:
+                start = np.searchsorted(times, t_start, side='left')
+            if t_stop is not None:
+                stop = np.searchsorted(times, t_stop, side='left')
+            window = slice(bounds.start + start, bounds.start + stop)
+            return self._times[window].copy(), self._values[window].copy()
+        return self.consistent(read)
+
+    def last(self):
+        """returns the time and value of the latest sample"""
+        def read():
+            if self.count == 0:
+                return None, np.nan
+            bounds = self._bounds(1)
+            return self._times[bounds.start], self._values[bounds.start]
+        return self.consistent(read)
+
+
+class ChannelStore(object):
+    """ring buffers of measured data indexed per channel"""
+
+    def __init__(self, channels=None, capacity=DEFAULT_CAPACITY):
+
+        # number of samples kept per channel
+        self.capacity = capacity
+        self.buffers = {}
+
+        if channels is not None:
+            for chan in channels:
+                self.add_channel(chan)
+
+    def __getitem__(self, chan):
+        return self.buffers[chan]
+
+    def __contains__(self, chan):
+        return chan in self.buffers
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def keys(self):
+        return self.buffers.keys()
+
+    def add_channel(self, chan, capacity=None):
+        """creates the buffer of a channel"""
+        if capacity is None:
+            capacity = self.capacity
+        self.buffers[chan] = RingBuffer(capacity)
+
+    def append(self, chan, value, timestamp=None):
+        """records a sample measured on a channel"""
+        self.buffers[chan].append(value, timestamp)
+
+    def latest(self, chan, npoints=None):
+        """returns copies of the latest samples measured on a channel"""
+        return self.buffers[chan].latest(npoints)
+
+    def window(self, chan, t_start=None, t_stop=None):
+        """returns copies of the samples measured on a channel within
+            [t_start, t_stop)
+        """
+        return self.buffers[chan].window(t_start, t_stop)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of the traces written to the history
+
+The pressure of a pumped chamber stays flat for hours, which the history
+would otherwise store as thousands of identical samples. A compressor only
+keeps the samples needed to draw the trace within a tolerance, the trace
+being the straight lines between the kept samples (as plotted on a linear
+axis), which pass within the tolerance of every sample dropped in between:
+    - DeadbandCompressor keeps a sample when the value moves out of a band
+      around the last kept value, and the sample before it
+    - SwingingDoorCompressor keeps a sample when the line from the last kept
+      sample to the next one would miss one of the samples since
+The tolerance is either absolute (in the unit of the values) or relative to
+each value, as suits pressures spanning several decades.
+
+The samples on both sides of a change of status or of a NaN value (a failed
+measure) are always kept, so the gaps and the status changes are exact, as
+are the values which a relative tolerance cannot apply to (zero or
+negative). A sample is also kept at least every max_interval seconds.
+"""
+
+import numpy as np
+
+# longest time without keeping a sample (s)
+MAX_INTERVAL = 600.
+# number of samples first scanned for one leaving the band of a deadband,
+# doubled at each scan
+SCAN_SIZE = 64
+
+
+def records(samples):
+    """returns (time, value, status) samples as records for
+        HistoryChannel.extend
+    """
+    return {
+        'time': np.array([s[0] for s in samples], dtype=np.int64),
+        'value': np.array([s[1] for s in samples], dtype=np.float64),
+        'status': np.array([s[2] for s in samples], dtype=np.int8)
+    }
+
+
+class Compressor(object):
+    """keeps the samples of a trace needed to draw it within a tolerance
+        The state is kept between the batches of samples of a channel
+    """
+
+    def __init__(self, tolerance, relative=False, max_interval=MAX_INTERVAL):
+
+        if tolerance < 0:
+            raise ValueError("The tolerance of a compressor must be positive")
+
+        self.tolerance = tolerance
+        self.relative = relative
+        self.max_interval = None
+        if max_interval is not None:
+            self.max_interval = int(max_interval * 1e9)
+
+        # the last kept sample (time, transformed value)
+        self._kept = None
+        # the last sample received (time, value, status, transformed value)
+        self._last = None
+
+    def transform(self, values):
+        """returns the array of the values the tolerance applies
+            to, NaN for the ones which cannot be compared (kept exactly)
+        """
+        if self.relative:
+            with np.errstate(invalid='ignore'):
+                return np.where(values > 0, values, np.nan)
+        return np.asarray(values, dtype=np.float64)
+
+    def reset(self, timestamp, transformed):
+        """starts the comparisons from a kept sample"""
+        self._kept = (timestamp, transformed)
+
+    def exceeds(self, timestamp, transformed):
+        """tells if a sample cannot be drawn from the last kept one within
+            the tolerance
+            Should be redefined in children classes
+        """
+        pass
+
+    def is_kept(self, sample):
+        return self._kept is not None and self._kept[0] == sample[0]
+
+    def keep(self, sample, kept):
+        """appends a sample to the kept ones, unless it already is"""
+        if not self.is_kept(sample):
+            kept.append(sample[:3])
+            self.reset(sample[0], sample[3])
+
+    def add(self, sample, kept):
+        """compares a sample (time, value, status, transformed value) to the
+            previous ones and appends the samples it makes necessary to kept
+        """
+        last = self._last
+        self._last = sample
+
+        if last is None:
+            self.keep(sample, kept)
+        elif sample[3] != sample[3] or last[3] != last[3] \
+                or sample[2] != last[2]:
+            # both sides of a gap or of a status change are kept, the
+            # samples within a gap are the same
+            if sample[1] == sample[1] or last[1] == last[1] \
+                    or sample[2] != last[2]:
+                self.keep(last, kept)
+                self.keep(sample, kept)
+        elif self.exceeds(sample[0], sample[3]):
+            # the trace is drawn up to the previous sample, then from it
+            self.keep(last, kept)
+            if self.exceeds(sample[0], sample[3]):
+                self.keep(sample, kept)
+        elif self.max_interval is not None \
+                and sample[0] - self._kept[0] >= self.max_interval:
+            self.keep(sample, kept)
+
+    def compress(self, times, values, statuses):
+        """returns the samples to keep among sorted samples, as a dict of
+            arrays indexed per column name (time, value and status)
+        """
+        kept = []
+        for sample in zip(
+            times.tolist(),
+            values.tolist(),
+            statuses.tolist(),
+            self.transform(values).tolist()
+        ):
+            self.add(sample, kept)
+        return records(kept)
+
+    def flush(self):
+        """returns the last sample received if it was not kept, as records
+            for HistoryChannel.extend, None otherwise
+        """
+        last = self._last
+        if last is None or self.is_kept(last):
+            return None
+        self.reset(last[0], last[3])
+        return records([last])
+
+
+class DeadbandCompressor(Compressor):
+    """keeps the samples out of the band around the last kept value
+        The samples are scanned with numpy up to the next one leaving the
+        band, so a flat trace costs few Python steps
+    """
+
+    def __init__(self, tolerance, relative=False, max_interval=MAX_INTERVAL):
+
+        super(DeadbandCompressor, self).__init__(
+            tolerance,
+            relative,
+            max_interval
+        )
+        # the line between two samples of the band stays in the band, so
+        # the band is half the tolerance wide on each side, less in relative
+        # as the tolerance then applies to the lower values of the band
+        if relative:
+            self._margin = tolerance / (2. + tolerance)
+        else:
+            self._margin = tolerance / 2.
+
+    def band(self, kept_value):
+        """returns the largest gap from the last kept value within the band"""
+        if self.relative:
+            return self._margin * kept_value
+        return self._margin
+
+    def exceeds(self, timestamp, transformed):
+        return abs(transformed - self._kept[1]) > self.band(self._kept[1])
+
+    def leaves_band(self, transformed, start, stop):
+        """returns the index of the first of transformed[start:stop] out of
+            the band around the last kept value, stop if there is none
+        """
+        kept_value = self._kept[1]
+        band = self.band(kept_value)
+        size = SCAN_SIZE
+        while start < stop:
+            end = min(start + size, stop)
+            out = np.flatnonzero(np.abs(transformed[start:end] - kept_value)
+                                 > band)
+            if len(out):
+                return start + int(out[0])
+            start = end
+            size *= 2
+        return stop
+
+    def compress(self, times, values, statuses):
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        statuses = np.asarray(statuses)
+        transformed = self.transform(values)
+        kept = []
+
+        def sample(index):
+            return (
+                int(times[index]),
+                float(values[index]),
+                int(statuses[index]),
+                float(transformed[index])
+            )
+
+        index = 0
+        if self._last is None and len(times):
+            self.add(sample(0), kept)
+            index = 1
+        if index >= len(times):
+            return records(kept)
+
+        # the samples on either side of a gap or of a status change
+        last = self._last
+        changes = np.flatnonzero(
+            np.isnan(transformed)
+            | np.isnan(np.r_[last[3], transformed[:-1]])
+            | (statuses != np.r_[last[2], statuses[:-1]])
+        )
+
+        while index < len(times):
+            # the samples before the next one which may be kept only make
+            # it the last one received
+            stop = len(times)
+            following = np.searchsorted(changes, index)
+            if following < len(changes):
+                stop = int(changes[following])
+            if self.max_interval is not None:
+                stop = min(stop, max(index, int(np.searchsorted(
+                    times,
+                    self._kept[0] + self.max_interval
+                ))))
+            stop = self.leaves_band(transformed, index, stop)
+            if stop > index:
+                self._last = sample(stop - 1)
+            if stop == len(times):
+                break
+            self.add(sample(stop), kept)
+            index = stop + 1
+
+        return records(kept)
+
+
+class SwingingDoorCompressor(Compressor):
+    """keeps the samples where the corridor of the lines drawn from the last
+        kept sample within the tolerance of the following ones closes
+    """
+
+    def margin(self, transformed):
+        """returns the largest gap between the trace and a value"""
+        if self.relative:
+            return self.tolerance * transformed
+        return self.tolerance
+
+    def reset(self, timestamp, transformed):
+        super(SwingingDoorCompressor, self).reset(timestamp, transformed)
+        # the range of slopes of the lines within the tolerance of all the
+        # samples since the last kept one
+        self._slopes = (-np.inf, np.inf)
+
+    def exceeds(self, timestamp, transformed):
+        kept_time, kept_value = self._kept
+        elapsed = float(timestamp - kept_time)
+        if elapsed <= 0:
+            return False
+        low, high = self._slopes
+        if not low <= (transformed - kept_value) / elapsed <= high:
+            # the line drawn up to this sample would miss a previous one
+            return True
+        margin = self.margin(transformed)
+        self._slopes = (
+            max(low, (transformed - margin - kept_value) / elapsed),
+            min(high, (transformed + margin - kept_value) / elapsed)
+        )
+        return False
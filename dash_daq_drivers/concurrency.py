@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Thread safety of the communication with the instruments
+
+Flask serves the dash callbacks on several threads, and the acquisition
+engine runs in its own. A command and its reply must be exchanged without
+any other thread using the port in between, otherwise the reply frames of
+two commands get mixed. The port locks serialize the commands per
+connexion, and the single-flight groups let concurrent threads asking the
+same query share one exchange instead of queueing duplicates.
+"""
+
+import threading
+import time
+import weakref
+
+# one lock per connexion handle, shared by the instruments using it
+_PORT_LOCKS = weakref.WeakKeyDictionary()
+_PORT_LOCKS_LOCK = threading.Lock()
+
+
+def port_lock(connexion):
+    """returns the lock serializing the commands sent on a connexion
+        Raises TypeError if the connexion cannot be weakly referenced
+    """
+    with _PORT_LOCKS_LOCK:
+        lock = _PORT_LOCKS.get(connexion)
+        if lock is None:
+            # reentrant as a command can be made of a write and a read
+            lock = threading.RLock()
+            _PORT_LOCKS[connexion] = lock
+    return lock
+
+
+class _Call(object):
+    """a call in flight and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # time at which the call returned
+        self.finished = None
+
+
+class SingleFlight(object):
+    """runs a single call at a time per key, the threads calling with the
+        same key meanwhile get the result of the call in flight
+        With a window, the result is also reused by the calls made less than
+        window seconds after it returned
+    """
+
+    def __init__(self, window=0.):
+
+        self.window = window
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        """returns the result of function(*args, **kwargs), shared with the
+            concurrent calls made with the same key
+        """
+        with self._lock:
+            call = self.calls.get(key)
+            if call is not None and call.finished is not None \
+                    and time.time() - call.finished > self.window:
+                # the result is too old to be reused
+                call = None
+            owner = call is None
+            if owner:
+                call = _Call()
+                self.calls[key] = call
+
+        if not owner:
+            call.done.wait()
+        else:
+            try:
+                call.result = function(*args, **kwargs)
+            except BaseException as err:
+                # the threads waiting for the call fail as well, rather than
+                # getting a result which was never set
+                call.error = err
+            finally:
+                with self._lock:
+                    call.finished = time.time()
+                    if self.window <= 0 or call.error is not None:
+                        self.calls.pop(key, None)
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def forget(self, key=None):
+        """drops the results kept for a key, or for all keys"""
+        with self._lock:
+            if key is None:
+                self.calls = dict(
+                    (k, call) for k, call in self.calls.items()
+                    if call.finished is None
+                )
+            else:
+                call = self.calls.get(key)
+                if call is not None and call.finished is not None:
+                    del self.calls[key]
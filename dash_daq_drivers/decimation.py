@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Reduction of the measured traces to the resolution at which they are shown
+
+A graph a few hundred pixels wide cannot show more than a couple of points
+per pixel, so sending every measure to the browser only costs bandwidth.
+The min/max decimation keeps the extreme values of each pixel bin, which
+preserves the peaks of the trace (i.e. pressure bursts) unlike a plain
+subsampling.
+
+The measures are timed in UTC, but a plotly date axis has no time zone and
+shows the times as they are sent, so the traces are sent in the local time
+of the server, as the measures were timed before.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+import numpy as np
+
+from .channel_store import now_ns
+
+# width of the graph assumed until the browser reports it, in pixels
+DEFAULT_WIDTH = 1000
+# number of decimated traces kept in memory
+CACHE_SIZE = 64
+# the offsets to UTC change on the hour (i.e. daylight saving time)
+HOUR_NS = 3600 * 10 ** 9
+
+
+def utc_offsets(times):
+    """returns the offset of the local time from UTC (ns) at each time (ns
+        since epoch)
+    """
+    times = np.asarray(times, dtype=np.int64)
+    hours, inverse = np.unique(times // HOUR_NS, return_inverse=True)
+    offsets = np.array(
+        [time.localtime(hour * 3600).tm_gmtoff for hour in hours.tolist()],
+        dtype=np.int64
+    ) * 10 ** 9
+    return offsets[inverse].reshape(times.shape)
+
+
+def current_utc_offset():
+    """returns the offset of the local time from UTC now, in ms"""
+    return time.localtime().tm_gmtoff * 1000
+
+
+def to_local_time(times):
+    """returns times (ns since epoch) as local datetime64, to be displayed"""
+    times = np.asarray(times, dtype=np.int64)
+    return (times + utc_offsets(times)).view('datetime64[ns]')
+
+
+def from_local_time(local_time):
+    """returns a local time (as parsed by numpy.datetime64) in ns since
+        epoch
+    """
+    local_time = int(np.datetime64(str(local_time), 'ns').astype(np.int64))
+    return local_time - int(utc_offsets(
+        local_time - utc_offsets(local_time)
+    ))
+
+
+def minmax_decimate(xdata, ydata, n_bins):
+    """keeps the first, the last, the min and the max points of each of the
+        n_bins bins of the trace, so at most 2 * n_bins + 2 points
+        NaN values (failed measures) are only kept for bins without any
+        valid value
+    """
+    npoints = len(ydata)
+    if n_bins < 1 or npoints <= 2 * n_bins:
+        return xdata, ydata
+
+    bin_size = int(np.ceil(npoints / float(n_bins)))
+    n_full = npoints // bin_size
+
+    # the full bins form a 2D array, the remainder of the trace a last bin
+    remainder = n_full * bin_size
+    blocks = [(0, ydata[:remainder].reshape(n_full, bin_size))]
+    if remainder < npoints:
+        blocks.append((remainder, ydata[remainder:].reshape(1, -1)))
+
+    indexes = [np.array([0, npoints - 1])]
+    for start, block in blocks:
+        missing = np.isnan(block)
+        offsets = start + np.arange(block.shape[0]) * block.shape[1]
+        indexes.append(
+            offsets + np.where(missing, np.inf, block).argmin(axis=1)
+        )
+        indexes.append(
+            offsets + np.where(missing, -np.inf, block).argmax(axis=1)
+        )
+
+    indexes = np.unique(np.concatenate(indexes))
+    return xdata[indexes], ydata[indexes]
+
+
+def decimate_segments(segments, n_bins):
+    """decimates a trace split in (x, y) segments, i.e. the chunks of its
+        history, into about n_bins bins in total without joining the
+        segments first, only the decimated points are copied
+    """
+    total = sum(len(ydata) for xdata, ydata in segments)
+    xblocks = []
+    yblocks = []
+    for xdata, ydata in segments:
+        if not len(ydata):
+            continue
+        # each segment gets a share of the bins proportional to its length
+        bins = max(1, int(round(n_bins * len(ydata) / float(total))))
+        xdata, ydata = minmax_decimate(xdata, ydata, bins)
+        xblocks.append(xdata)
+        yblocks.append(ydata)
+    if not xblocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    return np.concatenate(xblocks), np.concatenate(yblocks)
+
+
+def window_resolution(instr, instr_param, t_start, t_stop, n_bins):
+    """returns the time (s) spanned by each of the n_bins bins of a window,
+        None if the channel has no history to read aggregates from
+        An open bound is the first record of the history or now
+    """
+    if instr.historian is None:
+        return None
+    if t_start is None:
+        t_start = instr.historian.first_time(instr.instr_key, instr_param)
+        if t_start is None:
+            return None
+    if t_stop is None:
+        t_stop = now_ns()
+    return max(t_stop - t_start, 0) / 1e9 / n_bins
+
+
+class TraceDecimator(object):
+    """decimates the traces of a channel store and caches the results
+        A cached trace is reused as long as no new sample was recorded on its
+        channel, and for the same window and resolution
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # the callbacks can be served by several threads
+        self._lock = threading.Lock()
+
+    def decimate(self, instr, instr_param, width=DEFAULT_WIDTH,
+                 t_start=None, t_stop=None):
+        """returns the (x, y) arrays of the channel trace within the window
+            [t_start, t_stop) (ns since epoch), reduced to about twice the
+            width in pixels of the graph, x being the local times
+            The trace goes back in the history of the instrument if it has
+            a historian, beyond the samples kept in the channel's buffer
+        """
+        if width is None:
+            width = DEFAULT_WIDTH
+        width = int(width)
+
+        buffer = instr.measured_data[instr_param]
+        history = instr.channel_history(instr_param)
+        if history is not None:
+            history.refresh()
+        key = (instr.instr_key, instr_param, t_start, t_stop, width)
+        count = (buffer.count, 0 if history is None else history.count)
+
+        with self._lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] == count:
+                self.cache.move_to_end(key)
+                return cached[1]
+
+        xdata, ydata = decimate_segments(
+            instr.query(
+                instr_param,
+                t_start,
+                t_stop,
+                window_resolution(instr, instr_param, t_start, t_stop, width)
+            ),
+            width
+        )
+        # the decimated trace is a copy, it will not change with the buffer
+        trace = (
+            to_local_time(xdata),
+            np.array(ydata, copy=True)
+        )
+
+        with self._lock:
+            self.cache[key] = (count, trace)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return trace
+
+
+def parse_view(graph_view):
+    """extracts the width in pixels and the x-axis window in ns since epoch
+        from the view reported by the browser, in local time
+        i.e. {'width': 800, 'xrange': ['2018-06-01 12:00', '2018-06-01 13:00']}
+    """
+    width = DEFAULT_WIDTH
+    t_start = None
+    t_stop = None
+
+    if graph_view:
+        width = graph_view.get('width') or DEFAULT_WIDTH
+        xrange = graph_view.get('xrange')
+        if xrange:
+            try:
+                t_start, t_stop = [from_local_time(t) for t in xrange]
+            except ValueError:
+                t_start = None
+                t_stop = None
+
+    return width, t_start, t_stop
@@ -5,14 +5,27 @@ Created on Tue Mar 27 18:12:03 2018
 @author: Pierre-Francois Duc
 """
 
+import asyncio
+import threading
+
+import numpy as np
 import serial
 import visa
 
+from .async_transport import AsyncTransport
+from .broker import BrokerConnexion
+from .channel_store import ChannelStore, DEFAULT_CAPACITY
+from .concurrency import port_lock, SingleFlight
+from .historian import STATUS_UNKNOWN
+from .scheduler import port_scheduler, PRIORITY_BULK
+
 # names to manage the different interfaces used to connect to an instrument
 INTF_VISA = 'pyvisa'
 INTF_PROLOGIX = 'prologix'
 INTF_SERIAL = 'serial'
 INTF_INTERNAL = 'internal'
+# the port is opened by the instrument broker (see broker.py)
+INTF_BROKER = 'broker'
 
 
 class Instrument(object):
@@ -26,6 +39,9 @@ class Instrument(object):
         mock_mode=False,
         instr_intf=None,
         instr_mesurands=None,
+        data_capacity=DEFAULT_CAPACITY,
+        coalesce_window=0.,
+        scheduling=True,
         **kwargs
     ):
 
@@ -48,25 +64,40 @@ class Instrument(object):
         self.params_units = instr_mesurands
         # value of the last measure indexed per measurement channel
         self.last_measure = {}
-        # array of all measures indexed per measurement channel
-        self.measured_data = {}
+        # timestamped measures indexed per measurement channel, only the
+        # latest data_capacity measures of each channel are kept
+        self.measured_data = ChannelStore(capacity=data_capacity)
+        # on-disk history of the channels, see historian.Historian.attach
+        self.historian = None
 
         # Instrument connexion attributes
 
         # the name of the port to connect to the instrument
         self.instr_port_name = instr_port_name
+        # identifies the instrument in the app's components, unlike
+        # unique_id it does not change when the port is changed
+        self.instr_key = self.unique_id()
         # the name of the interface used to connect to the instrument
         self.instr_intf = instr_intf
         # connexion handle
         self.instr_connexion = None
         # termination characters used to communicate with the instrument
         self.term_chars = ""
+        # asyncio access to the connexion, created at first use
+        self.async_transport = None
+        # serializes the commands when there is no connexion handle to lock
+        self.lock = threading.RLock()
+        # identical queries asked concurrently (or within coalesce_window
+        # seconds) share the same reply
+        self.single_flight = SingleFlight(coalesce_window)
+        # the commands are sent by the priority scheduler of the port
+        self.scheduling = scheduling
 
         for param in instr_mesurands:
             # initializes the first measured value to 0 and the channels'
             # names
             self.measure_params.append(param)
-            self.measured_data[param] = []
+            self.measured_data.add_channel(param)
             self.last_measure[param] = 0
             self.params_names[param] = param
 
@@ -90,23 +121,340 @@ class Instrument(object):
         """
         return "%s(%s)" % (self.instr_id_name, self.instr_port_name)
 
+    def component_id(self, component_type, **kwargs):
+        """returns the pattern-matching id of a component of the instrument
+            i.e. {'type': 'power_button', 'instr': 'MGC4000(COM3)'}
+        """
+        answer = {'type': component_type, 'instr': self.instr_key}
+        answer.update(kwargs)
+        return answer
+
+    def get_port_lock(self):
+        """returns the lock of the connexion, shared by all the instruments
+            using it, so a command and its reply are never interleaved with
+            the ones of another thread
+        """
+        if self.instr_connexion is None:
+            return self.lock
+        try:
+            return port_lock(self.instr_connexion)
+        except TypeError:
+            # the connexion handle cannot be weakly referenced
+            return self.lock
+
+    def get_scheduler(self):
+        """returns the priority scheduler of the port, None if the commands
+            are sent directly
+        """
+        if self.mock_mode or not self.scheduling \
+                or self.instr_connexion is None \
+                or self.instr_intf not in (INTF_SERIAL, INTF_PROLOGIX):
+            return None
+        try:
+            return port_scheduler(self.instr_connexion)
+        except TypeError:
+            # the connexion handle cannot be weakly referenced
+            return None
+
+    def command_priority(self, msg):
+        """returns the priority class of a command (see scheduler.py)
+            Should be redefined in children classes, by default all the
+            commands are sent in order of arrival
+        """
+        return PRIORITY_BULK
+
     def measure(self, instr_param='', **kwargs):
         """initiate a measure by the instrument
             Should be redefined in children classes
         """
         pass
 
+    def measure_all(self, instr_params=None):
+        """measures several channels and returns the values per channel
+            Children classes can redefine it to group the communication with
+            the instrument
+        """
+        if instr_params is None:
+            instr_params = self.measure_params
+
+        answers = {}
+        for instr_param in instr_params:
+            answers[instr_param] = self.measure(instr_param)
+        return answers
+
+    async def async_measure(self, instr_param='', **kwargs):
+        """initiate a measure by the instrument from an event loop
+            Should be redefined in children classes, by default the blocking
+            measure is run in the executor of the loop
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            None, lambda: self.measure(instr_param, **kwargs)
+        )
+
+    async def async_measure_all(self, instr_params=None):
+        """measures several channels from an event loop"""
+        if instr_params is None:
+            instr_params = self.measure_params
+
+        answers = {}
+        for instr_param in instr_params:
+            answers[instr_param] = await self.async_measure(instr_param)
+        return answers
+
+    def snapshot(self, instr_param, npoints=None):
+        """returns the latest data measured on a channel as (x, y) arrays
+            The x values are the measure times (UTC) as numpy datetime64, both
+            arrays are copies, the buffer is overwritten once full
+        """
+        times, values = self.measured_data.latest(instr_param, npoints)
+        return times.view('datetime64[ns]'), values
+
+    def channel_history(self, instr_param):
+        """returns the on-disk history of a channel, None without historian"""
+        if self.historian is None:
+            return None
+        return self.historian.channel(self.instr_key, instr_param)
+
+    def query(self, instr_param, t_start=None, t_stop=None,
+              resolution=None):
+        """returns the samples of a channel taken within [t_start, t_stop)
+            (ns since epoch) as a list of (times, values) segments
+            The segments are views on the chunks of the history followed by
+            a copy of the samples of the channel's buffer within the window,
+            found by binary search
+            If a resolution (s) is given, the history is read from the
+            coarsest tier of aggregates whose bins are not wider
+        """
+        # the buffer is read first, the samples it lost meanwhile are in the
+        # history
+        times, values = self.measured_data.window(
+            instr_param, t_start, t_stop
+        )
+        segments = []
+
+        history = self.channel_history(instr_param)
+        if history is not None:
+            if resolution is not None:
+                # the aggregates, then the raw samples not yet rolled up
+                segments, t_start = self.historian.query_rollups(
+                    self.instr_key,
+                    instr_param,
+                    t_start,
+                    t_stop,
+                    resolution
+                )
+                if t_start is not None:
+                    skipped = np.searchsorted(times, t_start, side='left')
+                    times = times[skipped:]
+                    values = values[skipped:]
+            # the history before the samples read from the buffer
+            history_stop = t_stop
+            if len(times):
+                history_stop = int(times[0])
+            for segment in history.query(
+                t_start, history_stop, ['time', 'value']
+            ):
+                segments.append((segment['time'], segment['value']))
+
+        if len(times):
+            segments.append((times, values))
+        return segments
+
+    def channel_status(self, instr_param):
+        """returns the status of the last measure of a channel as an int8
+            code, kept with the measure in the history
+            0 is a valid measure, the instruments which know more about the
+            state of their channels override it
+        """
+        timestamp, value = self.measured_data[instr_param].last()
+        if timestamp is None or value != value:
+            return STATUS_UNKNOWN
+        return 0
+
     def read(self, num_bytes=None):
         """reads data available on the port"""
 
+        if not self.mock_mode:
+            with self.get_port_lock():
+                if self.instr_intf == INTF_VISA:
+                    answer = self.instr_connexion.read()
+                elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX,
+                                         INTF_BROKER):
+                    if num_bytes is not None:
+                        answer = self.instr_connexion.read(num_bytes)
+                    else:
+                        answer = self.instr_connexion.readline()
+                # the provided instrument interface is unknown
+                else:
+                    answer = None
+        # in mock mode
+        else:
+            answer = 'mock_mode_read'
+
+        return answer
+
+    def parse_answer(self, answer):
+        """extracts the content of a reply read from the instrument
+            Should be redefined in children classes, by default the reply is
+            returned as it is
+        """
+        return answer
+
+    def write(self, msg):
+        """writes command to the instrument but does not require a response"""
+
+        if not self.mock_mode:
+            if self.instr_connexion is None:
+                raise(IOError("There is no physical connexion established \
+with the instrument %s" % self.instr_id_name))
+            with self.get_port_lock():
+                if self.instr_intf == INTF_PROLOGIX:
+                    # make sure the address is the right one, the controller
+                    # only sends it if another instrument was selected
+                    self.instr_connexion.select(self.instr_port_name)
+                data = msg + self.term_chars
+                if self.instr_intf == INTF_SERIAL and isinstance(data, str):
+                    # pyserial only sends bytes
+                    data = data.encode('ascii')
+                answer = self.instr_connexion.write(data)
+        else:
+            answer = msg
+        return answer
+
+    def ask(self, msg, num_bytes=None):
+        """ writes a command to the instrument and reads its reply
+            The threads asking the same query at the same time share a single
+            exchange with the instrument
+        """
+        return self.single_flight.do(
+            (msg, num_bytes),
+            self._scheduled_ask,
+            msg,
+            num_bytes
+        )
+
+    def _scheduled_ask(self, msg, num_bytes=None):
+        """sends a command through the scheduler of the port, if any"""
+        scheduler = self.get_scheduler()
+        if scheduler is None:
+            return self._ask(msg, num_bytes)
+        return scheduler.call(
+            self._ask,
+            (msg, num_bytes),
+            priority=self.command_priority(msg)
+        )
+
+    def _ask(self, msg, num_bytes=None):
+        """writes a command and reads its reply under the lock of the port"""
+
+        answer = None
+
+        if not self.mock_mode:
+            with self.get_port_lock():
+                if self.instr_intf == INTF_VISA:
+                    answer = self.instr_connexion.ask(msg)
+                elif self.instr_intf == INTF_BROKER:
+                    # the broker sends the command and reads its reply at once
+                    answer = self.parse_answer(
+                        self.instr_connexion.ask(
+                            msg + self.term_chars,
+                            num_bytes
+                        )
+                    )
+                elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
+                    self.write(msg)
+                    answer = self.read(num_bytes)
+        else:
+            answer = msg
+        return answer
+
+    def ask_many(self, msgs, num_bytes=None):
+        """writes several commands back-to-back and reads all their replies
+            With fixed size replies (num_bytes), all of them are read at once
+            and split afterwards, which saves a round-trip per command
+            The batch is scheduled with the priority of its most urgent
+            command
+        """
+        msgs = list(msgs)
+        scheduler = self.get_scheduler()
+        if scheduler is None or not msgs:
+            return self._ask_many(msgs, num_bytes)
+        return scheduler.call(
+            self._ask_many,
+            (msgs, num_bytes),
+            priority=min(self.command_priority(msg) for msg in msgs)
+        )
+
+    def _ask_many(self, msgs, num_bytes=None):
+        """writes several commands and reads their replies under the lock
+            of the port
+        """
+
+        answers = []
+
+        if not self.mock_mode:
+            # no other command can be sent until all the replies are read
+            with self.get_port_lock():
+                if self.instr_intf == INTF_VISA:
+                    answers = [self.instr_connexion.ask(msg) for msg in msgs]
+                elif self.instr_intf == INTF_BROKER:
+                    answers = self.instr_connexion.ask_many(
+                        [msg + self.term_chars for msg in msgs],
+                        num_bytes
+                    )
+                elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
+                    if self.instr_intf == INTF_SERIAL:
+                        # all the commands leave in a single write
+                        self.write(self.term_chars.join(msgs))
+                    else:
+                        # the adapter frames each command on its own
+                        for msg in msgs:
+                            self.write(msg)
+                    if num_bytes is not None:
+                        buffer = Instrument.read(self, num_bytes * len(msgs))
+                        answers = [
+                            buffer[i * num_bytes:(i + 1) * num_bytes]
+                            for i in range(len(msgs))
+                        ]
+                    else:
+                        answers = [Instrument.read(self) for msg in msgs]
+        else:
+            answers = list(msgs)
+        return answers
+
+    def get_async_transport(self):
+        """returns the asyncio transport bound to the current connexion"""
+        if self.instr_connexion is None:
+            raise(IOError("There is no physical connexion established \
+with the instrument %s" % self.instr_id_name))
+
+        if self.async_transport is None \
+                or self.async_transport.connexion is not self.instr_connexion:
+            self.async_transport = AsyncTransport(self.instr_connexion)
+        return self.async_transport
+
+    async def async_read(self, num_bytes=None, timeout=None):
+        """reads data available on the port without blocking the loop"""
+
         if not self.mock_mode:
             if self.instr_intf == INTF_VISA:
-                answer = self.instr_connexion.read()
+                answer = await asyncio.wait_for(
+                    asyncio.get_event_loop().run_in_executor(
+                        None, self.instr_connexion.read
+                    ),
+                    timeout
+                )
             elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
-                if num_bytes is not None:
-                    answer = self.instr_connexion.read(num_bytes)
-                else:
-                    answer = self.instr_connexion.readline()
+                transport = self.get_async_transport()
+                try:
+                    answer = await asyncio.wait_for(
+                        transport.read(num_bytes),
+                        timeout
+                    )
+                except asyncio.TimeoutError:
+                    # a partial reply would shift all the following ones
+                    transport.flush_input()
+                    raise
             # the provided instrument interface is unknown
             else:
                 answer = None
@@ -116,44 +464,95 @@ class Instrument(object):
 
         return answer
 
-    def write(self, msg):
-        """writes command to the instrument but does not require a response"""
+    async def async_write(self, msg, timeout=None):
+        """writes command to the instrument without blocking the loop"""
 
         if not self.mock_mode:
+            transport = self.get_async_transport()
             if self.instr_intf == INTF_PROLOGIX:
                 # make sure the address is the right one
-                self.instr_connexion.write(
-                    "++addr %s" % self.instr_port_name)
-            if self.instr_connexion is not None:
-                answer = self.instr_connexion.write(msg + self.term_chars)
+                cmd = self.instr_connexion.address_command(
+                    self.instr_port_name
+                )
+                if cmd is not None:
+                    # a failed write leaves the selected address unknown
+                    self.instr_connexion.invalidate()
+                    await asyncio.wait_for(transport.write(cmd), timeout)
+                    self.instr_connexion.selected(self.instr_port_name)
+                data = self.instr_connexion.frame(msg)
             else:
-                raise(IOError("There is no physical connexion established \
-with the instrument %s" % self.instr_id_name))
+                data = msg + self.term_chars
+            answer = await asyncio.wait_for(transport.write(data), timeout)
         else:
             answer = msg
         return answer
 
-    def ask(self, msg, num_bytes=None):
-        """ writes a command to the instrument and reads its reply """
+    async def async_ask(self, msg, num_bytes=None, timeout=None):
+        """writes a command to the instrument and awaits its reply
+            The timeout applies to the whole command, write and read
+        """
 
         answer = None
 
         if not self.mock_mode:
             if self.instr_intf == INTF_VISA:
-                answer = self.instr_connexion.ask(msg)
+                answer = await asyncio.wait_for(
+                    asyncio.get_event_loop().run_in_executor(
+                        None, self.instr_connexion.ask, msg
+                    ),
+                    timeout
+                )
+            elif self.instr_intf == INTF_BROKER:
+                # the broker serializes the commands of all its clients
+                answer = self.parse_answer(
+                    await asyncio.wait_for(
+                        asyncio.get_event_loop().run_in_executor(
+                            None,
+                            self.instr_connexion.ask,
+                            msg + self.term_chars,
+                            num_bytes
+                        ),
+                        timeout
+                    )
+                )
             elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
-                self.write(msg)
-                answer = self.read(num_bytes)
+                transport = self.get_async_transport()
+                # the other coroutines and the threads (directly or through
+                # the scheduler of the port) must not interleave their
+                # commands
+                lock = self.get_port_lock()
+                await transport.acquire(lock)
+                try:
+                    # drops the leftovers of a previous timed out command
+                    transport.flush_input()
+                    try:
+                        answer = await asyncio.wait_for(
+                            self._async_write_read(msg, num_bytes),
+                            timeout
+                        )
+                    except asyncio.TimeoutError:
+                        transport.flush_input()
+                        raise
+                finally:
+                    transport.release(lock)
         else:
             answer = msg
         return answer
 
+    async def _async_write_read(self, msg, num_bytes):
+        """writes a command and reads its reply, without timeout"""
+        await self.async_write(msg)
+        return await self.async_read(num_bytes)
+
     def connect(self, instr_port_name=None, **kwargs):
         """implements the connexion to the instrument"""
 
         if instr_port_name is None:
             instr_port_name = self.instr_port_name
 
+        # the replies of the previous port must not be reused
+        self.single_flight.forget()
+
         if self.mock_mode:
             print(
                 "Connect %s, named %s on port %s, with %s"
@@ -194,12 +593,34 @@ with the instrument %s" % self.instr_id_name))
                     self.instr_connexion = serial.Serial(
                         instr_port_name, **kwargs)
 
+            elif self.instr_intf == INTF_BROKER:
+                # make sure the instrument is not already connected
+                self.disconnect()
+
+                # the termination characters are added before sending the
+                # commands to the broker
+                if "term_chars" in kwargs:
+                    self.term_chars = kwargs.pop("term_chars")
+
+                self.instr_connexion = BrokerConnexion(
+                    instr_port_name,
+                    **kwargs
+                )
+
             elif self.instr_intf == INTF_PROLOGIX:
+                # the PrologixController is shared by the instruments on the
+                # same adapter
+                if "controller" in kwargs:
+                    self.instr_connexion = kwargs.pop("controller")
+                if self.instr_connexion is None:
+                    raise(IOError("The instrument %s needs a \
+PrologixController to connect" % self.instr_id_name))
+
                 # only keeps the number of the port
                 self.instr_port_name = instr_port_name.replace('GPIB0::', '')
 
-                self.instr_connexion.write(
-                    ("++addr %s" % self.instr_port_name))
+                with self.get_port_lock():
+                    self.instr_connexion.select(self.instr_port_name)
                 # the \n termchar is embedded in the PrologixController class
                 self.term_chars = ""
 
@@ -214,7 +635,11 @@ with the instrument %s" % self.instr_id_name))
     def disconnect(self):
         """disconnect the instrument"""
 
-        if self.instr_connexion is not None:
+        if self.instr_intf == INTF_PROLOGIX:
+            # the controller is shared with the other instruments of the
+            # adapter, it is closed by its owner
+            self.instr_connexion = None
+        elif self.instr_connexion is not None:
             # should write exception handling as we experience it
             # or do that specifically for the children classes
             self.instr_connexion.close()
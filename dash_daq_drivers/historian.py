@@ -0,0 +1,770 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only history of the measured data on disk
+
+The ring buffers of the instruments only keep the latest samples and are
+lost when the process stops, the historian keeps every sample in files so
+weeks of measures survive a restart. Each channel has its own directory of
+chunks, a chunk is a file of fixed-width records stored column after column
+(the times as int64 ns since epoch, the values as float64 and the statuses
+as int8), preallocated for a fixed number of records and memory-mapped.
+The columns of a chunk are read as numpy views on the mapping, so serving
+the history does not copy it.
+
+The historian is a listener of the acquisition engine: the new samples are
+queued and written by batches, at most every flush_interval seconds, so the
+files are not touched at each measure. The samples queued when the process
+is killed are lost. A chunk counts its records in its header, which is only
+updated once the records are written, so other processes can read the
+files while they are appended to. Only one process must append to a
+history directory at a time (see shared_store.DataPlane), the others open it
+read-only, and only the writer deletes the expired chunks.
+
+The samples are also aggregated in tiers of coarser resolutions (see
+rollup), kept in sub-directories of the channel. Each tier, and the raw
+samples, has its own retention: once all the records of a chunk are older
+than it, the chunk is deleted. The queries for a resolution read the
+coarsest tier which is fine enough, and the raw samples not yet rolled up.
+
+The raw samples of a channel can be compressed before they are written (see
+compression), the aggregates are computed from all the samples. After a
+restart, the bin of each tier which was still open is rebuilt from the
+history of the previous tier, that is from the raw samples kept by the
+compressor for the first tier: the aggregates of that bin (at most 1 s with
+the default tiers) only account for the samples kept.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from .rollup import ROLLUP_COLUMNS, Rollup, raw_aggregates, tier_aggregates
+from .shared_store import file_name, map_file
+
+# identifies the layout of the chunk files
+MAGIC = 0x44415148495354
+# the chunk header is made of int64: magic, capacity and number of records
+HEADER_SIZE = 4 * 8
+# columns of the records of a channel
+RAW_COLUMNS = (
+    ('time', np.int64),
+    ('value', np.float64),
+    ('status', np.int8)
+)
+# default number of records per chunk
+CHUNK_SIZE = 65536
+# number of records between two entries of the time index of a chunk
+INDEX_STEP = 1024
+# extension of the chunk files, which are named after their first record
+CHUNK_EXTENSION = '.chunk'
+# maximum time the new samples are kept in memory before being written (s)
+FLUSH_INTERVAL = 5.
+# number of queued samples which triggers a write
+BATCH_SIZE = 1000
+# status of the samples whose instrument gave none
+STATUS_UNKNOWN = -1
+# time the raw samples are kept (s), None to keep them forever
+RAW_RETENTION = 7 * 86400
+# resolution and retention (s) of each tier of aggregates, from the finest
+ROLLUP_TIERS = (
+    (1., 90 * 86400),
+    (60., None)
+)
+# time between two deletions of the expired chunks (s)
+RETENTION_PERIOD = 60.
+
+
+def min_max_trace(records, resolution):
+    """returns the aggregates of a tier as a (times, values) trace holding
+        the min then the max of each bin
+    """
+    times = np.repeat(records['time'], 2)
+    times[1::2] += int(resolution * 1e9) // 2
+    values = np.empty(len(times))
+    values[0::2] = records['min']
+    values[1::2] = records['max']
+    return times, values
+
+
+class HistoryChunk(object):
+    """fixed capacity block of records in a memory-mapped file"""
+
+    def __init__(self, path, columns=RAW_COLUMNS, capacity=CHUNK_SIZE,
+                 writable=False):
+
+        self.path = path
+        self.columns = columns
+
+        if writable:
+            size = HEADER_SIZE + capacity * self.record_size(columns)
+            self._map = map_file(path, size, writable)
+        else:
+            with open(path, 'rb') as chunk_file:
+                header = np.frombuffer(
+                    chunk_file.read(HEADER_SIZE), dtype=np.int64
+                )
+            # a reader never writes the header, which may not be written yet
+            if len(header) < 2 or header[0] != MAGIC:
+                raise IOError("%s is not a history chunk" % path)
+            capacity = int(header[1])
+            size = HEADER_SIZE + capacity * self.record_size(columns)
+            self._map = map_file(path, size, False)
+
+        self._header = np.frombuffer(
+            self._map, dtype=np.int64, count=4, offset=0
+        )
+        if writable and self._header[0] != MAGIC:
+            self._header[1] = capacity
+            self._header[0] = MAGIC
+        self.capacity = int(self._header[1])
+
+        # a view on the whole capacity of each column, indexed per name
+        self._columns = {}
+        offset = HEADER_SIZE
+        for name, dtype in columns:
+            self._columns[name] = np.frombuffer(
+                self._map, dtype=dtype, count=self.capacity, offset=offset
+            )
+            offset += self.capacity * np.dtype(dtype).itemsize
+
+        # the time of every INDEX_STEP-th record, kept in memory
+        self._index = np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def record_size(columns):
+        """returns the number of bytes of a record"""
+        return sum(np.dtype(dtype).itemsize for name, dtype in columns)
+
+    @property
+    def count(self):
+        """number of records written in the chunk"""
+        return int(self._header[2])
+
+    def __len__(self):
+        return self.count
+
+    def free(self):
+        """returns the number of records which can still be written"""
+        return self.capacity - self.count
+
+    def column(self, name, start=0, stop=None):
+        """returns a view on the written records of a column"""
+        count = self.count
+        if stop is None or stop > count:
+            stop = count
+        return self._columns[name][start:stop]
+
+    def time_index(self, count=None):
+        """returns the coarse index of the chunk, the time of every
+            INDEX_STEP-th record among the first count ones
+            The written records never change, so the index is only extended
+        """
+        if count is None:
+            count = self.count
+        size = (count + INDEX_STEP - 1) // INDEX_STEP
+        if len(self._index) < size:
+            self._index = np.concatenate((
+                self._index,
+                self._columns['time'][
+                    len(self._index) * INDEX_STEP:count:INDEX_STEP
+                ]
+            ))
+        return self._index[:size]
+
+    def search(self, timestamp, count=None):
+        """returns the index of the first record taken at or after timestamp
+            The index tells which block of INDEX_STEP records holds it, so
+            the search only reads a few pages of the file
+        """
+        if count is None:
+            count = self.count
+        index = self.time_index(count)
+        block = np.searchsorted(index, timestamp, side='left')
+        if block == 0:
+            return 0
+        start = (block - 1) * INDEX_STEP
+        stop = min(block * INDEX_STEP, count)
+        return start + int(np.searchsorted(
+            self._columns['time'][start:stop], timestamp, side='left'
+        ))
+
+    def write(self, records):
+        """appends records, a dict of arrays indexed per column name, which
+            must fit in the chunk
+        """
+        count = self.count
+        npoints = len(records[self.columns[0][0]])
+        if npoints > self.capacity - count:
+            raise ValueError("The records do not fit in %s" % self.path)
+        for name, dtype in self.columns:
+            self._columns[name][count:count + npoints] = records[name]
+        # the records are only visible to the readers once fully written
+        self._header[2] = count + npoints
+
+    def flush(self):
+        """writes the modified pages of the chunk to the disk"""
+        self._map.flush()
+
+
+class HistoryChannel(object):
+    """append-only history of a channel, made of a directory of chunks"""
+
+    def __init__(self, directory, columns=RAW_COLUMNS, chunk_size=CHUNK_SIZE,
+                 writable=False):
+
+        self.directory = directory
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.writable = writable
+        self.chunks = []
+        # index of the first record of each chunk, which names its file
+        self.starts = []
+        # time of the first record of each chunk, the index of the chunks
+        self._first_times = []
+
+        if writable and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.refresh()
+
+    def refresh(self):
+        """opens the chunks added to the directory by another process, and
+            forgets the ones it deleted
+        """
+        while self.chunks and not os.path.exists(self.chunks[0].path):
+            self.drop_first()
+        if not os.path.isdir(self.directory):
+            return
+        starts = sorted(
+            int(name[:-len(CHUNK_EXTENSION)])
+            for name in os.listdir(self.directory)
+            if name.endswith(CHUNK_EXTENSION)
+        )
+        for start in starts:
+            if self.starts and start <= self.starts[-1]:
+                continue
+            try:
+                chunk = HistoryChunk(
+                    self.chunk_path(start),
+                    self.columns,
+                    self.chunk_size,
+                    self.writable
+                )
+            except IOError:
+                # the writer did not write the header of the chunk yet, it
+                # is opened at the next refresh
+                break
+            self.chunks.append(chunk)
+            self.starts.append(start)
+
+    def chunk_path(self, start):
+        return os.path.join(
+            self.directory,
+            '%016i%s' % (start, CHUNK_EXTENSION)
+        )
+
+    @property
+    def count(self):
+        """total number of records of the channel"""
+        if not self.chunks:
+            return 0
+        return self.starts[-1] + self.chunks[-1].count
+
+    def __len__(self):
+        return self.count
+
+    def first_times(self):
+        """returns the time of the first record of each chunk"""
+        while len(self._first_times) < len(self.chunks):
+            chunk = self.chunks[len(self._first_times)]
+            if not chunk.count:
+                break
+            self._first_times.append(int(chunk.column('time', 0, 1)[0]))
+        return self._first_times
+
+    def last_time(self):
+        """returns the time of the last record, None if there is none"""
+        for chunk in reversed(self.chunks):
+            times = chunk.column('time')
+            if len(times):
+                return int(times[-1])
+        return None
+
+    def extend(self, records):
+        """appends records, a dict of arrays indexed per column name
+            The records not later than the last one are dropped, so the
+            times are always sorted
+        """
+        if not self.writable:
+            raise IOError("The history of %s is read-only" % self.directory)
+
+        # another process may have written since this one last did
+        self.refresh()
+        times = np.asarray(records['time'], dtype=np.int64)
+        last_time = self.last_time()
+        if last_time is not None:
+            keep = np.searchsorted(times, last_time, side='right')
+            if keep:
+                times = times[keep:]
+                records = dict(
+                    (name, np.asarray(column)[keep:])
+                    for name, column in records.items()
+                )
+                records['time'] = times
+
+        written = 0
+        while written < len(times):
+            if not self.chunks or not self.chunks[-1].free():
+                self.add_chunk()
+            chunk = self.chunks[-1]
+            npoints = min(chunk.free(), len(times) - written)
+            chunk.write(
+                dict(
+                    (name, np.asarray(column)[written:written + npoints])
+                    for name, column in records.items()
+                )
+            )
+            written += npoints
+        return written
+
+    def add_chunk(self):
+        """creates the file of the next chunk"""
+        start = self.count
+        self.chunks.append(
+            HistoryChunk(
+                self.chunk_path(start),
+                self.columns,
+                self.chunk_size,
+                writable=True
+            )
+        )
+        self.starts.append(start)
+
+    def query(self, t_start=None, t_stop=None, names=None):
+        """returns views on the columns of the records taken within
+            [t_start, t_stop) (ns since epoch), as a list of dicts indexed
+            per column name, one per chunk
+            The chunks are found from their first time, then the records from
+            the coarse index of each chunk
+        """
+        self.refresh()
+        if names is None:
+            names = [name for name, dtype in self.columns]
+
+        first = 0
+        if t_start is not None:
+            first = max(
+                np.searchsorted(self.first_times(), t_start, side='right') - 1,
+                0
+            )
+
+        answer = []
+        for chunk in self.chunks[first:]:
+            count = chunk.count
+            if not count:
+                break
+            start = 0
+            stop = count
+            if t_start is not None:
+                start = chunk.search(t_start, count)
+            if t_stop is not None:
+                stop = chunk.search(t_stop, count)
+            if stop > start:
+                answer.append(
+                    dict((name, chunk.column(name, start, stop))
+                         for name in names)
+                )
+            if stop < count:
+                # the next chunks are later than t_stop
+                break
+        return answer
+
+    def latest(self, npoints):
+        """returns copies of the columns of the last npoints records"""
+        blocks = []
+        for segment in reversed(self.query()):
+            if npoints <= 0:
+                break
+            blocks.insert(0, dict(
+                (name, column[-npoints:]) for name, column in segment.items()
+            ))
+            npoints -= len(blocks[0]['time'])
+        return dict(
+            (name, np.concatenate([block[name] for block in blocks])
+             if blocks else np.zeros(0, dtype))
+            for name, dtype in self.columns
+        )
+
+    def drop_first(self):
+        """forgets the first chunk"""
+        self.chunks.pop(0)
+        self.starts.pop(0)
+        if self._first_times:
+            self._first_times.pop(0)
+
+    def expire(self, t_limit):
+        """deletes the chunks whose records are all older than t_limit (ns
+            since epoch), the last chunk is always kept
+        """
+        if not self.writable:
+            raise IOError("The history of %s is read-only" % self.directory)
+        self.refresh()
+        while len(self.chunks) > 1:
+            times = self.chunks[0].column('time')
+            if len(times) and times[-1] >= t_limit:
+                break
+            path = self.chunks[0].path
+            try:
+                os.remove(path)
+            except OSError:
+                # a mapped file cannot be deleted on Windows
+                break
+            self.drop_first()
+
+    def flush(self):
+        for chunk in self.chunks:
+            chunk.flush()
+
+
+class Historian(object):
+    """keeps the history of the channels of a rack on disk
+        The listener record_measures is registered on the acquisition
+        engine, which calls it after each measure
+        Only the process running the acquisition opens it writable, the
+        others read it, until promote is called if they take over
+    """
+
+    def __init__(self, directory, chunk_size=CHUNK_SIZE,
+                 flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE,
+                 raw_retention=RAW_RETENTION, tiers=ROLLUP_TIERS,
+                 writable=True):
+
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.raw_retention = raw_retention
+        # (resolution, retention) of each tier, from the finest
+        self.tiers = sorted(tiers)
+        self.writable = writable
+
+        # history of each channel, indexed per (instrument key, channel,
+        # resolution), the resolution of the raw samples is None
+        self.channels = {}
+        # tiers of aggregates of each channel being written
+        self.rollups = {}
+        # compressors of the raw samples, indexed per (instr key, channel)
+        self.compressors = {}
+        self._last_expiry = time.time()
+        # instruments attached to the historian
+        self.instruments = []
+        # number of samples of each ring buffer already queued
+        self._cursors = {}
+        # queued samples (times, values, statuses) per (instr key, channel)
+        self._pending = {}
+        self._pending_count = 0
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+
+    def channel_path(self, instr_key, chan):
+        return os.path.join(
+            self.directory,
+            file_name(instr_key),
+            file_name(chan)
+        )
+
+    def channel(self, instr_key, chan, resolution=None):
+        """returns the history of a channel, its raw samples or one of its
+            tiers of aggregates
+        """
+        key = (instr_key, chan, resolution)
+        with self._lock:
+            history = self.channels.get(key)
+            if history is None:
+                path = self.channel_path(instr_key, chan)
+                columns = RAW_COLUMNS
+                if resolution is not None:
+                    path = os.path.join(path, 'rollup-%gs' % resolution)
+                    columns = ROLLUP_COLUMNS
+                history = HistoryChannel(
+                    path,
+                    columns,
+                    chunk_size=self.chunk_size,
+                    writable=self.writable
+                )
+                self.channels[key] = history
+        return history
+
+    def channel_rollups(self, instr_key, chan):
+        """returns the tiers of aggregates of a channel, from the finest
+            Their open bins are rebuilt from the history of the previous
+            tier, so they do not lose the samples received before a restart
+        """
+        key = (instr_key, chan)
+        with self._lock:
+            rollups = self.rollups.get(key)
+            if rollups is None:
+                rollups = []
+                source = self.channel(instr_key, chan)
+                for resolution, retention in self.tiers:
+                    rollup = Rollup(
+                        self.channel(instr_key, chan, resolution),
+                        resolution
+                    )
+                    for segment in source.query(rollup.end_time()):
+                        if rollups:
+                            rollup.add(*tier_aggregates(segment))
+                        else:
+                            rollup.add(*raw_aggregates(
+                                segment['time'], segment['value']
+                            ))
+                    rollups.append(rollup)
+                    source = rollup.history
+                self.rollups[key] = rollups
+        return rollups
+
+    def set_compressor(self, instr, chan, compressor):
+        """compresses the samples of a channel before writing them, with a
+            compression.Compressor, or not if compressor is None
+        """
+        with self._lock:
+            key = (instr.instr_key, chan)
+            previous = self.compressors.pop(key, None)
+            if previous is not None:
+                # the last sample of the previous compressor is written
+                self._write_held(key, previous)
+            if compressor is not None:
+                self.compressors[key] = compressor
+
+    def _write_held(self, key, compressor):
+        records = compressor.flush()
+        if records is not None:
+            self.channel(*key).extend(records)
+
+    def record_measures(self, instr, channels):
+        """queues the samples measured on channels of an instrument since
+            the last call, and writes the queue if it is due
+        """
+        with self._lock:
+            for chan in channels:
+                key = (instr.instr_key, chan)
+                buffer = instr.measured_data[chan]
+                # the first time, only the sample just measured is new
+                cursor = self._cursors.get(key, max(buffer.count - 1, 0))
+                times, values, cursor = buffer.since(cursor)
+                self._cursors[key] = cursor
+                if not len(times):
+                    continue
+
+                statuses = np.full(
+                    len(times), instr.channel_status(chan), dtype=np.int8
+                )
+                # the ring buffer views are copied, as they are overwritten
+                self._pending.setdefault(key, []).append(
+                    (times.copy(), values.copy(), statuses)
+                )
+                self._pending_count += len(times)
+
+            if self._pending_count >= self.batch_size \
+                    or time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def follow(self, instr, channels):
+        """records the samples of channels of an instrument from the next
+            one stored, i.e. before storing many of them at once
+        """
+        with self._lock:
+            for chan in channels:
+                self._cursors[(instr.instr_key, chan)] = \
+                    instr.measured_data[chan].count
+
+    def flush(self):
+        """writes the queued samples to the chunks"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_count = 0
+            self._last_flush = time.time()
+
+            for (instr_key, chan), blocks in pending.items():
+                # the tiers catch up with the history before it grows
+                rollups = self.channel_rollups(instr_key, chan)
+                times, values, statuses = [
+                    np.concatenate(column) for column in zip(*blocks)
+                ]
+                history = self.channel(instr_key, chan)
+                last_time = history.last_time()
+                if last_time is not None:
+                    # the samples already written are dropped
+                    start = np.searchsorted(times, last_time, side='right')
+                    times = times[start:]
+                    values = values[start:]
+                    statuses = statuses[start:]
+
+                records = {
+                    'time': times,
+                    'value': values,
+                    'status': statuses
+                }
+                compressor = self.compressors.get((instr_key, chan))
+                if compressor is not None:
+                    records = compressor.compress(times, values, statuses)
+                history.extend(records)
+
+                aggregates = raw_aggregates(times, values)
+                for rollup in rollups:
+                    aggregates = rollup.add(*aggregates)
+
+            if time.time() - self._last_expiry >= RETENTION_PERIOD:
+                self.expire()
+
+    def promote(self):
+        """reopens the history writable once the process runs the
+            acquisition, i.e. when the writer of the data plane stopped
+            The samples of the ring buffers not written by the previous
+            writer are written at the next flush
+        """
+        with self._lock:
+            self.writable = True
+            self.channels = {}
+            self.rollups = {}
+            for instr in self.instruments:
+                for chan in instr.measured_data:
+                    # the samples already in the history are dropped
+                    self._cursors[(instr.instr_key, chan)] = 0
+
+    def expire(self, now=None):
+        """deletes the chunks older than the retention of their tier"""
+        if not self.writable:
+            # the chunks are only deleted by the process writing them
+            return
+        if now is None:
+            now = time.time()
+        retentions = dict(self.tiers)
+        retentions[None] = self.raw_retention
+        with self._lock:
+            self._last_expiry = now
+            for (instr_key, chan, resolution), history in list(
+                    self.channels.items()):
+                retention = retentions.get(resolution)
+                if retention is not None:
+                    history.expire(int((now - retention) * 1e9))
+
+    def first_time(self, instr_key, chan):
+        """returns the time of the oldest record of a channel in any tier,
+            None if there is none
+        """
+        first_times = []
+        for resolution in [None] + [res for res, ret in self.tiers]:
+            history = self.channel(instr_key, chan, resolution)
+            history.refresh()
+            if history.first_times():
+                first_times.append(history.first_times()[0])
+        return min(first_times) if first_times else None
+
+    def query_rollups(self, instr_key, chan, t_start=None, t_stop=None,
+                      resolution=None):
+        """returns the aggregates of a channel within [t_start, t_stop) from
+            the coarsest tier whose resolution is at most resolution (s), as
+            a list of (times, values) segments, and the time from which the
+            raw samples must be read, where the aggregates stop
+            Each bin is given as its min then its max value, the older bins
+            which the tier no longer keeps are read from coarser tiers. For
+            a resolution finer than all the tiers, only the bins older than
+            the raw samples kept are returned
+        """
+        levels = [
+            res for res, ret in self.tiers
+            if resolution is not None and res <= resolution
+        ]
+        raw_start = t_start
+        stop = t_stop
+        if levels:
+            # the finest tier used, and the coarser ones for the older bins
+            tiers = [res for res, ret in self.tiers if res >= levels[-1]]
+            history = self.channel(instr_key, chan, tiers[0])
+            history.refresh()
+            last_time = history.last_time()
+            if last_time is None:
+                return [], t_start
+            # the raw samples complete the trace after the tier
+            end_time = last_time + int(tiers[0] * 1e9)
+            if t_stop is None or end_time < t_stop:
+                stop = end_time
+            if t_start is None or end_time > t_start:
+                raw_start = end_time
+        else:
+            # the raw samples are read, the tiers only give the bins older
+            # than the raw samples kept
+            tiers = [res for res, ret in self.tiers]
+            raw = self.channel(instr_key, chan)
+            raw.refresh()
+            if raw.first_times():
+                first_time = raw.first_times()[0]
+                if t_stop is None or first_time < t_stop:
+                    stop = first_time
+
+        segments = []
+        for res in tiers:
+            history = self.channel(instr_key, chan, res)
+            history.refresh()
+            # only the bins which end before stop
+            tier_segments = history.query(
+                t_start,
+                None if stop is None else stop - int(res * 1e9) + 1
+            )
+            segments = [
+                min_max_trace(segment, res) for segment in tier_segments
+            ] + segments
+            if not history.first_times():
+                continue
+            stop = history.first_times()[0]
+            if t_start is not None and stop <= t_start:
+                break
+        return segments, raw_start
+
+    def attach(self, instr, restore=True):
+        """gives an instrument access to its history, see
+            Instrument.query, and restores its latest samples
+        """
+        instr.historian = self
+        self.instruments.append(instr)
+        if restore:
+            self.restore(instr)
+
+    def restore(self, instr, npoints=None):
+        """fills the ring buffers of an instrument with the latest samples of
+            its history, i.e. after a restart
+        """
+        with self._lock:
+            for chan in instr.measured_data:
+                buffer = instr.measured_data[chan]
+                count = npoints
+                if count is None or count > buffer.capacity:
+                    count = buffer.capacity
+                records = self.channel(instr.instr_key, chan).latest(count)
+                # the buffer may already hold the latest samples
+                last_time = buffer.last()[0]
+                start = 0
+                if last_time is not None:
+                    start = np.searchsorted(
+                        records['time'], last_time, side='right'
+                    )
+                if start < len(records['time']):
+                    buffer.extend(
+                        records['value'][start:],
+                        records['time'][start:]
+                    )
+                # the restored samples are already in the history
+                self._cursors[(instr.instr_key, chan)] = buffer.count
+
+    def close(self):
+        """writes the queued samples and the chunks to the disk"""
+        with self._lock:
+            if self.writable:
+                self.flush()
+                for key, compressor in self.compressors.items():
+                    self._write_held(key, compressor)
+                for history in self.channels.values():
+                    history.flush()
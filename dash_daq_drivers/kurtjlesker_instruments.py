@@ -9,50 +9,34 @@ Driver(s) for Kurt J. Lesker Instruments
 
 # In[]:
 # Import required libraries
+import asyncio
+import time
+
 import numpy as np
-import datetime
 
 import dash_html_components as html
 import dash_core_components as dcc
 from dash_daq import Gauge, StopButton, PowerButton, Indicator, \
     DarkThemeProvider
-from dash.dependencies import Output
 
+from .callbacks import make_gauges_callback
 from .generic_instruments import Instrument, INTF_SERIAL
-
-RESPONSE_BIT_NUM = 13
+from .mgc4000_frames import FRAME_SIZE, GaugeStatus, FrameReader, \
+    decode_frame, status_code
+from .channel_store import now_ns
+from .scheduler import PRIORITY_READ, PRIORITY_STATUS, PRIORITY_BULK, \
+    StaleRequestError
+from .vacuum_model import VacuumSystem, gauge_decades
+
+RESPONSE_BIT_NUM = FRAME_SIZE
+# maximum duration of a command sent from an event loop (s)
+ASK_TIMEOUT = 1.
+# time during which a gauge status is trusted without querying it again (s)
+STATUS_TTL = 5.
 GAUGE_TYPES = ['CG', 'IG', 'AI']
 INTERFACE = INTF_SERIAL
-GAUGE_READY = 'status ok'
-STATUS = {
-    '00 ST OK': GAUGE_READY,
-    '01 OVPRS': 'IG over pressure; AI pressure over 1100 Torr',
-    '02 EMISS': 'Ie failure',
-    '04 FLVLO': 'filament V low',
-    '08 FLOPN': 'IG filament open; CG sensor wire is open circuit or \
-CG cable unplugged',
-    '10 DEGAS': 'upper pressure limit exceeded during DEGAS operation',
-    '20 ICLOW': 'Ic too low',
-    '40 FLVHI': 'filament V high',
-    '?01 INVALID': 'The device does not exist',
-    '?01 SYNTX ER': 'Unknown command'
-}
-
-
-def make_gauge_callback(name, instr, app, inputs):
-    """generate a callback for the gauges which number can vary from instrument
-        to instrument
-    """
-    @app.callback(
-        Output('%s_gauge_%s' % (instr.unique_id(), name), 'value'),
-        inputs)
-    def update_gauge(interval_value):
-
-        return instr.last_measure[name]
-
-    update_gauge.__name__ = '%s_gauge_%s' % (instr.unique_id(), name)
-
-    return update_gauge
+# the statuses are GaugeStatus bits, see mgc4000_frames.describe_status
+GAUGE_READY = GaugeStatus.OK
 
 
 class MGC4000(Instrument):
@@ -63,9 +47,19 @@ class MGC4000(Instrument):
         mock=False,
         instr_user_name='MGC 4000',
         theme='light',
+        status_ttl=STATUS_TTL,
+        mock_seed=None,
         **kwargs
     ):
 
+        # last status of each gauge and the time it was queried, indexed per
+        # gauge name, the status is queried again once older than status_ttl
+        self.status_ttl = status_ttl
+        self.status_cache = {}
+
+        # the reply frames are received in the same buffer
+        self.frame_reader = FrameReader(RESPONSE_BIT_NUM)
+
         # manage the presence of the keyword interface which will determine
         # which method of communication protocol this instrument will use
         if 'interface' in kwargs.keys():
@@ -93,28 +87,33 @@ class MGC4000(Instrument):
                                       instr_mesurands=instr_mesurands,
                                       **kwargs)
 
-        # to record the time of each individual parameter measures
-        for param_name in instr_mesurands:
-            self.measured_data['%s_time' % param_name] = []
+        # the chamber measured in mock mode, and the calibration of its
+        # gauges
+        self.mock_system = VacuumSystem(seed=mock_seed)
+        self.mock_calibrations = self.mock_system.calibrations(
+            self.measure_params
+        )
 
         # populate the dropdown with the instrument parameters
         dropdown_options = [{'label': lbl, 'value': lbl}
                             for lbl in self.measure_params]
         self.channels_dropdown = dcc.Dropdown(
-            id="%s_channel" % (self.unique_id()),
+            id=self.component_id('channel'),
             options=dropdown_options,
             value=self.measure_params,
             multi=True
         )
 
-        # list of gauges for each parameters
+        # list of gauges for each parameters, the pressures span decades so
+        # the scale is logarithmic, min and max being exponents
         self.gauge_list = [
             Gauge(
-                id='%s_gauge_%s' % (self.unique_id(), lbl),
+                id=self.component_id('gauge', chan=lbl),
                 label='%s last value (%s)' % (lbl, self.params_units[lbl]),
-                min=0.,
-                max=10.,
-                value=0.1,
+                logarithmic=True,
+                min=gauge_decades(lbl)[0],
+                max=gauge_decades(lbl)[1],
+                value=10. ** gauge_decades(lbl)[0],
                 size=150,
                 units='mbar',
                 showCurrentValue=True
@@ -124,7 +123,7 @@ class MGC4000(Instrument):
 
         # an input to choose the COM port to connect to the instrument
         self.connexion_input = dcc.Input(
-            id='%s_instr_port' % (self.unique_id()),
+            id=self.component_id('instr_port'),
             placeholder='Enter port name...',
             type='text',
             value=''
@@ -132,19 +131,19 @@ class MGC4000(Instrument):
 
         # a button which will initiate the connexion to the instrument
         self.connexion_button = StopButton(
-            id='%s_instr_port_btn' % (self.unique_id()),
+            id=self.component_id('instr_port_btn'),
             children='Connect',
             buttonText='Connect',
             disabled=True
         )
 
         self.power_btn = PowerButton(
-            id='%s_power_button' % (self.unique_id()),
+            id=self.component_id('power_button'),
             on='false'
         )
 
         self.mock_indicator = Indicator(
-            id='%s_mock_indicator' % (self.unique_id()),
+            id=self.component_id('mock_indicator'),
             value=self.mock_mode
         )
 
@@ -152,9 +151,11 @@ class MGC4000(Instrument):
         self.control_components = self.setup_layout(theme)
 
     def generate_callbacks(self, app, inputs=[]):
-        """assigns the callback for this instrument's instance"""
-        for name in self.measure_params:
-            make_gauge_callback(name, self, app, inputs)
+        """assigns the callback updating the gauges of this instrument
+            For a rack of several instruments, a single callback
+            callbacks.make_gauges_callback updates all of their gauges
+        """
+        return make_gauges_callback([self], app, inputs)
 
     def setup_layout(self, theme='light'):
         """returns a layout of the controls in html"""
@@ -176,11 +177,11 @@ class MGC4000(Instrument):
             ),
             # Instrument name and power button
             html.Div(
-                id='instr_hdr',
+                id=self.component_id('instr_hdr'),
                 children=[
                     html.H3('%s' % self.instr_user_name),
                     html.Div(
-                        id='power_btn',
+                        id=self.component_id('power_btn'),
                         children=[
                             self.power_btn
                         ],
@@ -195,9 +196,15 @@ class MGC4000(Instrument):
                     'vertical-align': 'middle'
                 }
             ),
+            # This div is used as the output of the connexion callback
+            html.Div(
+                id=self.component_id('port_event'),
+                children='',
+                style={'display': 'none'}
+            ),
             # Instrument port and parameters input
             html.Div(
-                id='%s_controls_div' % self.unique_id(),
+                id=self.component_id('controls_div'),
                 children=[
                     html.Label(
                         [
@@ -242,11 +249,11 @@ class MGC4000(Instrument):
                 }
             ),
             html.Div(
-                id='%s_gauges_div' % self.unique_id(),
+                id=self.component_id('gauges_div'),
                 children=[
                     html.Div(
                         self.gauge_list,
-                        id='%s_gauges_list' % self.unique_id(),
+                        id=self.component_id('gauges_list'),
                         style={
                             'display': 'flex',
                             'flexDirection': 'row',
@@ -299,24 +306,24 @@ class MGC4000(Instrument):
             # method to check the type and id of the gauge
             gtype, n = self.check_is_gauge(instr_param)
             if self.mock_mode:
-                answer = 10 * np.random.random()
+                answer = self.mock_read([instr_param])[0]
             else:
                 if n is not None:
-                    if self.is_gauge_ready(gtype, n):
-                        answer = float(self.ask('#  RD%s%i' % (gtype, n)))
-                    else:
-                        print("gauge is not ready")
+                    try:
+                        if self.is_gauge_ready(gtype, n):
+                            answer = self.reading_value(
+                                self.ask('#  RD%s%i' % (gtype, n)), gtype, n
+                            )
+                        else:
+                            print("gauge is not ready")
+                            answer = np.nan
+                    except StaleRequestError as err:
+                        # the port was too busy, the gauge is read next time
+                        print("Measure of %s failed : %s" % (instr_param, err))
                         answer = np.nan
                 else:
                     answer = np.nan
-            self.last_measure[instr_param] = answer
-            self.measured_data[instr_param].append(
-                self.last_measure[instr_param]
-            )
-            # store the time at which the data was taken
-            self.measured_data['%s_time' % instr_param].append(
-                datetime.datetime.now()
-            )
+            self.store_measure(instr_param, answer)
         else:
             print(
                 "you are trying to measure a non existent instr_param : "
@@ -327,20 +334,195 @@ class MGC4000(Instrument):
 
         return answer
 
+    def measure_all(self, instr_params=None):
+        """measures several channels in a single transaction
+            The stale statuses are queried together, then the values of all
+            the ready gauges are read in one batch of commands
+        """
+        if instr_params is None:
+            instr_params = self.measure_params
+
+        answers = {}
+        gauges = {}
+        for instr_param in instr_params:
+            if instr_param in self.measure_params:
+                answers[instr_param] = np.nan
+                gtype, n = self.check_is_gauge(instr_param)
+                if n is not None:
+                    gauges[instr_param] = (gtype, n)
+            else:
+                print(
+                    "you are trying to measure a non existent instr_param : "
+                    + instr_param
+                )
+
+        # all channels measured together share the same time
+        measure_time = now_ns()
+
+        if self.mock_mode:
+            # all the channels are simulated at once
+            readings = self.mock_read(list(answers), measure_time)
+            for instr_param, reading in zip(answers, readings):
+                answers[instr_param] = reading
+        elif gauges:
+            # refresh the statuses which are too old in one go
+            stale = [
+                instr_param for instr_param in gauges
+                if self.is_status_stale(*gauges[instr_param])
+            ]
+            if stale:
+                replies = self.ask_many(
+                    ['#  RS%s%i' % gauges[instr_param]
+                     for instr_param in stale]
+                )
+                for instr_param, reply in zip(stale, replies):
+                    self.cache_status(reply, *gauges[instr_param])
+
+            # the gauges whose status was not replied are not read, their
+            # status is queried in the next batch
+            ready = [
+                instr_param for instr_param in gauges
+                if self.is_cached_ready(*gauges[instr_param])
+            ]
+            if ready:
+                replies = self.ask_many(
+                    ['#  RD%s%i' % gauges[instr_param]
+                     for instr_param in ready]
+                )
+                for instr_param, reply in zip(ready, replies):
+                    answers[instr_param] = self.reading_value(
+                        reply, *gauges[instr_param]
+                    )
+
+        for instr_param, answer in answers.items():
+            self.store_measure(instr_param, answer, measure_time)
+
+        return answers
+
+    def mock_read(self, instr_params, measure_time=None):
+        """returns the simulated readings of channels at a time (ns)"""
+        if measure_time is None:
+            measure_time = now_ns()
+        return self.mock_system.read(
+            instr_params,
+            [measure_time],
+            self.mock_calibrations
+        )[:, 0]
+
+    def mock_history(self, duration, period=1., instr_params=None):
+        """fills the channels with the simulated readings of the last
+            duration seconds, one every period seconds
+            The chamber starts its pump-down at the beginning of the history
+            if it started later. The samples are generated and stored by
+            blocks, so large volumes of data are cheap to produce, and are
+            written to the history of the instrument if it has one
+        """
+        if instr_params is None:
+            instr_params = self.measure_params
+
+        stop = now_ns()
+        times = np.arange(
+            stop - int(duration * 1e9),
+            stop,
+            int(period * 1e9),
+            dtype=np.int64
+        )
+        if len(times) and times[0] < self.mock_system.start_time:
+            # the readings before the start of the chamber would all be
+            # the atmospheric pressure
+            self.mock_system.start_time = int(times[0])
+
+        if self.historian is not None:
+            self.historian.follow(self, instr_params)
+        # a block never overwrites samples the historian did not record
+        block = self.measured_data.capacity
+        readings = []
+        for start in range(0, len(times), block):
+            block_times = times[start:start + block]
+            block_readings = self.mock_system.read(
+                instr_params,
+                block_times,
+                self.mock_calibrations
+            )
+            for instr_param, values in zip(instr_params, block_readings):
+                self.store_measures(instr_param, values, block_times)
+            if self.historian is not None:
+                self.historian.record_measures(self, instr_params)
+            readings.append(block_readings)
+
+        if readings:
+            readings = np.concatenate(readings, axis=1)
+        else:
+            readings = np.empty((len(instr_params), 0))
+        return times, readings
+
+    def store_measure(self, instr_param, answer, measure_time=None):
+        """records a measured value and the time at which it was taken
+            The time is in nanoseconds since epoch, now if not provided
+        """
+
+        self.last_measure[instr_param] = answer
+        self.measured_data.append(instr_param, answer, measure_time)
+
+    def store_measures(self, instr_param, values, measure_times):
+        """records several measured values and their times at once"""
+
+        if len(values):
+            self.last_measure[instr_param] = values[-1]
+            self.measured_data[instr_param].extend(values, measure_times)
+
+    def reading_value(self, answer, gtype, n):
+        """converts the decoded reply to a RD command into a pressure value"""
+        if not isinstance(answer, float):
+            # an error, a status or no reply at all
+            answer = np.nan
+        if np.isnan(answer):
+            # the gauge status will be queried at next measure
+            self.invalidate_status(gtype, n)
+        return answer
+
     def read(self, num_bytes=RESPONSE_BIT_NUM):
 
+        if not self.mock_mode and num_bytes == RESPONSE_BIT_NUM \
+                and hasattr(self.instr_connexion, 'readinto'):
+            # the frame is decoded from the reusable buffer, before another
+            # thread can read in it
+            with self.get_port_lock():
+                received = self.frame_reader.read(self.instr_connexion)
+                if not received:
+                    print('No answer recieved from %s' % (self))
+                    return None
+                answer = self.frame_reader.decode(received)
+                if answer is None:
+                    # the rest of a truncated or shifted frame would shift
+                    # all the following replies
+                    self.flush_input()
+                    print('Invalid answer from %s' % (self))
+                return answer
+
         answer = super(MGC4000, self).read(num_bytes)
 
+        return self.parse_answer(answer)
+
+    def flush_input(self):
+        """drops the bytes received but not read yet"""
+        reset = getattr(self.instr_connexion, 'reset_input_buffer', None)
+        if reset is not None:
+            reset()
+
+    def parse_answer(self, answer):
+        """decodes a reply frame from the controller into a value (float),
+            a GaugeStatus, a ReplyError or None if the frame is invalid
+        """
+
+        if isinstance(answer, str):
+            answer = answer.encode('ascii', 'replace')
+
         if answer:
-            if answer[0] == '*':
-                # the first 3 characters after the * are only space for RS232
-                # the last one is a \r
-                return answer[4:-1]
-            elif answer[0] == '?':
-                return answer
-            else:
+            decoded = decode_frame(answer)
+            if decoded is None:
                 print('Invalid answer from %s' % (self))
-                return None
+            return decoded
         else:
             print('No answer recieved from %s' % (self))
             return None
@@ -348,22 +530,184 @@ class MGC4000(Instrument):
     def ask(self, msg):
         return super(MGC4000, self).ask(msg, num_bytes=RESPONSE_BIT_NUM)
 
+    def command_priority(self, msg):
+        """the value reads are sent before the status queries, which are
+            sent before any other command
+        """
+        command = msg.strip('# ')[:2]
+        if command == 'RD':
+            return PRIORITY_READ
+        elif command == 'RS':
+            return PRIORITY_STATUS
+        return PRIORITY_BULK
+
+    def ask_many(self, msgs):
+        """sends several commands at once and returns their parsed replies"""
+        answers = super(MGC4000, self).ask_many(
+            msgs,
+            num_bytes=RESPONSE_BIT_NUM
+        )
+        if self.mock_mode:
+            return answers
+        return [self.parse_answer(answer) for answer in answers]
+
+    def _ask_many(self, msgs, num_bytes=None):
+        """sends commands and reads their replies under the lock of the port
+            After a short reply, the rest of it would be read as the next
+            replies, so the bytes received meanwhile are dropped
+        """
+        with self.get_port_lock():
+            answers = super(MGC4000, self)._ask_many(msgs, num_bytes)
+            if not self.mock_mode and any(
+                answer is None or len(answer) != RESPONSE_BIT_NUM
+                for answer in answers
+            ):
+                self.flush_input()
+        return answers
+
+    async def async_measure(self, instr_param, timeout=ASK_TIMEOUT):
+        """measures a channel without blocking the event loop"""
+        if instr_param not in self.measure_params:
+            print(
+                "you are trying to measure a non existent instr_param : "
+                + instr_param
+            )
+            return np.nan
+
+        gtype, n = self.check_is_gauge(instr_param)
+        if self.mock_mode:
+            answer = self.mock_read([instr_param])[0]
+        elif n is None:
+            answer = np.nan
+        else:
+            try:
+                if await self.async_is_gauge_ready(gtype, n, timeout):
+                    answer = self.reading_value(
+                        await self.async_ask(
+                            '#  RD%s%i' % (gtype, n),
+                            timeout
+                        ),
+                        gtype,
+                        n
+                    )
+                else:
+                    print("gauge is not ready")
+                    answer = np.nan
+            except asyncio.TimeoutError:
+                print('No answer recieved from %s' % (self))
+                self.invalidate_status(gtype, n)
+                answer = np.nan
+
+        self.store_measure(instr_param, answer)
+        return answer
+
+    async def async_read(self, num_bytes=RESPONSE_BIT_NUM, timeout=None):
+        answer = await super(MGC4000, self).async_read(num_bytes, timeout)
+        return self.parse_answer(answer)
+
+    async def async_ask(self, msg, timeout=ASK_TIMEOUT):
+        return await super(MGC4000, self).async_ask(
+            msg,
+            num_bytes=RESPONSE_BIT_NUM,
+            timeout=timeout
+        )
+
     def status(self, gtype='CG', n=None):
-        """query the status of a given pressure gauge"""
+        """query the status of a given pressure gauge
+            Returns a GaugeStatus, a ReplyError or None without reply
+        """
 
         if n is None:
             gtype, n = self.check_is_gauge(gtype)
 
         answer = self.ask('#  RS%s%i' % (gtype, n))
 
-        if answer in STATUS:
-            return STATUS[answer]
+        return self.cache_status(answer, gtype, n)
+
+    async def async_status(self, gtype='CG', n=None, timeout=ASK_TIMEOUT):
+        """query the status of a given pressure gauge from an event loop"""
+
+        if n is None:
+            gtype, n = self.check_is_gauge(gtype)
+
+        answer = await self.async_ask('#  RS%s%i' % (gtype, n), timeout)
+
+        return self.cache_status(answer, gtype, n)
+
+    async def async_is_gauge_ready(self, gtype='CG', n=None,
+                                   timeout=ASK_TIMEOUT):
+        """tell us if the gauge is ready, queries its status if stale"""
+
+        if n is None:
+            gtype, n = self.check_is_gauge(gtype)
+
+        if self.is_status_stale(gtype, n):
+            answer = await self.async_status(gtype, n, timeout)
+        else:
+            answer = self.status_cache['%s%i' % (gtype, n)][0]
+        return (answer == GAUGE_READY)
+
+    def cache_status(self, answer, gtype, n):
+        """keeps the decoded reply to a RS command in the cache
+            Only the statuses are kept, a lost reply, an error or a garbled
+            reply is queried again at next use
+        """
+
+        if isinstance(answer, GaugeStatus):
+            self.status_cache['%s%i' % (gtype, n)] = (answer, time.time())
         else:
-            return answer
+            self.invalidate_status(gtype, n)
+        return answer
+
+    def channel_status(self, instr_param):
+        """returns the cached status of a gauge as an int8 code, without
+            querying it
+        """
+        cached = self.status_cache.get(instr_param)
+        if cached is None:
+            return super(MGC4000, self).channel_status(instr_param)
+        return status_code(cached[0])
+
+    def is_status_stale(self, gtype, n):
+        """tells if the status of the gauge must be queried again"""
+
+        cached = self.status_cache.get('%s%i' % (gtype, n))
+        if cached is None:
+            return True
+        return time.time() - cached[1] >= self.status_ttl
+
+    def cached_status(self, gtype='CG', n=None):
+        """returns the last status of the gauge, queries it if it is stale"""
+
+        if n is None:
+            gtype, n = self.check_is_gauge(gtype)
+
+        if self.is_status_stale(gtype, n):
+            return self.status(gtype, n)
+
+        return self.status_cache['%s%i' % (gtype, n)][0]
+
+    def invalidate_status(self, gtype='CG', n=None):
+        """forces the status of the gauge to be queried at next use"""
+
+        if n is None:
+            gtype, n = self.check_is_gauge(gtype)
+
+        self.status_cache.pop('%s%i' % (gtype, n), None)
+
+    def is_cached_ready(self, gtype, n):
+        """tells if the cached status of the gauge is ready, without
+            querying it
+        """
+        cached = self.status_cache.get('%s%i' % (gtype, n))
+        return cached is not None and cached[0] == GAUGE_READY
 
     def is_gauge_ready(self, gtype='CG', n=None):
-        """tell us if the gauge is ready to be measured"""
-        answer = self.status(gtype, n)
+        """tell us if the gauge is ready to be measured
+            The status is only queried when the cached one is older than
+            status_ttl, so most measures cost a single serial round-trip
+        """
+        answer = self.cached_status(gtype, n)
         return (answer == GAUGE_READY)
 
     def check_is_gauge(self, gauge):
@@ -378,3 +722,19 @@ class MGC4000(Instrument):
             print("The gauge type '%s' is not accepted, please choose one \
 from the list %s" % (gtype, GAUGE_TYPES))
             return None, None
+
+
+def make_mock_rack(n_instruments, seed=0, **kwargs):
+    """returns n_instruments mock MGC4000, each with its own simulated
+        chamber, i.e. to test the app with a large rack
+    """
+    return [
+        MGC4000(
+            'VIRTUAL%i' % i,
+            mock=True,
+            instr_user_name='MGC 4000 #%i' % i,
+            mock_seed=None if seed is None else seed + i,
+            **kwargs
+        )
+        for i in range(n_instruments)
+    ]
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Decoding of the reply frames of the MGC4000 controller
+
+Each reply of the controller is a fixed 13 bytes frame, i.e.
+    b'*   1.00E-03\\r'    the value read on a gauge (RD)
+    b'*   08 FLOPN\\r'    the status of a gauge (RS)
+    b'?01 SYNTX ER\\r'    an error
+The payload is the 8 bytes between the 4 first ones and the carriage return.
+A frame of another size, or which does not end with the carriage return, is
+invalid: a byte lost on the line would otherwise shift the digits of the
+value (i.e. b'*   1.01E03\r' is not 1010.).
+The frames are decoded straight from the received bytes, without decoding
+them as text or copying them first, and can be received in a reusable buffer
+so the driver does not create a new one for each measure. This does not make
+a read free of allocations: pyserial implements readinto with its read,
+which still returns a new bytes object for each call.
+"""
+
+import enum
+
+# size of a reply frame, in bytes
+FRAME_SIZE = 13
+# position of the payload in a frame
+PAYLOAD_START = 4
+PAYLOAD_STOP = 12
+
+# first byte of the successful replies and of the errors
+REPLY_OK = ord('*')
+REPLY_ERROR = ord('?')
+SPACE = ord(' ')
+CARRIAGE_RETURN = ord('\r')
+DOT = ord('.')
+PLUS = ord('+')
+MINUS = ord('-')
+ZERO = ord('0')
+NINE = ord('9')
+EXPONENT = (ord('E'), ord('e'))
+
+
+class GaugeStatus(enum.IntFlag):
+    """status bits of a gauge, as replied to a RS command"""
+    OK = 0x00
+    OVPRS = 0x01
+    EMISS = 0x02
+    FLVLO = 0x04
+    FLOPN = 0x08
+    DEGAS = 0x10
+    ICLOW = 0x20
+    FLVHI = 0x40
+
+
+class ReplyError(enum.Enum):
+    """errors replied by the controller"""
+    INVALID = 'The device does not exist'
+    SYNTAX = 'Unknown command'
+
+
+# meaning of each status bit
+STATUS_MESSAGES = {
+    GaugeStatus.OVPRS: 'IG over pressure; AI pressure over 1100 Torr',
+    GaugeStatus.EMISS: 'Ie failure',
+    GaugeStatus.FLVLO: 'filament V low',
+    GaugeStatus.FLOPN: 'IG filament open; CG sensor wire is open circuit or \
+CG cable unplugged',
+    GaugeStatus.DEGAS: 'upper pressure limit exceeded during DEGAS operation',
+    GaugeStatus.ICLOW: 'Ic too low',
+    GaugeStatus.FLVHI: 'filament V high'
+}
+
+
+# code of an unknown status, as historian.STATUS_UNKNOWN
+STATUS_UNKNOWN = -1
+# code of each error, the status codes are positive
+ERROR_CODES = {
+    ReplyError.INVALID: -2,
+    ReplyError.SYNTAX: -3
+}
+
+
+def describe_status(status):
+    """returns a readable message for a status or an error"""
+    if isinstance(status, ReplyError):
+        return status.value
+    if status is None:
+        return 'no answer'
+    if status == GaugeStatus.OK:
+        return 'status ok'
+    return '; '.join(
+        message for flag, message in sorted(STATUS_MESSAGES.items())
+        if status & flag
+    )
+
+
+def status_code(status):
+    """returns a status as an int8 code, i.e. to store it in the history:
+        the GaugeStatus bits, or a negative code for the errors and for an
+        unknown status
+    """
+    if isinstance(status, ReplyError):
+        return ERROR_CODES[status]
+    if status is None:
+        return STATUS_UNKNOWN
+    return int(status)
+
+
+def parse_number(frame, start, stop):
+    """parses a number written as i.e. ' 1.00E-03' in frame[start:stop]
+        without copying the bytes, returns None if it is malformed
+    """
+    i = start
+    while i < stop and frame[i] == SPACE:
+        i += 1
+    sign = 1
+    if i < stop and frame[i] in (PLUS, MINUS):
+        sign = -1 if frame[i] == MINUS else 1
+        i += 1
+
+    mantissa = 0
+    decimals = 0
+    digits = 0
+    in_fraction = False
+    while i < stop:
+        byte = frame[i]
+        if ZERO <= byte <= NINE:
+            mantissa = 10 * mantissa + byte - ZERO
+            digits += 1
+            if in_fraction:
+                decimals += 1
+        elif byte == DOT and not in_fraction:
+            in_fraction = True
+        else:
+            break
+        i += 1
+    if not digits:
+        return None
+
+    exponent = 0
+    if i < stop and frame[i] in EXPONENT:
+        i += 1
+        exponent_sign = 1
+        if i < stop and frame[i] in (PLUS, MINUS):
+            exponent_sign = -1 if frame[i] == MINUS else 1
+            i += 1
+        exponent_digits = 0
+        while i < stop and ZERO <= frame[i] <= NINE:
+            exponent = 10 * exponent + frame[i] - ZERO
+            exponent_digits += 1
+            i += 1
+        if not exponent_digits:
+            return None
+        exponent *= exponent_sign
+
+    while i < stop and frame[i] == SPACE:
+        i += 1
+    if i != stop:
+        return None
+
+    # the integer operations are exact, the division rounds correctly
+    exponent -= decimals
+    if exponent >= 0:
+        return float(sign * mantissa * 10 ** exponent)
+    return sign * mantissa / 10 ** -exponent
+
+
+def parse_hex(frame, start, stop):
+    """parses hexadecimal digits in frame[start:stop], None if malformed"""
+    answer = 0
+    for i in range(start, stop):
+        byte = frame[i] | 0x20
+        if ZERO <= byte <= NINE:
+            answer = 16 * answer + byte - ZERO
+        elif ord('a') <= byte <= ord('f'):
+            answer = 16 * answer + byte - ord('a') + 10
+        else:
+            return None
+    return answer
+
+
+def decode_frame(frame, offset=0, stop=None):
+    """decodes the reply frame in frame[offset:stop] (bytes, bytearray or
+        memoryview)
+        Returns the value (float) of a RD reply, the GaugeStatus of a RS
+        reply, a ReplyError for the errors and None for an invalid frame
+    """
+    if stop is None:
+        stop = len(frame)
+    if stop - offset != FRAME_SIZE or frame[stop - 1] != CARRIAGE_RETURN:
+        return None
+
+    first = frame[offset]
+    start = offset + PAYLOAD_START
+    if first == REPLY_OK:
+        if frame[start + 2] == SPACE:
+            # 'HH XXXXX', the status bits in hexadecimal then their name
+            bits = parse_hex(frame, start, start + 2)
+            if bits is None:
+                return None
+            try:
+                return GaugeStatus(bits)
+            except ValueError:
+                return None
+        return parse_number(frame, start, offset + PAYLOAD_STOP)
+    elif first == REPLY_ERROR:
+        if isinstance(frame, memoryview):
+            # a view cannot be searched, only the errors are copied
+            frame = frame[offset:stop].tobytes()
+            offset, stop = 0, FRAME_SIZE
+        if frame.find(b'INVALID', offset, stop) >= 0:
+            return ReplyError.INVALID
+        return ReplyError.SYNTAX
+    return None
+
+
+class FrameReader(object):
+    """receives reply frames in a buffer allocated once
+        The connexion may still allocate to fill it, as pyserial does
+    """
+
+    def __init__(self, frame_size=FRAME_SIZE):
+
+        self.frame_size = frame_size
+        self.allocate(frame_size)
+
+    def allocate(self, size):
+        """creates the buffer, and the views on it where readinto writes,
+            which are kept so a read does not create them again
+        """
+        self.buffer = bytearray(size)
+        view = memoryview(self.buffer)
+        # the view on the end of the buffer from each position
+        self.views = [view[i:] for i in range(size)]
+
+    def read(self, connexion, num_frames=1):
+        """reads frames from a connexion (i.e. serial.Serial) in the buffer
+            and returns the number of bytes received, which is less than
+            expected if the connexion timed out
+            The frames can then be decoded from the buffer with decode
+        """
+        size = num_frames * self.frame_size
+        if size != len(self.buffer):
+            # readinto fills its whole view, so it must be of the right size
+            self.allocate(size)
+
+        received = 0
+        while received < size:
+            count = connexion.readinto(self.views[received])
+            if not count:
+                break
+            received += count
+        return received
+
+    def decode(self, received, index=0):
+        """decodes the index-th frame of the buffer, see decode_frame"""
+        offset = index * self.frame_size
+        return decode_frame(
+            self.buffer,
+            offset,
+            min(offset + self.frame_size, received)
+        )
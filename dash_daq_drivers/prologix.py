@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Shared access to a Prologix GPIB-USB controller
+
+Several GPIB instruments are reached through the same Prologix adapter, the
+instrument a command is meant for is selected with a "++addr N" command. The
+controller remembers the selected address so it is only sent again when the
+next command is meant for another instrument, and can send a batch of
+commands grouped per address. The instruments sharing a controller also
+share the lock and the scheduler of its port (see concurrency.py and
+scheduler.py), so the address and the command are never separated.
+"""
+
+from collections import OrderedDict
+
+import serial
+
+from .concurrency import port_lock
+
+# characters which must be escaped to be sent as data to an instrument
+ESCAPED = b'\r\n\x1b+'
+ESC = b'\x1b'
+
+
+def escape(data):
+    """escapes the characters the adapter would otherwise interpret"""
+    if not any(c in data for c in ESCAPED):
+        return data
+    answer = bytearray()
+    for c in data:
+        if c in ESCAPED:
+            answer += ESC
+        answer.append(c)
+    return bytes(answer)
+
+
+class PrologixController(object):
+    """connexion handle of a Prologix adapter shared by GPIB instruments"""
+
+    def __init__(self, port_name, baud_rate=115200, timeout=1., auto=True,
+                 connexion=None, **kwargs):
+
+        if connexion is None:
+            connexion = serial.Serial(
+                port_name,
+                baud_rate,
+                timeout=timeout,
+                **kwargs
+            )
+        # the serial connexion to the adapter
+        self.connexion = connexion
+        self.port_name = port_name
+        # GPIB address currently selected on the adapter, None if unknown
+        self.address = None
+
+        # the adapter is the controller in charge of the bus
+        self.command('++mode 1')
+        # read the replies automatically after each command
+        self.command('++auto %i' % (1 if auto else 0))
+
+    def __str__(self):
+        return "Prologix controller on %s" % self.port_name
+
+    @property
+    def baudrate(self):
+        return getattr(self.connexion, 'baudrate', None)
+
+    def fileno(self):
+        return self.connexion.fileno()
+
+    def command(self, cmd):
+        """sends a command to the adapter itself, i.e. '++ver'"""
+        if isinstance(cmd, str):
+            cmd = cmd.encode('ascii')
+        if not cmd.startswith(b'++addr '):
+            return self.connexion.write(cmd + b'\n')
+        # keeps track of the addresses selected without select
+        self.invalidate()
+        answer = self.connexion.write(cmd + b'\n')
+        self.selected(cmd[7:].strip().decode('ascii'))
+        return answer
+
+    def address_command(self, address):
+        """returns the command selecting an address, None if the address is
+            already selected
+            The address is only selected once the command is sent, which
+            selected records
+        """
+        address = str(address)
+        if address == self.address:
+            return None
+        return ('++addr %s\n' % address).encode('ascii')
+
+    def selected(self, address):
+        """records the address selected by a command sent to the adapter"""
+        self.address = str(address)
+
+    def select(self, address):
+        """selects the instrument the next commands are meant for, only if it
+            is not already selected
+        """
+        cmd = self.address_command(address)
+        if cmd is not None:
+            # a failed write leaves the selected address unknown
+            self.invalidate()
+            self.connexion.write(cmd)
+            self.selected(address)
+
+    def invalidate(self):
+        """forgets the selected address, i.e. after the adapter was reset"""
+        self.address = None
+
+    def frame(self, msg):
+        """returns the bytes sending data to the selected instrument"""
+        if isinstance(msg, str):
+            msg = msg.encode('ascii')
+        return escape(msg) + b'\n'
+
+    def write(self, msg):
+        """sends data to the selected instrument"""
+        if isinstance(msg, str):
+            msg = msg.encode('ascii')
+        if msg.startswith(b'++'):
+            return self.command(msg)
+        return self.connexion.write(self.frame(msg))
+
+    def read(self, num_bytes=None):
+        if num_bytes is None:
+            return self.readline()
+        return self.connexion.read(num_bytes)
+
+    def readline(self):
+        return self.connexion.readline()
+
+    def ask(self, address, msg, num_bytes=None):
+        """sends a command to the instrument at an address and reads its
+            reply
+        """
+        with port_lock(self):
+            self.select(address)
+            self.write(msg)
+            return self.read(num_bytes)
+
+    def batch(self, commands):
+        """sends a list of (address, command, num_bytes) and returns their
+            replies in the same order
+            The commands are grouped per address, in order of first
+            appearance, so each address is selected once
+        """
+        groups = OrderedDict()
+        for index, (address, msg, num_bytes) in enumerate(commands):
+            groups.setdefault(str(address), []).append(
+                (index, msg, num_bytes)
+            )
+
+        answers = [None] * len(commands)
+        # the instruments using the controller must wait for the whole batch
+        with port_lock(self):
+            for address, group in groups.items():
+                self.select(address)
+                for index, msg, num_bytes in group:
+                    self.write(msg)
+                    answers[index] = self.read(num_bytes)
+        return answers
+
+    def close(self):
+        self.invalidate()
+        self.connexion.close()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Server push of the new measures to the browsers
+
+The acquisition engine publishes each new sample to a broadcaster which
+forwards it to every subscribed browser through a server-sent events (SSE)
+stream, so the clients no longer poll the server to know if something was
+measured. The client side of the stream is in assets/dash_daq_clientside.js.
+"""
+
+import json
+import math
+import queue
+import threading
+
+import flask
+
+# number of events kept for a client which does not read them fast enough
+QUEUE_SIZE = 1000
+# time without event after which a comment is sent to keep the stream open (s)
+KEEPALIVE = 15.
+# route of the stream, relative to the routes prefix of the dash app
+PUSH_ROUTE = '_push/samples'
+# number of streams served at once, each of them holds a thread of the worker
+# for as long as it is open, so it must stay well under the number of
+# threads of a worker (100 in the Procfile) for the callbacks to be served
+MAX_SUBSCRIBERS = 50
+# time after which a client refused for lack of room tries again (s)
+RETRY_AFTER = 30
+
+
+def sample_to_json(timestamp, value):
+    """returns a [time in ms since epoch, value] pair which JSON accepts"""
+    if value is None or math.isnan(value):
+        # NaN is not valid JSON for the browser, it becomes a gap
+        value = None
+    return [timestamp / 1e6, value]
+
+
+def measures_event(instr, channels):
+    """returns the event holding the last sample of the channels of an
+        instrument, None if none of them was measured yet
+    """
+    samples = {}
+    for chan in channels:
+        timestamp, value = instr.measured_data[chan].last()
+        if timestamp is not None:
+            samples[chan] = sample_to_json(timestamp, value)
+    if samples:
+        return {'instr': instr.instr_key, 'samples': samples}
+    return None
+
+
+class TooManySubscribersError(Exception):
+    """raised for a client subscribing when max_subscribers already are"""
+    pass
+
+
+class SampleBroadcaster(object):
+    """forwards the published samples to all the subscribed clients"""
+
+    def __init__(self, queue_size=QUEUE_SIZE,
+                 max_subscribers=MAX_SUBSCRIBERS):
+
+        self.queue_size = queue_size
+        # None for no limit
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        """returns the queue in which the new events will be put
+            Raises TooManySubscribersError if max_subscribers are subscribed
+        """
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            if self.max_subscribers is not None \
+                    and len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribersError(
+                    "%i clients already follow the samples"
+                    % len(self._subscribers)
+                )
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """stops sending events to a queue"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        """sends an event to all the subscribers without ever blocking"""
+        message = json.dumps(event)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # a slow client loses samples instead of slowing the others
+                pass
+
+    def publish_measures(self, instr, channels):
+        """publishes the last sample of each channel of an instrument
+            Can be used as a listener of the acquisition engine
+        """
+        event = measures_event(instr, channels)
+        if event is not None:
+            self.publish(event)
+
+    def stream(self, initial_events=(), keepalive=KEEPALIVE,
+               subscriber=None):
+        """generates the text of a server-sent events stream, to a new
+            subscriber if none is provided
+        """
+        if subscriber is None:
+            subscriber = self.subscribe()
+        try:
+            # flask starts the stream up to its first piece before sending
+            # the headers, which must not wait for an event
+            yield ': connected\n\n'
+            for event in initial_events:
+                yield 'data: %s\n\n' % json.dumps(event)
+            while True:
+                try:
+                    message = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    # comments are ignored by the browser
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'data: %s\n\n' % message
+        finally:
+            self.unsubscribe(subscriber)
+
+
+def last_measures_events(instr_list):
+    """returns an event per instrument with the last sample of its channels
+        so a new client does not wait for the next measure to display them
+    """
+    events = []
+    for instr in instr_list:
+        event = measures_event(instr, instr.measure_params)
+        if event is not None:
+            events.append(event)
+    return events
+
+
+def register_push_route(app, broadcaster, instr_list=(), route=PUSH_ROUTE):
+    """serves the events of the broadcaster as a stream on the dash app's
+        server, the stream starts with the last measures of the instruments
+        The clients beyond the max_subscribers of the broadcaster are
+        answered 503 and retry later
+    """
+
+    def push_stream():
+        try:
+            subscriber = broadcaster.subscribe()
+        except TooManySubscribersError as err:
+            return flask.Response(
+                str(err),
+                status=503,
+                mimetype='text/plain',
+                headers={'Retry-After': str(RETRY_AFTER)}
+            )
+        response = flask.Response(
+            flask.stream_with_context(
+                broadcaster.stream(
+                    last_measures_events(instr_list),
+                    subscriber=subscriber
+                )
+            ),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                # prevents the proxies from buffering the stream
+                'X-Accel-Buffering': 'no'
+            }
+        )
+        # the stream may be closed before it was ever read
+        response.call_on_close(lambda: broadcaster.unsubscribe(subscriber))
+        return response
+
+    app.server.add_url_rule(
+        '%s%s' % (app.config.routes_pathname_prefix, route),
+        'push_stream',
+        push_stream
+    )
+    return push_stream
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+JSON route serving the measured data of a channel within a time window
+
+    GET <routes prefix>_query/<instrument key>/<channel>?start=...&stop=...
+
+The instrument key can hold slashes (i.e. MGC4000(/dev/ttyUSB0)), the
+channel cannot. The bounds of the window are either ISO dates (UTC) or
+numbers of milliseconds since epoch, as the times of the push stream, and
+are optional. max_points must be a positive integer.
+The samples are found by binary search in the history and in the buffer of
+the channel (see Instrument.query), from the coarsest tier of aggregates
+which still has about max_points bins, and reduced to about max_points by
+min/max decimation when there are more of them.
+"""
+
+import math
+
+import flask
+import numpy as np
+
+from .decimation import decimate_segments, window_resolution
+
+# route of the queries, relative to the routes prefix of the dash app
+QUERY_ROUTE = '_query'
+# number of samples returned when the query does not set max_points
+MAX_POINTS = 10000
+# the times are int64 ns since epoch, so within about 292 years of 1970 (s)
+MAX_SECONDS = np.iinfo(np.int64).max // 10 ** 9
+
+
+def parse_time(text):
+    """returns a time in ns since epoch from an ISO date or a number of ms
+        since epoch, None for an empty text
+        Raises ValueError for a text which is neither, or out of range
+    """
+    if text is None or text == '':
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        number = None
+
+    if number is not None:
+        # also false for NaN
+        if not abs(number) < MAX_SECONDS * 1e3:
+            raise ValueError("The time %s is out of range" % text)
+        return int(number * 1e6)
+
+    date = np.datetime64(text)
+    seconds = date.astype('datetime64[s]').astype(np.int64)
+    if np.isnat(date) or not abs(seconds) < MAX_SECONDS:
+        raise ValueError("The date %s is out of range" % text)
+    return int(date.astype('datetime64[ns]').astype(np.int64))
+
+
+def parse_max_points(text):
+    """returns the number of points of a query, MAX_POINTS if text is None
+        Raises ValueError for a text which is not a positive integer
+    """
+    if text is None:
+        return MAX_POINTS
+    max_points = int(text)
+    if max_points < 1:
+        raise ValueError("max_points must be positive, not %s" % text)
+    return max_points
+
+
+def samples_to_json(times, values):
+    """returns the times (ms since epoch) and the values of samples as lists
+        which JSON accepts, NaN becoming None
+    """
+    return (
+        (times / 1e6).tolist(),
+        [None if math.isnan(value) else value for value in values.tolist()]
+    )
+
+
+def query_samples(instr, instr_param, t_start=None, t_stop=None,
+                  max_points=MAX_POINTS):
+    """returns the answer to a query on a channel of an instrument"""
+    # min/max decimation keeps about 2 points per bin
+    n_bins = max(max_points // 2, 1)
+    segments = instr.query(
+        instr_param,
+        t_start,
+        t_stop,
+        window_resolution(instr, instr_param, t_start, t_stop, n_bins)
+    )
+    count = sum(len(times) for times, values in segments)
+    if count > max_points:
+        times, values = decimate_segments(segments, n_bins)
+    elif segments:
+        times = np.concatenate([times for times, values in segments])
+        values = np.concatenate([values for times, values in segments])
+    else:
+        times = np.zeros(0, dtype=np.int64)
+        values = np.zeros(0, dtype=np.float64)
+
+    times, values = samples_to_json(times, values)
+    return {
+        'instr': instr.instr_key,
+        'channel': instr_param,
+        'count': count,
+        'decimated': count > max_points,
+        'times': times,
+        'values': values
+    }
+
+
+def register_query_route(app, instr_list, route=QUERY_ROUTE):
+    """serves the queries on the channels of the instruments on the dash
+        app's server
+    """
+    instruments = dict((instr.instr_key, instr) for instr in instr_list)
+
+    def query_channel(instr_key, instr_param):
+        instr = instruments.get(instr_key)
+        if instr is None or instr_param not in instr.measured_data:
+            return flask.jsonify(
+                {'error': 'unknown channel %s:%s' % (instr_key, instr_param)}
+            ), 404
+        try:
+            t_start = parse_time(flask.request.args.get('start'))
+            t_stop = parse_time(flask.request.args.get('stop'))
+            max_points = parse_max_points(
+                flask.request.args.get('max_points')
+            )
+        except (ValueError, OverflowError) as err:
+            return flask.jsonify({'error': str(err)}), 400
+
+        return flask.jsonify(
+            query_samples(instr, instr_param, t_start, t_stop, max_points)
+        )
+
+    app.server.add_url_rule(
+        '%s%s/<path:instr_key>/<instr_param>' % (
+            app.config.routes_pathname_prefix,
+            route
+        ),
+        'query_channel',
+        query_channel
+    )
+    return query_channel
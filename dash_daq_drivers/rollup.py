@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates of the history at coarser resolutions
+
+Reading a week of raw samples to draw it on a graph a thousand pixels wide
+touches every sample, even if the decimation then drops most of them. The
+rollups keep the min, max, mean and count of the samples of each bin of a
+fixed resolution (i.e. 1 s, then 1 min), so the graph reads the coarsest
+tier which still has a bin per pixel instead.
+
+Each tier is computed from the previous one as the samples arrive, only the
+last bin of each tier stays open in memory until a later record closes it.
+NaN values (failed measures) are not counted, a bin without any valid value
+has NaN aggregates and a count of 0, so the gaps of the trace remain.
+"""
+
+import numpy as np
+
+# columns of the records of a tier, time is the start of the bin
+ROLLUP_COLUMNS = (
+    ('time', np.int64),
+    ('min', np.float64),
+    ('max', np.float64),
+    ('mean', np.float64),
+    ('count', np.int64)
+)
+
+
+def raw_aggregates(times, values):
+    """returns samples as the (times, mins, maxs, sums, counts) aggregates
+        of one sample each, the input of the finest tier
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    return (
+        np.asarray(times, dtype=np.int64),
+        values,
+        values,
+        np.where(valid, values, 0.),
+        valid.astype(np.int64)
+    )
+
+
+def tier_aggregates(records):
+    """returns the records of a tier as (times, mins, maxs, sums, counts)
+        aggregates, the input of the next tier
+    """
+    counts = np.asarray(records['count'], dtype=np.int64)
+    return (
+        np.asarray(records['time'], dtype=np.int64),
+        records['min'],
+        records['max'],
+        np.where(counts > 0, records['mean'] * counts, 0.),
+        counts
+    )
+
+
+def aggregate(times, mins, maxs, sums, counts, resolution):
+    """merges sorted aggregates into bins of resolution ns, returns the
+        (times, mins, maxs, sums, counts) of each bin, times being the start
+        of the bins
+    """
+    bins = times - times % resolution
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    return (
+        bins[starts],
+        np.fmin.reduceat(mins, starts),
+        np.fmax.reduceat(maxs, starts),
+        np.add.reduceat(sums, starts),
+        np.add.reduceat(counts, starts)
+    )
+
+
+class Rollup(object):
+    """tier of aggregates of a channel, written to a history with the
+        ROLLUP_COLUMNS
+    """
+
+    def __init__(self, history, resolution):
+
+        self.history = history
+        # width of the bins, in seconds and in ns
+        self.resolution = resolution
+        self.resolution_ns = int(resolution * 1e9)
+        # the aggregates of the open bin, None before the first record
+        self._open = None
+
+    def end_time(self):
+        """returns the end of the last closed bin, None if there is none"""
+        last_time = self.history.last_time()
+        if last_time is None:
+            return None
+        return last_time + self.resolution_ns
+
+    def add(self, times, mins, maxs, sums, counts):
+        """adds sorted aggregates, writes the bins they close and returns
+            the aggregates of these bins, for the next tier
+        """
+        if self._open is not None:
+            times, mins, maxs, sums, counts = [
+                np.concatenate((opened, new))
+                for opened, new in zip(
+                    self._open, (times, mins, maxs, sums, counts)
+                )
+            ]
+        if not len(times):
+            return times, mins, maxs, sums, counts
+
+        bins = aggregate(times, mins, maxs, sums, counts, self.resolution_ns)
+        # the last bin stays open until a later record arrives
+        self._open = tuple(column[-1:] for column in bins)
+        closed = tuple(column[:-1] for column in bins)
+
+        times, mins, maxs, sums, counts = closed
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(counts > 0, sums / counts, np.nan)
+        written = self.history.extend({
+            'time': times,
+            'min': mins,
+            'max': maxs,
+            'mean': means,
+            'count': counts
+        })
+        # the bins already written before a restart are not passed on
+        return tuple(column[len(times) - written:] for column in closed)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Priority scheduling of the commands sent on a physical port
+
+The value reads, the status queries and the diagnostic commands of all the
+threads share the same slow serial link. The scheduler of a port sends them
+one at a time by order of priority instead of arrival, so a value read never
+waits behind housekeeping traffic. The requests which waited past their
+deadline are dropped instead of being sent late.
+The commands are not spaced further: a request writes a command and blocks
+on its reply, which the instrument only sends once it received the command.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import weakref
+
+# priority classes, the lowest is sent first
+PRIORITY_READ = 0
+PRIORITY_STATUS = 1
+PRIORITY_BULK = 2
+
+# time after which a request not sent yet is dropped, per priority (s)
+DEADLINES = {
+    PRIORITY_READ: 2.,
+    PRIORITY_STATUS: 10.,
+    PRIORITY_BULK: None
+}
+# time without request after which the thread of a scheduler stops (s)
+IDLE_TIMEOUT = 60.
+
+# one scheduler per connexion handle, shared by the instruments using it
+_SCHEDULERS = weakref.WeakKeyDictionary()
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+class StaleRequestError(IOError):
+    """raised for a request dropped because it waited past its deadline"""
+    pass
+
+
+class ScheduledRequest(object):
+    """a call waiting to be run by a port scheduler, and its outcome"""
+
+    def __init__(self, function, args, priority, deadline):
+
+        self.function = function
+        self.args = args
+        self.priority = priority
+        # time (as time.time) after which the request is dropped, or None
+        self.deadline = deadline
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """returns the result of the call once run, raises its error"""
+        if not self.done.wait(timeout):
+            raise StaleRequestError("The request was not run in time")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PortScheduler(object):
+    """runs the requests sent on a port one at a time, by priority"""
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+
+        self.idle_timeout = idle_timeout
+
+        self.queue = []
+        # keeps the order of arrival among the requests of a same priority
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def in_scheduler_thread(self):
+        """tells if the caller is the thread running the requests"""
+        return self._thread is threading.current_thread()
+
+    def submit(self, function, args=(), priority=PRIORITY_BULK,
+               deadline=None):
+        """queues a call and returns its ScheduledRequest
+            The deadline is a delay in seconds, by default the one of the
+            priority class
+        """
+        if deadline is None:
+            deadline = DEADLINES.get(priority)
+        if deadline is not None:
+            deadline = time.time() + deadline
+
+        request = ScheduledRequest(function, args, priority, deadline)
+        with self._condition:
+            heapq.heappush(
+                self.queue,
+                (priority, next(self._counter), request)
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='port-scheduler'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return request
+
+    def call(self, function, args=(), priority=PRIORITY_BULK,
+             deadline=None):
+        """runs a call through the scheduler and returns its result"""
+        if self.in_scheduler_thread():
+            # a request of the scheduler cannot wait for another one
+            return function(*args)
+        return self.submit(function, args, priority, deadline).wait()
+
+    def _next_request(self):
+        """returns the most urgent request, None once idle for too long"""
+        with self._condition:
+            while not self.queue:
+                if not self._condition.wait(self.idle_timeout) \
+                        and not self.queue:
+                    # the next request will start a new thread
+                    self._thread = None
+                    return None
+            return heapq.heappop(self.queue)[2]
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+
+            now = time.time()
+            if request.deadline is not None and now > request.deadline:
+                request.error = StaleRequestError(
+                    "The request waited %.3f s too long and was dropped"
+                    % (now - request.deadline)
+                )
+                request.done.set()
+                continue
+
+            try:
+                request.result = request.function(*request.args)
+            except Exception as err:
+                request.error = err
+            finally:
+                request.done.set()
+
+
+def port_scheduler(connexion):
+    """returns the scheduler of the port of a connexion handle
+        Raises TypeError if the connexion cannot be weakly referenced
+    """
+    with _SCHEDULERS_LOCK:
+        scheduler = _SCHEDULERS.get(connexion)
+        if scheduler is None:
+            scheduler = PortScheduler()
+            _SCHEDULERS[connexion] = scheduler
+    return scheduler
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory data plane between the processes serving the app
+
+A server like gunicorn runs several worker processes which would otherwise
+each have their own instruments and measures. With a data plane, a single
+process (the writer) runs the acquisition and writes the measures in ring
+buffers memory-mapped from files, the other processes (the readers) map the
+same files read-only and copy the samples they need from them.
+
+The files are kept in /dev/shm when it exists, so they never reach the disk.
+Each channel header holds the sequence number of its seqlock (see
+channel_store.py), which the readers of the other processes check as the
+threads of the writer do. A writer killed during an update leaves it odd:
+the readers stop waiting after SEQLOCK_TIMEOUT, and the next writer makes it
+even again when it takes over. The channels selected for the acquisition and
+the ports requested for the instruments are kept in small control files
+which all the processes can write, the writer applies them.
+
+The writer is the process holding an exclusive lock on the plane directory,
+if it dies the lock is released and a reader takes its place. The processes
+must not be forked after the data plane is created (i.e. no gunicorn
+--preload), as they would share the lock.
+"""
+
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # without file locks (Windows) each process is its own writer
+    fcntl = None
+
+from .acquisition import ChannelSelection, PortRequests
+from .channel_store import ChannelStore, RingBuffer
+
+# identifies the layout of the data files
+MAGIC = 0x44415150474b4c31
+# directory of the data planes, in memory when possible
+SHARED_DIRECTORY = \
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# directory of the data plane when none is provided
+DEFAULT_DIRECTORY = os.path.join(SHARED_DIRECTORY, 'dash-daq-pressure-gauge')
+# time between two checks for new samples by a reader, in seconds
+FOLLOW_PERIOD = 0.05
+# time between two attempts of a reader to become the writer, in seconds
+PROMOTE_PERIOD = 1.
+# time after which a reader considers a channel update will never end, as
+# its writer was stopped in the middle of it, in seconds
+SEQLOCK_TIMEOUT = 0.1
+
+# the file header and the channel headers are made of int64
+HEADER_SIZE = 4 * 8
+CHANNEL_HEADER_SIZE = 2 * 8
+# longest port name of a port request, in bytes
+PORT_NAME_SIZE = 248
+
+
+def file_name(instr_key):
+    """returns a file name made of the characters of an instrument key which
+        are safe on every file system
+    """
+    return ''.join(c if c.isalnum() else '_' for c in instr_key)
+
+
+def plane_directory(app_name):
+    """returns the directory of the data plane of an app, each app (i.e. the
+        real and the mock ones) must have its own as they have their own
+        instruments and writer
+    """
+    return '%s-%s' % (DEFAULT_DIRECTORY, file_name(app_name))
+
+
+def map_file(path, size, writable):
+    """maps a file of the given size, created filled with zeros if needed"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        return mmap.mmap(fd, size, access=access)
+    finally:
+        os.close(fd)
+
+
+class SharedRingBuffer(RingBuffer):
+    """ring buffer of timestamped values in a memory-mapped file"""
+
+    def __init__(self, buffer, offset, capacity):
+
+        self.capacity = capacity
+        # the thread of this process appending samples, while it does
+        self._writer = None
+
+        # sequence number and total number of samples of the channel
+        self._header = np.frombuffer(
+            buffer, dtype=np.int64, count=2, offset=offset
+        )
+        offset += CHANNEL_HEADER_SIZE
+        self._times = np.frombuffer(
+            buffer, dtype=np.int64, count=2 * capacity, offset=offset
+        )
+        offset += 2 * capacity * 8
+        self._values = np.frombuffer(
+            buffer, dtype=np.float64, count=2 * capacity, offset=offset
+        )
+
+    @staticmethod
+    def size(capacity):
+        """returns the number of bytes used by a buffer in the file"""
+        return CHANNEL_HEADER_SIZE + 2 * capacity * 16
+
+    def begin_write(self):
+        self._writer = threading.get_ident()
+        self._header[0] += 1
+
+    def end_write(self):
+        self._header[0] += 1
+        self._writer = None
+
+    def sequence(self):
+        return int(self._header[0])
+
+    def consistent(self, read):
+        """returns read() called until the writer did not update the channel
+            meanwhile, the result must be a copy of the samples
+        """
+        if self._writer == threading.get_ident():
+            # the samples are read by the thread writing them
+            return read()
+        deadline = None
+        while True:
+            seq = self.sequence()
+            if seq % 2 == 0:
+                answer = read()
+                if self.sequence() == seq:
+                    return answer
+            if deadline is None:
+                deadline = time.time() + SEQLOCK_TIMEOUT
+            elif time.time() > deadline:
+                # the writer stopped during an update, the samples will not
+                # change until another one takes over
+                return read()
+            # the writer is updating the channel
+            time.sleep(0)
+
+    def reset_sequence(self):
+        """ends the update of a writer stopped in the middle of it"""
+        if self._header[0] % 2:
+            self._header[0] += 1
+
+    @property
+    def count(self):
+        """total number of samples, read consistently with the seqlock"""
+        return self.consistent(lambda: int(self._header[1]))
+
+    @count.setter
+    def count(self, value):
+        self._header[1] = value
+
+
+class SharedChannelStore(ChannelStore):
+    """channel store whose ring buffers are in a memory-mapped file"""
+
+    def __init__(self, path, channels, capacity, writable=False):
+
+        super(SharedChannelStore, self).__init__(capacity=capacity)
+
+        self.path = path
+        self.channels = list(channels)
+        self.writable = writable
+
+        size = HEADER_SIZE + len(self.channels) * SharedRingBuffer.size(
+            capacity
+        )
+        self.memory = map_file(path, size, writable)
+
+        if writable:
+            header = np.frombuffer(self.memory, dtype=np.int64, count=4)
+            if header[0] != MAGIC:
+                header[:] = [MAGIC, 1, len(self.channels), capacity]
+
+        offset = HEADER_SIZE
+        for chan in self.channels:
+            self.buffers[chan] = SharedRingBuffer(
+                self.memory, offset, capacity
+            )
+            if writable:
+                # the previous writer may have died during an update
+                self.buffers[chan].reset_sequence()
+            offset += SharedRingBuffer.size(capacity)
+
+    def add_channel(self, chan, capacity=None):
+        raise ValueError(
+            "The channels of a shared store are set when it is created"
+        )
+
+
+class SharedSelection(ChannelSelection):
+    """channels selected for the acquisition, shared by all the processes
+        Behaves like the ChannelSelection of the acquisition engine, the
+        expiry of each channel is kept in the file
+    """
+
+    def __init__(self, path, instr_list):
+
+        super(SharedSelection, self).__init__()
+
+        # each channel of each instrument has an expiry in the file
+        self.flags = {}
+        for instr in instr_list:
+            for chan in instr.measure_params:
+                self.flags[(instr.instr_key, chan)] = len(self.flags)
+
+        self.memory = map_file(
+            path, max(len(self.flags), 1) * 8, writable=True
+        )
+        self._expiries = np.frombuffer(
+            self.memory, dtype=np.float64, count=len(self.flags)
+        )
+
+    def channels(self):
+        return list(self.flags)
+
+    def get_expiry(self, instr_key, chan):
+        index = self.flags.get((instr_key, chan))
+        if index is None:
+            return 0.
+        return float(self._expiries[index])
+
+    def set_expiry(self, instr_key, chan, expiry):
+        index = self.flags.get((instr_key, chan))
+        if index is not None:
+            self._expiries[index] = expiry
+
+
+class SharedPortRequests(PortRequests):
+    """ports the instruments were asked to connect to, shared by all the
+        processes, so the process running the acquisition applies the
+        requests made in the others
+    """
+
+    def __init__(self, path, instr_list):
+
+        # each instrument has a slot with the version of its last request
+        # (twice the version, odd while the port is written) and the port
+        self.slots = dict(
+            (instr.instr_key, i) for i, instr in enumerate(instr_list)
+        )
+        self.slot_size = 8 + PORT_NAME_SIZE
+        self.memory = map_file(
+            path,
+            max(len(self.slots), 1) * self.slot_size,
+            writable=True
+        )
+        # the processes requesting a port at the same time take turns
+        self._lock = threading.Lock()
+        self._lock_file = open(path, 'rb')
+
+    def _version(self, slot):
+        return np.frombuffer(
+            self.memory, dtype=np.int64, count=1, offset=slot * self.slot_size
+        )
+
+    def request(self, instr_key, port):
+        """asks for an instrument to be connected to a port"""
+        name = port.encode('utf-8')
+        if len(name) > PORT_NAME_SIZE:
+            raise ValueError("The port name %s is too long" % port)
+
+        slot = self.slots[instr_key]
+        version = self._version(slot)
+        start = slot * self.slot_size + 8
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                # a process stopped while writing left the version odd
+                version[0] += 1 + version[0] % 2
+                self.memory[start:start + PORT_NAME_SIZE] = \
+                    name.ljust(PORT_NAME_SIZE, b'\0')
+                version[0] += 1
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def get(self, instr_key):
+        """returns the version and the port of the last request, version 0
+            without request
+        """
+        slot = self.slots.get(instr_key)
+        if slot is None:
+            return 0, None
+        version = self._version(slot)
+        start = slot * self.slot_size + 8
+        deadline = time.time() + SEQLOCK_TIMEOUT
+        while True:
+            seq = int(version[0])
+            name = self.memory[start:start + PORT_NAME_SIZE]
+            if seq % 2 == 0 and int(version[0]) == seq:
+                break
+            if time.time() > deadline:
+                # the request was not written completely, it is ignored
+                return 0, None
+            time.sleep(0)
+        if not seq:
+            return 0, None
+        return seq // 2, name.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+class DataPlane(threading.Thread):
+    """shares the measures of a rack between the processes serving the app
+        The instruments' measured_data are replaced by shared stores. In the
+        reader processes, the thread notifies its listeners of the samples
+        written by the writer and takes over the acquisition if the writer
+        process stops
+    """
+
+    def __init__(self, instr_list, directory=DEFAULT_DIRECTORY):
+
+        super(DataPlane, self).__init__(name='data-plane')
+        self.daemon = True
+
+        self.instr_list = list(instr_list)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # functions called with (instr, channels) when new samples are read
+        self.listeners = []
+        # functions called when the process becomes the writer
+        self.promotion_listeners = []
+        # acquisition engine started when the process becomes the writer
+        self.engine = None
+
+        self._lock_file = open(os.path.join(directory, 'writer.lock'), 'a')
+        self.is_writer = self.try_lock()
+
+        for instr in self.instr_list:
+            instr.measured_data = SharedChannelStore(
+                self.data_path(instr),
+                instr.measure_params,
+                instr.measured_data.capacity,
+                writable=self.is_writer
+            )
+
+        # the selection of the acquisition engine
+        self.selected_channels = SharedSelection(
+            os.path.join(directory, 'selection'),
+            self.instr_list
+        )
+        # the ports requested for the instruments, applied by the writer
+        self.port_requests = SharedPortRequests(
+            os.path.join(directory, 'ports'),
+            self.instr_list
+        )
+
+        self._stop_event = threading.Event()
+
+    def data_path(self, instr):
+        """returns the path of the file holding an instrument's measures"""
+        return os.path.join(
+            self.directory,
+            '%s-%i.ring' % (
+                file_name(instr.instr_key),
+                instr.measured_data.capacity
+            )
+        )
+
+    def try_lock(self):
+        """tries to become the writer of the data plane"""
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def promote(self):
+        """remaps the stores writable once the process became the writer"""
+        self.is_writer = True
+        for instr in self.instr_list:
+            instr.measured_data = SharedChannelStore(
+                self.data_path(instr),
+                instr.measure_params,
+                instr.measured_data.capacity,
+                writable=True
+            )
+        for listener in self.promotion_listeners:
+            try:
+                listener()
+            except Exception as err:
+                print("Listener %s failed : %s" % (listener, err))
+        if self.engine is not None:
+            self.engine.start()
+
+    def add_listener(self, listener):
+        """registers a function called with the instrument and the list of
+            channels which have new samples, in the reader processes
+        """
+        self.listeners.append(listener)
+
+    def add_promotion_listener(self, listener):
+        """registers a function called without argument when the process
+            becomes the writer, before the acquisition starts
+        """
+        self.promotion_listeners.append(listener)
+
+    def start_acquisition(self, engine):
+        """starts the engine if the process is the writer, follows the
+            samples written by the writer otherwise
+        """
+        self.engine = engine
+        if self.is_writer:
+            engine.start()
+        else:
+            self.start()
+
+    def run(self):
+        """notifies the listeners of the new samples until the process
+            becomes the writer
+        """
+        counts = {}
+        last_attempt = time.time()
+        while not self._stop_event.is_set():
+            for instr in self.instr_list:
+                changed = []
+                for chan in instr.measure_params:
+                    count = instr.measured_data[chan].count
+                    if counts.get((instr.instr_key, chan)) != count:
+                        counts[(instr.instr_key, chan)] = count
+                        changed.append(chan)
+                if changed:
+                    for listener in self.listeners:
+                        try:
+                            listener(instr, changed)
+                        except Exception as err:
+                            print("Listener %s failed : %s" % (listener, err))
+
+            if time.time() - last_attempt > PROMOTE_PERIOD:
+                last_attempt = time.time()
+                if self.try_lock():
+                    self.promote()
+                    return
+
+            self._stop_event.wait(FOLLOW_PERIOD)
+
+    def stop(self, timeout=None):
+        """stops following the samples"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Simulator of a MGC4000 controller behind a pseudo-terminal
+
+Unlike the mock mode of the instruments, which skips the communication, the
+simulator answers the RD and RS commands on a pseudo-terminal, so the real
+serial path (framing, status handling, timeouts) can be exercised and
+benchmarked on a Linux box without hardware. The replies can be delayed as
+by a real link at a given baud rate, with jitter, and degraded with dropped
+bytes or error replies.
+
+It runs in a thread of the process using it
+    >>> simulator = MGC4000Simulator(baud_rate=19200)
+    >>> simulator.start()
+    >>> gauge = MGC4000(simulator.port_name)
+or on its own, printing the port to connect the app to
+    $ python -m dash_daq_drivers.simulator --jitter 0.002 --drop-rate 0.01
+"""
+
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from .mgc4000_frames import FRAME_SIZE, GaugeStatus
+
+# gauges answered by the simulator, the others reply ?01 INVALID
+GAUGES = ('CG1', 'CG2', 'CG3', 'CG4')
+# time taken by the controller to process a command, in seconds
+PROCESSING_TIME = 0.002
+# bits sent per byte on a serial link (start, 8 data and stop bits)
+BITS_PER_BYTE = 10
+
+# replies to the commands which cannot be processed
+SYNTAX_ERROR = b'?01 SYNTX ER'
+INVALID_DEVICE = b'?01 INVALID'
+
+
+def make_frame(payload, first=b'*   '):
+    """returns the 13 bytes frame of a reply payload"""
+    frame = first + payload if first else payload
+    return frame.ljust(FRAME_SIZE - 1)[:FRAME_SIZE - 1] + b'\r'
+
+
+class MGC4000Simulator(threading.Thread):
+    """answers the MGC4000 commands on a pseudo-terminal"""
+
+    def __init__(self, baud_rate=19200, processing_time=PROCESSING_TIME,
+                 jitter=0., drop_rate=0., error_rate=0., seed=None,
+                 gauges=GAUGES):
+
+        super(MGC4000Simulator, self).__init__(name='mgc4000-simulator')
+        self.daemon = True
+
+        # the replies are delayed by the time to send them at this rate
+        self.baud_rate = baud_rate
+        self.processing_time = processing_time
+        # maximum random delay added to each reply, in seconds
+        self.jitter = jitter
+        # probability that a byte of a reply is lost
+        self.drop_rate = drop_rate
+        # probability that a valid command is replied with a syntax error
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        # pressure (mbar) and status of each gauge
+        self.pressures = dict((gauge, 1e-3) for gauge in gauges)
+        self.statuses = dict((gauge, GaugeStatus.OK) for gauge in gauges)
+
+        # number of commands received and of bytes dropped
+        self.commands = 0
+        self.dropped = 0
+
+        self.master_fd, self.slave_fd = os.openpty()
+        # no echo nor line editing, the pseudo-terminal acts as a wire
+        tty.setraw(self.slave_fd)
+        tty.setraw(self.master_fd)
+        # the port the instruments connect to, i.e. /dev/pts/3
+        self.port_name = os.ttyname(self.slave_fd)
+
+        self._stop_event = threading.Event()
+
+    def set_pressure(self, gauge, pressure):
+        self.pressures[gauge] = pressure
+
+    def set_status(self, gauge, status):
+        """sets the status bits of a gauge, its reads reply errors until it
+            is back to GaugeStatus.OK
+        """
+        self.statuses[gauge] = GaugeStatus(status)
+
+    def transmit_time(self, num_bytes):
+        """returns the time needed to send a number of bytes at the baud
+            rate of the simulated link
+        """
+        if not self.baud_rate:
+            return 0.
+        return num_bytes * BITS_PER_BYTE / float(self.baud_rate)
+
+    def reply(self, command):
+        """returns the reply frame to a command (without the \\r)"""
+
+        command = command.lstrip(b'# ')
+        operation = command[:2]
+        gauge = command[2:].strip().decode('ascii', 'replace')
+
+        if operation not in (b'RD', b'RS') \
+                or self.random.random() < self.error_rate:
+            return make_frame(SYNTAX_ERROR, first=None)
+        if gauge not in self.pressures:
+            return make_frame(INVALID_DEVICE, first=None)
+
+        status = self.statuses[gauge]
+        if operation == b'RS':
+            name = status.name if status.name and status else 'ST OK'
+            return make_frame(('%02X %s' % (status, name)).encode('ascii'))
+
+        if status != GaugeStatus.OK:
+            return make_frame(SYNTAX_ERROR, first=None)
+        # the pressure drifts slowly between two reads
+        self.pressures[gauge] *= 1 + 0.01 * self.random.gauss(0, 1)
+        return make_frame(('%.2E' % self.pressures[gauge]).encode('ascii'))
+
+    def degrade(self, frame):
+        """drops bytes of a reply according to drop_rate"""
+        if not self.drop_rate:
+            return frame
+        kept = bytes(
+            c for c in frame if self.random.random() >= self.drop_rate
+        )
+        self.dropped += len(frame) - len(kept)
+        return kept
+
+    def run(self):
+        buffer = b''
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self.master_fd, 1024)
+            except OSError:
+                # the pseudo-terminal was closed
+                return
+
+            while b'\r' in buffer:
+                command, buffer = buffer.split(b'\r', 1)
+                self.commands += 1
+                frame = self.reply(command)
+
+                # the command is received, processed then replied at the
+                # speed of the link
+                time.sleep(
+                    self.transmit_time(len(command) + 1 + len(frame))
+                    + self.processing_time
+                    + self.random.uniform(0, self.jitter)
+                )
+                os.write(self.master_fd, self.degrade(frame))
+
+    def stop(self, timeout=None):
+        """stops answering and closes the pseudo-terminal"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulates a MGC4000 controller on a pseudo-terminal'
+    )
+    parser.add_argument('--baud-rate', type=int, default=19200)
+    parser.add_argument(
+        '--processing-time', type=float, default=PROCESSING_TIME
+    )
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--drop-rate', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = MGC4000Simulator(
+        baud_rate=args.baud_rate,
+        processing_time=args.processing_time,
+        jitter=args.jitter,
+        drop_rate=args.drop_rate,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    simulator.start()
+    print("MGC4000 simulator listening on %s" % simulator.port_name)
+    try:
+        while simulator.is_alive():
+            simulator.join(1.)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Physical model of a pumped vacuum chamber, used by the mock instruments
+
+The pressure of the chamber follows pump-down curves (a fast roughing
+exponential followed by a slow outgassing one) towards a base pressure,
+which is raised while a leak is open, and goes back up to the atmosphere
+when the chamber is vented. The events (vents, leaks) are drawn at random
+from a seed, so a mock instrument always tells the same story. The noise of
+the readings and the calibrations of the gauges are drawn from their own
+random states, so the story does not depend on how the chamber is read.
+
+The pressure is computed with numpy for whole blocks of times at once, the
+gauges read it within their range, with their own calibration offset and
+noise, and with the 3 significant digits of the controller. Hundreds of
+virtual controllers can be simulated for load and display tests.
+"""
+
+import numpy as np
+
+from .channel_store import now_ns
+
+# atmospheric pressure, in mbar
+P_ATM = 1013.25
+# range of each type of gauge in mbar, CG are convection gauges, IG ion
+# gauges and AI analog inputs
+GAUGE_RANGES = {
+    'CG': (1e-4, 1333.),
+    'IG': (1e-10, 1e-2),
+    'AI': (1e-4, 1333.)
+}
+# relative noise of the readings of each type of gauge
+GAUGE_NOISE = {
+    'CG': 0.02,
+    'IG': 0.05,
+    'AI': 0.01
+}
+# relative spread of the calibration of the gauges
+CALIBRATION_SPREAD = 0.03
+
+# the kinds of segments of the pressure history
+PUMPING = 0
+VENTING = 1
+
+
+def gauge_decades(gauge):
+    """returns the exponents of the decades spanned by the range of a gauge
+        (i.e. (-4, 4) for a CG), to display it on a logarithmic scale
+    """
+    low, high = GAUGE_RANGES.get(gauge[:2], (1e-10, 1e4))
+    return int(np.floor(np.log10(low))), int(np.ceil(np.log10(high)))
+
+
+def significant_digits(values, digits=3):
+    """rounds the values to a number of significant digits, as displayed by
+        the controller (i.e. 1.23E-05)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    answer = values.copy()
+    valid = np.isfinite(values) & (values > 0)
+    scale = 10. ** (
+        np.floor(np.log10(values[valid])) - (digits - 1)
+    )
+    answer[valid] = np.round(values[valid] / scale) * scale
+    return answer
+
+
+class VacuumSystem(object):
+    """pressure history of a pumped chamber, drawn from a seed"""
+
+    def __init__(
+        self,
+        seed=None,
+        start_time=None,
+        base_pressure=5e-8,
+        roughing_tau=40.,
+        outgassing_tau=1500.,
+        outgassing_pressure=5e-3,
+        vent_interval=7200.,
+        vent_duration=300.,
+        vent_tau=15.,
+        leak_interval=14400.,
+        leak_pressure=2e-6
+    ):
+
+        # the seed draws the seeds of the events, of the noise of the
+        # readings and of the calibrations of the gauges
+        seeds = np.random.RandomState(seed).randint(2 ** 31, size=3)
+        self.events_random = np.random.RandomState(seeds[0])
+        self.noise_random = np.random.RandomState(seeds[1])
+        self.calibration_random = np.random.RandomState(seeds[2])
+
+        # the history starts vented at this time, in ns since epoch
+        if start_time is None:
+            start_time = now_ns()
+        self.start_time = int(start_time)
+
+        self.base_pressure = base_pressure
+        # time constants of the pump-down, in seconds
+        self.roughing_tau = roughing_tau
+        self.outgassing_tau = outgassing_tau
+        # pressure left to the slow outgassing when the roughing is over
+        self.outgassing_pressure = outgassing_pressure
+        # mean time between two vents, their duration and time constant (s)
+        self.vent_interval = vent_interval
+        self.vent_duration = vent_duration
+        self.vent_tau = vent_tau
+        # mean time before a leak opens and the pressure it adds (mbar)
+        self.leak_interval = leak_interval
+        self.leak_pressure = leak_pressure
+
+        # the segments of the history: start (s), kind and start pressure
+        self.segment_starts = [0.]
+        self.segment_kinds = [PUMPING]
+        self.segment_pressures = [P_ATM]
+        # the leaks, open from start to stop (s), until the next vent
+        self.leaks = []
+        # the history is drawn up to this time (s)
+        self.horizon = 0.
+        self._arrays = None
+
+    def _pumping(self, dt, p_start):
+        """pressure after pumping dt seconds from p_start, without leak"""
+        base = self.base_pressure
+        slow = np.minimum(self.outgassing_pressure, p_start - base)
+        fast = np.maximum(p_start - base - slow, 0.)
+        return base \
+            + fast * np.exp(-dt / self.roughing_tau) \
+            + slow * np.exp(-dt / self.outgassing_tau)
+
+    def _venting(self, dt, p_start):
+        """pressure after venting dt seconds from p_start"""
+        return P_ATM - (P_ATM - p_start) * np.exp(-dt / self.vent_tau)
+
+    def _extend(self, until):
+        """draws the events of the history up to a time (s)"""
+        while self.horizon < until:
+            start = self.segment_starts[-1]
+            p_start = self.segment_pressures[-1]
+            if self.segment_kinds[-1] == PUMPING:
+                # the chamber is pumped until it is vented
+                duration = self.events_random.exponential(
+                    self.vent_interval
+                )
+                leak_start = start + self.events_random.exponential(
+                    self.leak_interval
+                )
+                if leak_start < start + duration:
+                    self.leaks.append((leak_start, start + duration))
+                p_end = self._pumping(duration, p_start)
+                kind = VENTING
+            else:
+                duration = self.vent_duration
+                p_end = self._venting(duration, p_start)
+                kind = PUMPING
+
+            self.segment_starts.append(start + duration)
+            self.segment_kinds.append(kind)
+            self.segment_pressures.append(float(p_end))
+            self.horizon = start + duration
+            self._arrays = None
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = (
+                np.array(self.segment_starts),
+                np.array(self.segment_kinds),
+                np.array(self.segment_pressures),
+                np.array(self.leaks).reshape(-1, 2)
+            )
+        return self._arrays
+
+    def pressure(self, times):
+        """returns the true pressure (mbar) of the chamber at the times
+            (ns since epoch)
+        """
+        seconds = (
+            np.asarray(times, dtype=np.int64) - self.start_time
+        ) / 1e9
+        seconds = np.maximum(seconds, 0.)
+        if len(seconds):
+            self._extend(seconds.max())
+
+        starts, kinds, p_starts, leaks = self._get_arrays()
+        index = np.searchsorted(starts, seconds, side='right') - 1
+        dt = seconds - starts[index]
+        p_start = p_starts[index]
+
+        answer = np.where(
+            kinds[index] == PUMPING,
+            self._pumping(dt, p_start),
+            self._venting(dt, p_start)
+        )
+        for leak_start, leak_stop in leaks:
+            answer += self.leak_pressure * (
+                (seconds >= leak_start) & (seconds < leak_stop)
+            )
+        return answer
+
+    def read(self, gauges, times, calibrations=None):
+        """returns the readings of gauges (i.e. ['CG1', 'IG1']) at the times
+            (ns since epoch), as an array of shape (gauges, times)
+            The readings out of the range of an ion gauge are NaN (the gauge
+            is off), the convection gauges saturate at their range limits
+        """
+        pressure = self.pressure(times)
+        answer = np.empty((len(gauges), len(pressure)))
+
+        for row, gauge in enumerate(gauges):
+            gtype = gauge[:2]
+            low, high = GAUGE_RANGES.get(gtype, (0., np.inf))
+            noise = GAUGE_NOISE.get(gtype, 0.)
+            if calibrations is not None:
+                calibration = calibrations.get(gauge, 1.)
+            else:
+                calibration = 1.
+
+            reading = pressure * calibration * np.exp(
+                self.noise_random.normal(0., noise, len(pressure))
+            )
+            if gtype == 'IG':
+                reading[reading > high] = np.nan
+                reading = np.maximum(reading, low)
+            else:
+                reading = np.clip(reading, low, high)
+            answer[row] = reading
+
+        return significant_digits(answer)
+
+    def calibrations(self, gauges):
+        """draws a calibration factor per gauge"""
+        return dict(
+            (
+                gauge,
+                float(np.exp(
+                    self.calibration_random.normal(0., CALIBRATION_SPREAD)
+                ))
+            )
+            for gauge in gauges
+        )
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the background acquisition engine
+"""
+
+import asyncio
+import time
+
+from dash_daq_drivers.acquisition import AcquisitionEngine, ChannelSelection
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+
+class PortRecorder(MGC4000):
+    """mock gauge recording the ports it is connected to"""
+
+    def __init__(self, *args, **kwargs):
+        self.ports = []
+        super(PortRecorder, self).__init__(*args, **kwargs)
+
+    def connect(self, instr_port_name=None, **kwargs):
+        self.ports.append(instr_port_name)
+        if instr_port_name == 'missing':
+            raise IOError("could not open port %s" % instr_port_name)
+
+
+def test_poll_measures_the_selected_channels():
+    instr = MGC4000(mock=True, mock_seed=0)
+    engine = AcquisitionEngine([instr])
+    measured = []
+    engine.add_listener(lambda instr, channels: measured.append(channels))
+
+    engine.select_channels(instr, ['CG1', 'unknown'])
+    engine.poll()
+    assert measured == [['CG1']]
+    assert instr.measured_data['CG1'].count == 1
+    assert instr.measured_data['CG2'].count == 0
+
+
+def test_port_requests_are_applied_before_the_poll():
+    instr = PortRecorder(mock=True)
+    engine = AcquisitionEngine([instr])
+
+    engine.poll()
+    assert instr.ports == []
+
+    engine.request_port(instr, '/dev/ttyUSB1')
+    assert instr.ports == []
+    engine.poll()
+    engine.poll()
+    assert instr.ports == ['/dev/ttyUSB1']
+
+    # a failed connexion does not stop the acquisition
+    engine.request_port(instr, 'missing')
+    engine.request_port(instr, '/dev/ttyUSB1')
+    engine.poll()
+    assert instr.ports == ['/dev/ttyUSB1', '/dev/ttyUSB1']
+
+
+def test_clients_leases_are_polled_together():
+    instr = MGC4000(mock=True, mock_seed=0)
+    engine = AcquisitionEngine([instr])
+    measured = []
+    engine.add_listener(lambda instr, channels: measured.append(channels))
+
+    engine.lease_channels(instr, ['CG1'])
+    engine.lease_channels(instr, ['CG2'], duration=0.05)
+    engine.poll()
+    assert measured == [['CG1', 'CG2']]
+
+    # a page which stops renewing its lease only drops its own channels
+    time.sleep(0.1)
+    engine.poll()
+    assert measured[-1] == ['CG1']
+
+    # nor does deselecting the rack stop the leased channels
+    engine.select_channels(instr, [])
+    engine.poll()
+    assert measured[-1] == ['CG1']
+
+
+def test_selection_stops_on_deselection():
+    selection = ChannelSelection()
+    selection['gauge'] = ['CG1', 'CG2']
+    assert selection['gauge'] == ['CG1', 'CG2']
+    selection['gauge'] = ['CG1']
+    assert selection['gauge'] == ['CG1']
+
+    # the leased channels stay polled until their lease expires
+    selection.lease('gauge', ['CG3'], time.time() + 10.)
+    selection['gauge'] = []
+    assert selection.items() == [('gauge', ['CG3'])]
+    selection.lease('gauge', ['CG3'], time.time() - 1.)
+    assert selection['gauge'] == ['CG3']
+
+
+class SlowGauge(MGC4000):
+    """mock gauge taking some time to answer, without blocking the loop"""
+
+    async def async_measure(self, instr_param, timeout=None):
+        await asyncio.sleep(0.2)
+        return await super(SlowGauge, self).async_measure(instr_param)
+
+
+def test_instruments_are_polled_concurrently():
+    rack = [
+        SlowGauge('COM%i' % seed, mock=True, mock_seed=seed)
+        for seed in range(3)
+    ]
+    engine = AcquisitionEngine(rack)
+    measured = []
+    engine.add_listener(lambda instr, channels: measured.append(instr))
+    for instr in rack:
+        engine.select_channels(instr, ['CG1'])
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.time()
+        loop.run_until_complete(engine.async_poll())
+        # in the time of a single measure
+        assert time.time() - start < 0.5
+    finally:
+        loop.close()
+    assert sorted(measured, key=rack.index) == rack
+    assert all(instr.measured_data['CG1'].count == 1 for instr in rack)
+
+
+def test_concurrent_engine_polls_from_its_thread():
+    rack = [
+        SlowGauge('COM%i' % seed, mock=True, mock_seed=seed)
+        for seed in range(2)
+    ]
+    engine = AcquisitionEngine(rack, period=0.05, concurrent=True)
+    for instr in rack:
+        engine.select_channels(instr, ['CG1'])
+    engine.start()
+    time.sleep(0.5)
+    engine.stop(1.)
+    assert not engine.is_alive()
+    assert all(instr.measured_data['CG1'].count >= 1 for instr in rack)
+
+
+class BuggyGauge(MGC4000):
+    """mock gauge whose driver fails with an unexpected error"""
+
+    def measure_all(self, instr_params=None):
+        raise TypeError("bug in the driver")
+
+    def connect(self, instr_port_name=None, **kwargs):
+        raise TypeError("bug in the driver")
+
+
+def test_unexpected_errors_do_not_stop_the_acquisition():
+    good = MGC4000('COM1', mock=True, mock_seed=0)
+    buggy = BuggyGauge('COM2', mock=True)
+    engine = AcquisitionEngine([buggy, good], period=0.02)
+    measured = []
+    engine.add_listener(lambda instr, channels: measured.append(instr))
+    engine.select_channels(buggy, ['CG1'])
+    engine.select_channels(good, ['CG1'])
+
+    # the other instruments are measured
+    engine.poll()
+    assert measured == [good]
+
+    # the thread keeps polling after an error outside of the measures
+    engine.request_port(buggy, 'COM3')
+    engine.start()
+    time.sleep(0.2)
+    try:
+        assert engine.is_alive()
+        assert len(measured) > 2
+    finally:
+        engine.stop(1.)
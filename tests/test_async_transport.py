@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the asyncio access to the instruments, through the simulator
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+
+@pytest.fixture
+def gauge():
+    simulator = pytest.importorskip('dash_daq_drivers.simulator')
+    link = simulator.MGC4000Simulator(baud_rate=0, processing_time=0.)
+    link.start()
+    instr = MGC4000(link.port_name, timeout=1.)
+    yield instr
+    instr.disconnect()
+    link.stop(1.)
+
+
+def is_pressure(value):
+    return 1e-4 < value < 1e-2
+
+
+def test_successive_event_loops(gauge):
+    # each asyncio.run creates and closes its own loop
+    for _ in range(3):
+        assert is_pressure(asyncio.run(gauge.async_measure('CG1')))
+
+
+def test_port_lock_taken_by_a_thread(gauge):
+    lock = gauge.get_port_lock()
+    taken = threading.Event()
+
+    def use_port():
+        with lock:
+            taken.set()
+            time.sleep(0.05)
+
+    thread = threading.Thread(target=use_port)
+    thread.start()
+    taken.wait()
+
+    start = time.time()
+    value = asyncio.run(gauge.async_measure('CG1'))
+    elapsed = time.time() - start
+    thread.join()
+    assert is_pressure(value)
+    # the command waited for the thread to free the port
+    assert elapsed >= 0.04
+
+
+def test_threads_and_coroutines_share_the_port(gauge):
+    values = []
+
+    def measure_in_thread():
+        for _ in range(20):
+            values.append(gauge.measure('CG2'))
+
+    async def measure_in_loop():
+        for _ in range(20):
+            values.append(await gauge.async_measure('CG1'))
+
+    thread = threading.Thread(target=measure_in_thread)
+    thread.start()
+    asyncio.run(measure_in_loop())
+    thread.join()
+
+    assert len(values) == 40
+    assert all(is_pressure(value) for value in values)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the broker sharing the instruments' ports between processes
+"""
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from dash_daq_drivers.broker import BrokerConnexion, InstrumentBroker, \
+    PORT_TIMEOUT, decode_value, encode_value
+from dash_daq_drivers.generic_instruments import INTF_BROKER
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+
+def test_encode_bytes():
+    value = ['#  RDCG1\r', b'*   1.00E-03\r', bytearray(b'\xff'), 13]
+    assert decode_value(encode_value(value)) == [
+        '#  RDCG1\r', b'*   1.00E-03\r', b'\xff', 13
+    ]
+
+
+@pytest.fixture
+def mock_broker(tmp_path):
+    pytest.importorskip('tty')
+    broker = InstrumentBroker(str(tmp_path / 'broker.sock'), mock=True)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield broker
+    broker.shutdown()
+    broker.server_close()
+
+
+def test_mock_broker_answers_as_a_mgc4000(mock_broker):
+    gauge = MGC4000(
+        'COM3',
+        interface=INTF_BROKER,
+        broker_path=mock_broker.path,
+        timeout=1.
+    )
+    try:
+        value = gauge.measure('CG1')
+        assert 1e-4 < value < 1e-2
+        assert gauge.channel_status('CG1') == 0
+        assert mock_broker.call('status') == {'COM3': 1}
+    finally:
+        gauge.disconnect()
+    assert mock_broker.call('status') == {}
+
+
+def test_ports_are_opened_with_a_read_timeout(mock_broker):
+    gauge = MGC4000(
+        'COM3',
+        interface=INTF_BROKER,
+        broker_path=mock_broker.path
+    )
+    other = MGC4000(
+        'COM4',
+        interface=INTF_BROKER,
+        broker_path=mock_broker.path,
+        timeout=0.5
+    )
+    try:
+        connexions = dict(
+            (port, broker_port.instr.instr_connexion)
+            for port, broker_port in mock_broker.ports.items()
+        )
+        assert connexions['COM3'].timeout == PORT_TIMEOUT
+        assert connexions['COM4'].timeout == 0.5
+    finally:
+        gauge.disconnect()
+        other.disconnect()
+
+
+def test_late_reply_is_not_read_as_the_next_one(mock_broker, monkeypatch):
+    call = mock_broker.call
+    delays = [0.3]
+
+    def slow_call(method, port=None, args=(), kwargs=None):
+        if method == 'read' and delays:
+            time.sleep(delays.pop())
+            return b'late'
+        return call(method, port, args, kwargs)
+
+    monkeypatch.setattr(mock_broker, 'call', slow_call)
+    connexion = BrokerConnexion(
+        'COM3', mock_broker.path, reply_timeout=0.1
+    )
+    try:
+        with pytest.raises(IOError):
+            connexion.read(13)
+        # the request is answered on a new socket, with the port opened
+        # again for it
+        time.sleep(0.3)
+        assert connexion.status() == {'COM3': 1}
+        assert connexion.ask('#  RDCG1\r', 13).endswith(b'\r')
+    finally:
+        connexion.close()
+
+
+def test_socket_is_private(mock_broker):
+    assert os.stat(mock_broker.path).st_mode & 0o777 == 0o600
+
+
+def test_running_broker_keeps_its_socket(mock_broker):
+    with pytest.raises(IOError):
+        InstrumentBroker(mock_broker.path)
+    assert mock_broker.call('status') == {}
+    connexion = BrokerConnexion('COM3', mock_broker.path)
+    try:
+        assert connexion.status() == {'COM3': 1}
+    finally:
+        connexion.close()
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / 'broker.sock')
+    # a socket file nobody listens on, as left by a killed broker
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    broker = InstrumentBroker(path)
+    try:
+        assert os.path.exists(path)
+    finally:
+        broker.server_close()
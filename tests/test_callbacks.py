@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the server callbacks updating the gauges of a rack
+"""
+
+import json
+
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input
+
+from dash_daq_drivers.callbacks import make_gauges_callback
+from dash_daq_drivers.kurtjlesker_instruments import make_mock_rack
+
+
+def gauge_output(instr_key, chan):
+    return {
+        'id': {'type': 'gauge', 'instr': instr_key, 'chan': chan},
+        'property': 'value'
+    }
+
+
+def test_one_callback_updates_every_gauge_of_the_rack():
+    rack = make_mock_rack(2)
+    app = dash.Dash(__name__)
+    app.layout = html.Div(
+        [dcc.Interval(id='interval')]
+        + [instr.control_components for instr in rack]
+    )
+    make_gauges_callback(rack, app, [Input('interval', 'n_intervals')])
+
+    # a single callback with a pattern-matching output for all the gauges
+    assert list(app.callback_map) == [
+        '{"chan":["ALL"],"instr":["ALL"],"type":"gauge"}.value'
+    ]
+
+    rack[0].last_measure['CG1'] = 1e-3
+    rack[1].last_measure['CG2'] = 2e-5
+    outputs = [
+        gauge_output(instr.instr_key, chan)
+        for instr in rack for chan in ('CG1', 'CG2')
+    ] + [gauge_output('MGC4000(elsewhere)', 'CG1')]
+    reply = app.server.test_client().post(
+        '/_dash-update-component',
+        json={
+            'output': list(app.callback_map)[0],
+            'outputs': outputs,
+            'inputs': [
+                {'id': 'interval', 'property': 'n_intervals', 'value': 1}
+            ],
+            'changedPropIds': ['interval.n_intervals'],
+            'state': []
+        }
+    )
+    assert reply.status_code == 200
+
+    # the replies are indexed per JSON id of gauge
+    values = dict(
+        (json.dumps(json.loads(key), sort_keys=True), props['value'])
+        for key, props in reply.get_json()['response'].items()
+    )
+    expected = dict(
+        (json.dumps(output['id'], sort_keys=True),
+         rack[i // 2].last_measure[output['id']['chan']])
+        for i, output in enumerate(outputs[:-1])
+    )
+    # the gauges of another rack are left as they are
+    assert values == expected
+    assert 1e-3 in values.values() and 2e-5 in values.values()
+
+
+def test_instrument_generates_its_gauges_callback():
+    instr = make_mock_rack(1)[0]
+    app = dash.Dash(__name__)
+    instr.generate_callbacks(app, [Input('interval', 'n_intervals')])
+    assert len(app.callback_map) == 1
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ring buffers keeping the measured data
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers.channel_store import ChannelStore, RingBuffer
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_latest_samples_in_order():
+    buffer = RingBuffer(4)
+    for i in range(6):
+        buffer.append(float(i), i)
+
+    assert len(buffer) == 4
+    assert buffer.count == 6
+    times, values = buffer.latest()
+    assert times.tolist() == [2, 3, 4, 5]
+    assert values.tolist() == [2., 3., 4., 5.]
+    assert buffer.latest(2)[0].tolist() == [4, 5]
+    assert buffer.last() == (5, 5.)
+
+
+def test_latest_is_not_overwritten():
+    buffer = RingBuffer(4)
+    buffer.extend([2., 3., 4., 5.], [2, 3, 4, 5])
+    times, values = buffer.latest()
+    window_times, window_values = buffer.window(3, 5)
+    buffer.append(6., 6)
+
+    assert times.tolist() == [2, 3, 4, 5]
+    assert values.tolist() == [2., 3., 4., 5.]
+    assert window_times.tolist() == [3, 4]
+    assert window_values.tolist() == [3., 4.]
+
+
+def test_extend_keeps_the_last_capacity_samples():
+    buffer = RingBuffer(3)
+    buffer.append(0., 0)
+    buffer.extend(np.arange(1., 6.), np.arange(1, 6))
+    assert buffer.count == 6
+    assert buffer.latest()[0].tolist() == [3, 4, 5]
+    with pytest.raises(ValueError):
+        buffer.extend([1., 2.], [1])
+
+
+def test_since():
+    buffer = RingBuffer(3)
+    buffer.extend([1., 2.], [1, 2])
+    times, values, cursor = buffer.since(0)
+    assert times.tolist() == [1, 2]
+    assert cursor == 2
+
+    # the samples overwritten before being read are skipped
+    buffer.extend([3., 4., 5., 6.], [3, 4, 5, 6])
+    times, values, cursor = buffer.since(cursor)
+    assert times.tolist() == [4, 5, 6]
+    assert cursor == 6
+    assert len(buffer.since(cursor)[0]) == 0
+
+
+def test_window():
+    store = ChannelStore(['CG1'], capacity=10)
+    for i in range(10):
+        store.append('CG1', float(i), 10 * i)
+
+    assert store.window('CG1', 20, 50)[0].tolist() == [20, 30, 40]
+    assert store.window('CG1', 85)[0].tolist() == [90]
+    assert store.window('CG1', t_stop=15)[0].tolist() == [0, 10]
+    assert len(store.window('CG1', 100)[0]) == 0
+
+
+def test_reads_stay_sorted_while_written():
+    buffer = RingBuffer(64)
+    stop = threading.Event()
+
+    def write():
+        timestamp = 0
+        while not stop.is_set():
+            buffer.extend(np.ones(7), np.arange(timestamp, timestamp + 7))
+            timestamp += 7
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(2000):
+            times, values = buffer.latest()
+            assert np.all(np.diff(times) == 1)
+            times, values = buffer.window(t_start=buffer.count // 2)
+            assert np.all(np.diff(times) == 1)
+    finally:
+        stop.set()
+        writer.join()
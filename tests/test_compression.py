@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the compression of the traces written to the history
+"""
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers.compression import Compressor, DeadbandCompressor, \
+    SwingingDoorCompressor
+
+TOLERANCE = 0.02
+
+
+def pressure_trace(n=5000, seed=0):
+    """returns the times, values and statuses of a noisy pump down"""
+    random = np.random.RandomState(seed)
+    times = np.arange(n, dtype=np.int64) * 10 ** 9
+    values = 1e-3 * np.exp(
+        -np.linspace(0., 5., n) + np.cumsum(random.normal(0., 0.002, n))
+    )
+    return times, values, np.zeros(n, dtype=np.int8)
+
+
+def compress(compressor, times, values, statuses, batch=700):
+    """returns the records kept from samples sent in batches, flushed"""
+    parts = []
+    for start in range(0, len(times), batch):
+        stop = start + batch
+        parts.append(compressor.compress(
+            times[start:stop], values[start:stop], statuses[start:stop]
+        ))
+    flushed = compressor.flush()
+    if flushed is not None:
+        parts.append(flushed)
+    return dict(
+        (column, np.concatenate([part[column] for part in parts]))
+        for column in ('time', 'value', 'status')
+    )
+
+
+@pytest.mark.parametrize('compressor_class', [
+    DeadbandCompressor,
+    SwingingDoorCompressor
+])
+@pytest.mark.parametrize('relative', [False, True])
+def test_drawn_trace_is_within_tolerance(compressor_class, relative):
+    times, values, statuses = pressure_trace()
+    tolerance = TOLERANCE if relative else TOLERANCE * 1e-4
+    kept = compress(
+        compressor_class(tolerance, relative, max_interval=None),
+        times,
+        values,
+        statuses
+    )
+
+    assert 1 < len(kept['time']) < len(times) // 2
+    # the trace is drawn with straight lines between the kept samples
+    drawn = np.interp(times, kept['time'], kept['value'])
+    bound = tolerance * values if relative else tolerance
+    assert np.all(np.abs(drawn - values) <= bound * (1. + 1e-9))
+
+
+def test_relative_deviation_is_checked_on_the_drawn_lines():
+    # on a log scale the samples are on a straight line, the line drawn
+    # from the first to the last one misses the middle one by a factor 5
+    times = np.arange(3, dtype=np.int64) * 10 ** 9
+    for compressor_class in (DeadbandCompressor, SwingingDoorCompressor):
+        kept = compress(
+            compressor_class(TOLERANCE, relative=True),
+            times,
+            np.array([1., 10., 100.]),
+            np.zeros(3, dtype=np.int8)
+        )
+        assert (kept['time'] // 10 ** 9).tolist() == [0, 1, 2]
+
+
+def test_deadband_matches_the_sample_loop():
+    times, values, statuses = pressure_trace(3000, seed=1)
+    values[100:110] = np.nan
+    values[500] = -1.
+    values[900:901] = np.nan
+    statuses[1500:1600] = 2
+    statuses[2000] = 1
+
+    for relative in (False, True):
+        tolerance = TOLERANCE if relative else TOLERANCE * 1e-4
+        for max_interval in (None, 20.):
+            vectorized = compress(
+                DeadbandCompressor(tolerance, relative, max_interval),
+                times,
+                values,
+                statuses,
+                batch=333
+            )
+            # the loop over each sample of the base class
+            reference = DeadbandCompressor(tolerance, relative, max_interval)
+            looped = [
+                Compressor.compress(
+                    reference,
+                    times[start:start + 333],
+                    values[start:start + 333],
+                    statuses[start:start + 333]
+                )
+                for start in range(0, len(times), 333)
+            ]
+            flushed = reference.flush()
+            if flushed is not None:
+                looped.append(flushed)
+            for column in ('time', 'value', 'status'):
+                np.testing.assert_array_equal(
+                    vectorized[column],
+                    np.concatenate([part[column] for part in looped])
+                )
+
+
+@pytest.mark.parametrize('compressor_class', [
+    DeadbandCompressor,
+    SwingingDoorCompressor
+])
+def test_gaps_and_status_changes_are_kept(compressor_class):
+    times = np.arange(10, dtype=np.int64) * 10 ** 9
+    values = np.array([1., 1., 1., np.nan, np.nan, 1., 1., 1., 1., 1.])
+    statuses = np.array([0, 0, 0, 0, 0, 0, 0, 3, 3, 3], dtype=np.int8)
+    kept = compressor_class(0.1, relative=True).compress(
+        times, values, statuses
+    )
+    assert (kept['time'] // 10 ** 9).tolist() == [0, 2, 3, 4, 5, 6, 7]
+
+
+def test_max_interval_keeps_a_sample():
+    times = np.arange(100, dtype=np.int64) * 10 ** 9
+    kept = DeadbandCompressor(0.1, max_interval=30.).compress(
+        times, np.ones(100), np.zeros(100, np.int8)
+    )
+    assert (kept['time'] // 10 ** 9).tolist() == [0, 30, 60, 90]
+
+
+def test_negative_tolerance_is_refused():
+    with pytest.raises(ValueError):
+        DeadbandCompressor(-0.1)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the port locks and of the single-flight groups
+"""
+
+import threading
+import time
+
+import pytest
+
+from dash_daq_drivers.concurrency import SingleFlight, port_lock
+
+
+class Connexion(object):
+    pass
+
+
+class Abort(BaseException):
+    pass
+
+
+def run_concurrently(flight, key, function, n=5):
+    """calls function from n threads while the first call is in flight,
+        returns the results and the errors of the threads
+    """
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+    errors = []
+
+    def leader():
+        started.set()
+        release.wait(5.)
+        return function()
+
+    def caller(target):
+        try:
+            results.append(flight.do(key, target))
+        except BaseException as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=caller, args=(leader,))]
+    threads[0].start()
+    assert started.wait(5.)
+    threads += [
+        threading.Thread(target=caller, args=(function,))
+        for _ in range(n - 1)
+    ]
+    for thread in threads[1:]:
+        thread.start()
+    # leaves the time for the other threads to wait for the call
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5.)
+    return results, errors
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    def query():
+        calls.append(None)
+        return len(calls)
+
+    results, errors = run_concurrently(flight, 'RDCG1', query)
+    assert results == [1] * 5
+    assert errors == []
+    # the result is not kept without a window
+    assert flight.do('RDCG1', query) == 2
+
+
+def test_error_is_raised_in_every_caller():
+    flight = SingleFlight()
+
+    def failing():
+        raise Abort()
+
+    results, errors = run_concurrently(flight, 'RDCG1', failing)
+    assert results == []
+    assert len(errors) == 5
+    assert all(isinstance(err, Abort) for err in errors)
+    # the failed call is not reused
+    assert flight.do('RDCG1', lambda: 3) == 3
+
+
+def test_result_is_reused_within_the_window():
+    flight = SingleFlight(window=0.2)
+    calls = []
+
+    def query():
+        calls.append(None)
+        return len(calls)
+
+    assert flight.do('RDCG1', query) == 1
+    assert flight.do('RDCG1', query) == 1
+    # each key has its own result
+    assert flight.do('RDCG2', query) == 2
+
+    time.sleep(0.25)
+    assert flight.do('RDCG1', query) == 3
+
+    flight.forget('RDCG1')
+    assert flight.do('RDCG1', query) == 4
+    flight.forget()
+    assert flight.do('RDCG2', query) == 5
+
+
+def test_port_lock_is_shared_per_connexion():
+    connexion = Connexion()
+    lock = port_lock(connexion)
+    assert port_lock(connexion) is lock
+    assert port_lock(Connexion()) is not lock
+
+    # a command can take the lock again, another thread cannot
+    acquired = []
+    with lock:
+        with port_lock(connexion):
+            thread = threading.Thread(
+                target=lambda: acquired.append(lock.acquire(timeout=0.05))
+            )
+            thread.start()
+            thread.join(5.)
+    assert acquired == [False]
+
+
+def test_port_lock_needs_a_weak_reference():
+    with pytest.raises(TypeError):
+        port_lock(b'COM3')
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the reduction of the traces to the resolution of the graph
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers.decimation import from_local_time, minmax_decimate, \
+    parse_view, to_local_time
+
+
+@pytest.fixture
+def paris_time(monkeypatch):
+    if not hasattr(time, 'tzset'):
+        pytest.skip('the time zone cannot be changed on this platform')
+    monkeypatch.setenv('TZ', 'Europe/Paris')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_minmax_keeps_the_peaks():
+    ydata = np.zeros(1000)
+    ydata[123] = 5.
+    ydata[456] = -3.
+    xdata = np.arange(1000)
+    xdata, decimated = minmax_decimate(xdata, ydata, 10)
+    assert len(decimated) <= 22
+    assert 123 in xdata and 456 in xdata
+    assert decimated.max() == 5. and decimated.min() == -3.
+
+
+def test_minmax_short_traces_are_kept():
+    xdata = np.arange(10)
+    assert minmax_decimate(xdata, xdata * 1., 5)[0] is xdata
+
+
+def test_traces_in_local_time(paris_time):
+    # 2018-06-26 08:00 UTC, summer time in Paris
+    summer = 1530000000 * 10 ** 9
+    # 2018-01-26 08:00 UTC, winter time
+    winter = summer - 151 * 86400 * 10 ** 9
+    local = to_local_time([winter, summer])
+    assert str(local[0]) == '2018-01-26T09:00:00.000000000'
+    assert str(local[1]) == '2018-06-26T10:00:00.000000000'
+
+    assert from_local_time('2018-06-26 10:00') == summer
+    assert parse_view({
+        'width': 500,
+        'xrange': ['2018-01-26 09:00', '2018-06-26 10:00']
+    }) == (500, winter, summer)
+
+
+def test_invalid_view():
+    assert parse_view({'xrange': ['now', 'later']})[1:] == (None, None)
+    assert parse_view(None)[1:] == (None, None)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the generic instrument driver
+"""
+
+import subprocess
+import sys
+
+
+def test_generic_driver_does_not_import_dash():
+    # run apart, as the other tests may already have imported dash
+    script = (
+        'import sys\n'
+        'import dash_daq_drivers.generic_instruments\n'
+        'print(sorted(set(m.split(".")[0] for m in sys.modules)'
+        ' & {"dash", "flask", "plotly"}))\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', script])
+    assert output.decode().strip() == '[]'
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the on-disk history of the measured data and of its aggregates
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers.channel_store import ChannelStore
+from dash_daq_drivers.historian import Historian, HistoryChannel, \
+    HistoryChunk
+from dash_daq_drivers.rollup import ROLLUP_COLUMNS, Rollup, raw_aggregates
+
+SECOND = 10 ** 9
+
+
+def records(times, values=None):
+    times = np.asarray(times, dtype=np.int64)
+    if values is None:
+        values = times / 1e9
+    return {
+        'time': times,
+        'value': np.asarray(values, dtype=np.float64),
+        'status': np.zeros(len(times), dtype=np.int8)
+    }
+
+
+class FakeInstrument(object):
+    """the parts of an instrument a historian uses"""
+
+    def __init__(self, instr_key='MGC4000(COM3)', channels=('CG1',),
+                 capacity=100):
+        self.instr_key = instr_key
+        self.measured_data = ChannelStore(channels, capacity)
+        self.historian = None
+
+    def channel_status(self, chan):
+        return 0
+
+
+def test_chunk_write_and_search(tmp_path):
+    chunk = HistoryChunk(str(tmp_path / 'a.chunk'), capacity=3000,
+                         writable=True)
+    chunk.write(records(np.arange(0, 2000, 2)))
+    assert chunk.count == 1000
+    assert chunk.free() == 2000
+    assert chunk.search(0) == 0
+    assert chunk.search(1001) == 501
+    assert chunk.search(5000) == 1000
+    with pytest.raises(ValueError):
+        chunk.write(records(np.arange(3000, 6000)))
+
+    reader = HistoryChunk(chunk.path)
+    assert reader.capacity == 3000
+    assert reader.column('time')[-1] == 1998
+
+
+def test_reader_never_writes_the_header(tmp_path):
+    path = str(tmp_path / 'empty.chunk')
+    # a chunk created by the writer, whose header is not written yet
+    with open(path, 'wb') as chunk_file:
+        chunk_file.write(b'\0' * 1024)
+    with pytest.raises(IOError):
+        HistoryChunk(path)
+    with open(path, 'rb') as chunk_file:
+        assert chunk_file.read() == b'\0' * 1024
+
+
+def test_channel_spans_chunks(tmp_path):
+    directory = str(tmp_path / 'CG1')
+    history = HistoryChannel(directory, chunk_size=10, writable=True)
+    assert history.extend(records(np.arange(25) * SECOND)) == 25
+    assert len(history.chunks) == 3
+    assert history.count == 25
+    assert history.last_time() == 24 * SECOND
+
+    # the records not later than the last one are dropped
+    assert history.extend(records(np.arange(20, 30) * SECOND)) == 5
+    segments = history.query(8 * SECOND, 12 * SECOND)
+    assert [s['time'].tolist() for s in segments] == [
+        [8 * SECOND, 9 * SECOND], [10 * SECOND, 11 * SECOND]
+    ]
+    assert history.latest(3)['time'].tolist() == [
+        27 * SECOND, 28 * SECOND, 29 * SECOND
+    ]
+
+
+def test_reader_follows_the_writer(tmp_path):
+    directory = str(tmp_path / 'CG1')
+    writer = HistoryChannel(directory, chunk_size=10, writable=True)
+    reader = HistoryChannel(directory, chunk_size=10)
+    writer.extend(records(np.arange(5)))
+    assert reader.count == 0
+    reader.refresh()
+    assert reader.count == 5
+
+    # a chunk whose header is not written yet is opened later
+    with open(writer.chunk_path(10), 'wb') as chunk_file:
+        chunk_file.write(b'\0' * 64)
+    reader.refresh()
+    assert len(reader.chunks) == 1
+
+    with pytest.raises(IOError):
+        reader.extend(records([10]))
+    with pytest.raises(IOError):
+        reader.expire(10)
+
+
+def test_expire_keeps_the_last_chunk(tmp_path):
+    history = HistoryChannel(str(tmp_path), chunk_size=10, writable=True)
+    history.extend(records(np.arange(30) * SECOND))
+    history.expire(15 * SECOND)
+    assert history.starts == [10, 20]
+    history.expire(100 * SECOND)
+    assert history.starts == [20]
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+def test_rollup_bins(tmp_path):
+    history = HistoryChannel(
+        str(tmp_path), ROLLUP_COLUMNS, chunk_size=10, writable=True
+    )
+    rollup = Rollup(history, 1.)
+    times = np.arange(0, 3 * SECOND, SECOND // 4)
+    values = np.arange(len(times), dtype=np.float64)
+    values[5] = np.nan
+
+    closed = rollup.add(*raw_aggregates(times, values))
+    # the last bin stays open
+    assert closed[0].tolist() == [0, SECOND]
+    written = history.query()[0]
+    assert written['min'].tolist() == [0., 4.]
+    assert written['max'].tolist() == [3., 7.]
+    assert written['count'].tolist() == [4, 3]
+    assert written['mean'][1] == pytest.approx((4. + 6. + 7.) / 3)
+    assert rollup.end_time() == 2 * SECOND
+
+
+def test_historian_records_and_rolls_up(tmp_path):
+    historian = Historian(
+        str(tmp_path), chunk_size=100, flush_interval=0.,
+        tiers=((1., None), (10., None))
+    )
+    instr = FakeInstrument()
+    historian.attach(instr)
+    for i in range(40):
+        instr.measured_data.append('CG1', float(i), i * SECOND // 2)
+        historian.record_measures(instr, ['CG1'])
+    historian.close()
+
+    raw = historian.channel(instr.instr_key, 'CG1')
+    assert raw.count == 40
+    fine = historian.channel(instr.instr_key, 'CG1', 1.)
+    assert fine.count == 19
+    coarse = historian.channel(instr.instr_key, 'CG1', 10.)
+    # the counts are the numbers of samples of the bins
+    assert coarse.query()[0]['count'].tolist() == [20]
+
+    segments, raw_start = historian.query_rollups(
+        instr.instr_key, 'CG1', resolution=5.
+    )
+    times = np.concatenate([times for times, values in segments])
+    assert np.all(np.diff(times) > 0)
+    assert raw_start == 19 * SECOND
+
+
+def test_read_only_historian(tmp_path):
+    writer = Historian(str(tmp_path), flush_interval=0.)
+    instr = FakeInstrument()
+    writer.attach(instr)
+    instr.measured_data.append('CG1', 1., 1)
+    writer.record_measures(instr, ['CG1'])
+
+    reader = Historian(str(tmp_path), writable=False)
+    other = FakeInstrument()
+    reader.attach(other, restore=False)
+    history = reader.channel(instr.instr_key, 'CG1')
+    assert history.count == 1
+    # a reader never deletes the chunks
+    reader.expire(now=1e12)
+    reader.close()
+    assert history.count == 1
+    with pytest.raises(IOError):
+        history.extend(records([2]))
+
+
+def test_promoted_historian_writes_the_missed_samples(tmp_path):
+    writer = Historian(str(tmp_path), flush_interval=0.)
+    instr = FakeInstrument()
+    writer.attach(instr)
+    instr.measured_data.append('CG1', 1., 1)
+    writer.record_measures(instr, ['CG1'])
+    # the writer stops before writing the following samples
+    instr.measured_data.append('CG1', 2., 2)
+    instr.measured_data.append('CG1', 3., 3)
+
+    reader = Historian(str(tmp_path), flush_interval=0., writable=False)
+    reader.attach(instr, restore=False)
+    reader.promote()
+    instr.measured_data.append('CG1', 4., 4)
+    reader.record_measures(instr, ['CG1'])
+    history = reader.channel(instr.instr_key, 'CG1')
+    assert history.latest(10)['time'].tolist() == [1, 2, 3, 4]
+
+
+def test_restore(tmp_path):
+    historian = Historian(str(tmp_path), flush_interval=0.)
+    instr = FakeInstrument()
+    historian.attach(instr)
+    for i in range(5):
+        instr.measured_data.append('CG1', float(i), i)
+        historian.record_measures(instr, ['CG1'])
+    historian.close()
+
+    restarted = FakeInstrument()
+    Historian(str(tmp_path)).attach(restarted)
+    assert restarted.measured_data.latest('CG1')[0].tolist() == [
+        0, 1, 2, 3, 4
+    ]
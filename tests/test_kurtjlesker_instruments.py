@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the MGC4000 driver against the simulated controller
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+from dash_daq_drivers.mgc4000_frames import GaugeStatus, ReplyError
+
+GAUGES = ['CG1', 'CG2']
+
+# replies of the controller to the value reads
+READINGS = {
+    b'#RDCG1': b'*   1.00E-03\r',
+    b'#RDCG2': b'*   2.00E-05\r',
+    b'#RDCG3': b'*   3.00E+02\r'
+}
+
+
+@pytest.fixture
+def link():
+    simulator = pytest.importorskip('dash_daq_drivers.simulator')
+    link = simulator.MGC4000Simulator(baud_rate=0, processing_time=0.)
+    link.start()
+    yield link
+    link.stop(1.)
+
+
+@pytest.fixture
+def gauge(link):
+    instr = MGC4000(link.port_name, timeout=0.05, status_ttl=0.2)
+    yield instr
+    instr.disconnect()
+
+
+class FakePort(object):
+    """serial port recording the writes, each command written queues its
+        reply to be read
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.pending = b''
+        # number of bytes delivered by the next read, all of them if None
+        self.next_read = None
+        self.flushes = 0
+
+    def write(self, data):
+        self.writes.append(data)
+        for command in data.split(b'\r')[:-1]:
+            self.pending += READINGS[command]
+        return len(data)
+
+    def read(self, num_bytes):
+        if self.next_read is not None:
+            num_bytes, self.next_read = self.next_read, None
+        answer, self.pending = self.pending[:num_bytes], \
+            self.pending[num_bytes:]
+        return answer
+
+    def reset_input_buffer(self):
+        self.pending = b''
+        self.flushes += 1
+
+
+@pytest.fixture
+def port():
+    instr = MGC4000()
+    instr.term_chars = '\r'
+    instr.instr_connexion = FakePort()
+    return instr
+
+
+def sent(link, action):
+    """returns the number of commands received by the controller during
+        an action
+    """
+    before = link.commands
+    action()
+    # the commands of a batch are all replied before the action returns
+    return link.commands - before
+
+
+def test_statuses_are_cached_for_their_ttl(link, gauge):
+    # the statuses of both gauges in one batch, then their values
+    assert sent(link, lambda: gauge.measure_all(GAUGES)) == 4
+    # only the values while the statuses are fresh
+    assert sent(link, lambda: gauge.measure_all(GAUGES)) == 2
+    time.sleep(0.25)
+    assert sent(link, lambda: gauge.measure_all(GAUGES)) == 4
+
+
+def test_failed_read_queries_the_status_again(link, gauge):
+    gauge.measure_all(GAUGES)
+    link.set_status('CG1', GaugeStatus.FLOPN)
+
+    # the read fails with an error reply, the value is NaN
+    values = gauge.measure_all(GAUGES)
+    assert values['CG1'] != values['CG1']
+    assert values['CG2'] == values['CG2']
+    assert 'CG1' not in gauge.status_cache
+
+    # the status is queried again at once, and the faulty gauge not read
+    assert sent(link, lambda: gauge.measure_all(GAUGES)) == 2
+    assert gauge.status_cache['CG1'][0] == GaugeStatus.FLOPN
+    assert gauge.channel_status('CG1') != 0
+
+
+def test_error_replies_are_not_cached(link, gauge):
+    link.error_rate = 1.
+    values = gauge.measure_all(GAUGES)
+    assert all(value != value for value in values.values())
+    assert gauge.status_cache == {}
+
+    # the gauges are measured as soon as the controller answers again
+    link.error_rate = 0.
+    values = gauge.measure_all(GAUGES)
+    assert all(value == value for value in values.values())
+
+
+def test_cached_statuses():
+    instr = MGC4000(mock=True)
+    instr.cache_status(GaugeStatus.OK, 'CG', 1)
+    assert instr.is_cached_ready('CG', 1)
+    for reply in (None, ReplyError.SYNTAX, 1e-3):
+        instr.cache_status(reply, 'CG', 1)
+        assert 'CG1' not in instr.status_cache
+        assert not instr.is_cached_ready('CG', 1)
+
+
+def test_lost_status_replies_are_not_queried_one_by_one(link, gauge):
+    # no reply reaches the driver
+    link.drop_rate = 1.
+    assert sent(link, lambda: gauge.measure_all(GAUGES)) == 2
+    assert gauge.status_cache == {}
+
+
+def test_batch_is_sent_in_one_write(port):
+    answers = port.ask_many(['#RDCG1', '#RDCG2', '#RDCG3'])
+    assert port.instr_connexion.writes == [b'#RDCG1\r#RDCG2\r#RDCG3\r']
+    # the replies are split per frame, in the order of the commands
+    assert answers == [1e-3, 2e-5, 300.]
+    assert port.instr_connexion.flushes == 0
+
+
+def test_short_read_in_a_batch(port):
+    # the second reply is one byte short when the batch is read
+    port.instr_connexion.next_read = 2 * 13 - 1
+    answers = port.ask_many(['#RDCG1', '#RDCG2', '#RDCG3'])
+    # no value is taken from the bytes of another frame
+    assert answers == [1e-3, None, None]
+
+    # the end of the late replies is dropped, not read as the next ones
+    assert port.instr_connexion.flushes == 1
+    assert port.ask('#RDCG3') == 300.
+    assert port.ask_many(['#RDCG2', '#RDCG1']) == [2e-5, 1e-3]
+
+
+def test_mock_history_is_a_pump_down(tmp_path):
+    historian = pytest.importorskip('dash_daq_drivers.historian')
+    instr = MGC4000(mock=True, mock_seed=0, data_capacity=100)
+    history = historian.Historian(str(tmp_path), flush_interval=0.)
+    history.attach(instr)
+
+    # the chamber is pumped from the start of the history, not from now
+    times, readings = instr.mock_history(600., period=2., instr_params=GAUGES)
+    assert readings.shape == (2, 300)
+    for values in readings:
+        assert values[0] > 100.
+        assert values[-1] < 1e-2 * values[0]
+        # the noise of the readings is smaller than the fall in 20 s
+        assert np.all(np.diff(values[:100:10]) < 0)
+    assert instr.last_measure['CG1'] == readings[0, -1]
+
+    # the ring buffers keep the latest samples, the history all of them
+    assert len(instr.measured_data['CG1']) == 100
+    history.close()
+    assert history.channel(instr.instr_key, 'CG1').count == 300
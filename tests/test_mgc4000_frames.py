@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the decoding of the MGC4000 reply frames
+"""
+
+import io
+
+import pytest
+
+from dash_daq_drivers.mgc4000_frames import FRAME_SIZE, FrameReader, \
+    GaugeStatus, ReplyError, decode_frame
+
+
+@pytest.mark.parametrize('frame, expected', [
+    (b'*   1.00E-03\r', 1e-3),
+    (b'*   1.01E+03\r', 1010.),
+    (b'*   7.60E+02\r', 760.),
+    (b'*   5.00E-08\r', 5e-8),
+])
+def test_decode_value(frame, expected):
+    assert decode_frame(frame) == expected
+    assert decode_frame(bytearray(frame)) == expected
+
+
+def test_decode_value_is_correctly_rounded():
+    assert decode_frame(b'*   1.23E-04\r') == float('1.23E-04')
+    assert decode_frame(b'*   9.99E-11\r') == float('9.99E-11')
+
+
+def test_decode_status():
+    assert decode_frame(b'*   08 FLOPN\r') == GaugeStatus(8)
+    assert decode_frame(b'*   00 READY\r') == GaugeStatus(0)
+
+
+def test_decode_errors():
+    assert decode_frame(b'?01 SYNTX ER\r') is ReplyError.SYNTAX
+    assert decode_frame(b'?01 INVALID \r') is ReplyError.INVALID
+
+
+@pytest.mark.parametrize('frame', [
+    # a byte dropped on the line
+    b'*   1.01E03\r',
+    b'*   1.01E-0\r',
+    b'*   1.0E-03\r',
+    # a byte too many, or the start of the next frame
+    b'*   1.01E-03\r*',
+    b'*    1.01E-03\r',
+    # no carriage return at the end
+    b'*   1.01E-03 ',
+    # shifted by a byte lost in the previous frame
+    b'   1.01E-03\r*',
+    b'*   1.0.E-03\r',
+    b'*   1.00E-0a\r',
+    b'*   1.00E   \r',
+    b'*   zz FLOPN\r',
+    b'',
+])
+def test_decode_invalid_frames(frame):
+    assert decode_frame(frame) is None
+
+
+def test_decode_in_a_buffer():
+    buffer = bytearray(b'*   1.00E-03\r*   2.00E-03\r')
+    assert decode_frame(buffer, FRAME_SIZE, 2 * FRAME_SIZE) == 2e-3
+    assert decode_frame(memoryview(buffer)[:FRAME_SIZE]) == 1e-3
+    assert decode_frame(buffer, 1, FRAME_SIZE + 1) is None
+
+
+def test_decode_from_a_view():
+    view = memoryview(
+        bytearray(b'*   08 FLOPN\r?01 INVALID \r?01 SYNTX ER\r')
+    )
+    assert decode_frame(view, 0, FRAME_SIZE) == GaugeStatus.FLOPN
+    assert decode_frame(view, FRAME_SIZE, 2 * FRAME_SIZE) \
+        == ReplyError.INVALID
+    assert decode_frame(view[2 * FRAME_SIZE:]) == ReplyError.SYNTAX
+    assert decode_frame(view, 1, FRAME_SIZE + 1) is None
+
+
+class ChunkedConnexion(object):
+    """serial connexion which receives its bytes a few at a time"""
+
+    def __init__(self, data, chunk=5):
+        self.stream = io.BytesIO(data)
+        self.chunk = chunk
+
+    def readinto(self, view):
+        data = self.stream.read(min(self.chunk, len(view)))
+        view[:len(data)] = data
+        return len(data)
+
+
+def test_frame_reader():
+    reader = FrameReader()
+    connexion = ChunkedConnexion(b'*   1.00E-03\r*   08 FLOPN\r')
+    buffer = reader.buffer
+
+    assert reader.read(connexion) == FRAME_SIZE
+    assert reader.decode(FRAME_SIZE) == 1e-3
+    assert reader.read(connexion) == FRAME_SIZE
+    assert reader.decode(FRAME_SIZE) == GaugeStatus(8)
+    # the frames are received in the same buffer
+    assert reader.buffer is buffer
+
+
+def test_frame_reader_timeout():
+    reader = FrameReader()
+    connexion = ChunkedConnexion(b'*   1.00E-0')
+
+    received = reader.read(connexion)
+    assert received == FRAME_SIZE - 2
+    assert reader.decode(received) is None
+
+
+def test_frame_reader_many_frames():
+    reader = FrameReader()
+    connexion = ChunkedConnexion(b'*   1.00E-03\r*   2.00E-03\r')
+
+    received = reader.read(connexion, num_frames=2)
+    assert received == 2 * FRAME_SIZE
+    assert [reader.decode(received, i) for i in range(2)] == [1e-3, 2e-3]
+
+
+def test_dropped_bytes_are_not_measured():
+    simulator = pytest.importorskip('dash_daq_drivers.simulator')
+    from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+    link = simulator.MGC4000Simulator(
+        baud_rate=0, processing_time=0., drop_rate=0.05, seed=3
+    )
+    link.start()
+    instr = MGC4000(link.port_name, timeout=0.05)
+    try:
+        values = [instr.measure('CG1') for _ in range(50)]
+    finally:
+        instr.disconnect()
+        link.stop(1.)
+
+    assert link.dropped
+    assert any(value == value for value in values)
+    # a frame with a dropped byte is never read as another pressure
+    for value in values:
+        assert value != value or 1e-4 < value < 1e-2
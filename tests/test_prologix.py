@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Prologix controller shared by GPIB instruments
+"""
+
+import pytest
+
+from dash_daq_drivers.prologix import PrologixController, escape
+
+
+class FakeConnexion(object):
+    """serial connexion recording the bytes written, each line read is the
+        reply to the last data line written
+    """
+
+    def __init__(self):
+        self.written = []
+        # prefixes of the writes which fail
+        self.failing = []
+
+    def write(self, data):
+        if any(data.startswith(prefix) for prefix in self.failing):
+            raise IOError("write failed")
+        self.written.append(data)
+        return len(data)
+
+    def last_data(self):
+        for data in reversed(self.written):
+            if not data.startswith(b'++'):
+                return data
+        return b''
+
+    def readline(self):
+        return b'reply to ' + self.last_data()
+
+    def read(self, num_bytes):
+        return self.readline()[:num_bytes]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def controller():
+    controller = PrologixController('COM9', connexion=FakeConnexion())
+    controller.connexion.written = []
+    return controller
+
+
+def test_setup_commands():
+    connexion = FakeConnexion()
+    PrologixController('COM9', auto=False, connexion=connexion)
+    assert connexion.written == [b'++mode 1\n', b'++auto 0\n']
+
+
+def test_address_is_only_sent_when_it_changes(controller):
+    controller.select(5)
+    controller.select('5')
+    controller.select(6)
+    controller.select(5)
+    assert controller.connexion.written == [
+        b'++addr 5\n', b'++addr 6\n', b'++addr 5\n'
+    ]
+
+    # an address set with a raw command is known as well
+    controller.command('++addr 7')
+    controller.select(7)
+    assert controller.connexion.written[-1] == b'++addr 7\n'
+
+    controller.invalidate()
+    controller.select(7)
+    assert controller.connexion.written[-2:] == [b'++addr 7\n'] * 2
+
+
+def test_failed_selection_is_sent_again(controller):
+    controller.select(5)
+    controller.connexion.failing = [b'++addr']
+    with pytest.raises(IOError):
+        controller.select(6)
+    assert controller.address is None
+
+    # the adapter may still be on the previous address
+    controller.connexion.failing = []
+    controller.select(5)
+    assert controller.connexion.written == [b'++addr 5\n', b'++addr 5\n']
+
+
+def test_escaping():
+    assert escape(b'*IDN?') == b'*IDN?'
+    assert escape(b'a+b\r\n\x1b') == b'a\x1b+b\x1b\r\x1b\n\x1b\x1b'
+
+
+def test_framing(controller):
+    assert controller.frame('VOLT 1+2') == b'VOLT 1\x1b+2\n'
+    controller.write('*RST')
+    controller.write(b'++ver')
+    assert controller.connexion.written == [b'*RST\n', b'++ver\n']
+
+
+def test_ask_selects_and_reads(controller):
+    assert controller.ask(3, '*IDN?') == b'reply to *IDN?\n'
+    assert controller.ask(3, 'MEAS?', 8) == b'reply to'
+    assert controller.connexion.written == [
+        b'++addr 3\n', b'*IDN?\n', b'MEAS?\n'
+    ]
+
+
+def test_batch_groups_the_commands_per_address(controller):
+    answers = controller.batch([
+        (5, 'A', None),
+        (6, 'B', None),
+        (5, 'C', None),
+        (6, 'D', 10)
+    ])
+    assert controller.connexion.written == [
+        b'++addr 5\n', b'A\n', b'C\n', b'++addr 6\n', b'B\n', b'D\n'
+    ]
+    # the replies are in the order of the commands
+    assert answers == [
+        b'reply to A\n', b'reply to B\n', b'reply to C\n', b'reply to D'
+    ]
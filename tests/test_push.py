@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the server push of the new measures to the browsers
+"""
+
+import json
+import queue
+
+import dash
+import dash_html_components as html
+import numpy as np
+import pytest
+
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+from dash_daq_drivers.push import SampleBroadcaster, \
+    TooManySubscribersError, register_push_route, PUSH_ROUTE
+
+
+def received(subscriber):
+    """returns the events waiting in the queue of a subscriber"""
+    events = []
+    while True:
+        try:
+            events.append(json.loads(subscriber.get_nowait()))
+        except queue.Empty:
+            return events
+
+
+def test_subscribers_get_the_events_published_meanwhile():
+    broadcaster = SampleBroadcaster()
+    first = broadcaster.subscribe()
+    broadcaster.publish({'n': 1})
+    second = broadcaster.subscribe()
+    broadcaster.publish({'n': 2})
+    assert len(broadcaster) == 2
+
+    broadcaster.unsubscribe(first)
+    broadcaster.publish({'n': 3})
+    assert received(first) == [{'n': 1}, {'n': 2}]
+    assert received(second) == [{'n': 2}, {'n': 3}]
+
+    broadcaster.unsubscribe(first)
+    assert len(broadcaster) == 1
+
+
+def test_slow_subscriber_loses_events_without_blocking_the_others():
+    broadcaster = SampleBroadcaster(queue_size=3)
+    slow = broadcaster.subscribe()
+    fast = broadcaster.subscribe()
+    for n in range(5):
+        broadcaster.publish({'n': n})
+        # the fast one reads each event as it comes
+        assert received(fast) == [{'n': n}]
+    # the slow one keeps the oldest events, the others are dropped
+    assert received(slow) == [{'n': 0}, {'n': 1}, {'n': 2}]
+
+
+def test_nan_is_sent_as_null():
+    instr = MGC4000(mock=True)
+    instr.store_measure('CG1', np.nan, 2 * 10 ** 6)
+    instr.store_measure('CG2', 1e-3, 3 * 10 ** 6)
+    broadcaster = SampleBroadcaster()
+    subscriber = broadcaster.subscribe()
+    broadcaster.publish_measures(instr, ['CG1', 'CG2', 'CG3'])
+
+    message = subscriber.get_nowait()
+    assert 'NaN' not in message
+    # the channels never measured are left out
+    assert json.loads(message) == {
+        'instr': instr.instr_key,
+        'samples': {'CG1': [2., None], 'CG2': [3., 1e-3]}
+    }
+
+
+def test_subscribers_are_bounded():
+    broadcaster = SampleBroadcaster(max_subscribers=2)
+    first = broadcaster.subscribe()
+    broadcaster.subscribe()
+    with pytest.raises(TooManySubscribersError):
+        broadcaster.subscribe()
+    broadcaster.unsubscribe(first)
+    broadcaster.subscribe()
+
+    assert len(SampleBroadcaster(max_subscribers=None)) == 0
+
+
+def test_stream_unsubscribes_when_closed():
+    broadcaster = SampleBroadcaster()
+    stream = broadcaster.stream([{'n': 0}], keepalive=0.01)
+    assert next(stream) == ': connected\n\n'
+    assert next(stream) == 'data: {"n": 0}\n\n'
+    assert next(stream) == ': keepalive\n\n'
+    broadcaster.publish({'n': 1})
+    assert next(stream) == 'data: {"n": 1}\n\n'
+    assert len(broadcaster) == 1
+    stream.close()
+    assert len(broadcaster) == 0
+
+
+def test_push_route_refuses_the_clients_beyond_the_limit():
+    broadcaster = SampleBroadcaster(max_subscribers=1)
+    app = dash.Dash(__name__)
+    app.layout = html.Div()
+    register_push_route(app, broadcaster)
+    client = app.server.test_client()
+
+    reply = client.get('/' + PUSH_ROUTE, buffered=False)
+    assert reply.status_code == 200
+    assert reply.mimetype == 'text/event-stream'
+    assert len(broadcaster) == 1
+
+    refused = client.get('/' + PUSH_ROUTE, buffered=False)
+    assert refused.status_code == 503
+    assert 'Retry-After' in refused.headers
+
+    # a stream closed before it was read frees its place
+    reply.close()
+    assert len(broadcaster) == 0
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the queries on the samples of a channel within a time window
+"""
+
+import dash
+import dash_html_components as html
+import pytest
+
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+from dash_daq_drivers.query import MAX_POINTS, parse_max_points, \
+    parse_time, register_query_route
+
+SECOND = 10 ** 9
+
+
+def test_parse_time():
+    assert parse_time(None) is None
+    assert parse_time('') is None
+    assert parse_time('1527854400000') == 1527854400 * SECOND
+    assert parse_time('1.5') == 1500000
+    assert parse_time('2018-06-01T12:00') == 1527854400 * SECOND
+
+
+@pytest.mark.parametrize('text', [
+    'inf', '-inf', 'nan', '1e30', '99999-01-01', 'NaT', 'yesterday'
+])
+def test_parse_invalid_time(text):
+    with pytest.raises(ValueError):
+        parse_time(text)
+
+
+def test_parse_max_points():
+    assert parse_max_points(None) == MAX_POINTS
+    assert parse_max_points('12') == 12
+    for text in ('0', '-5', 'many', '1.5'):
+        with pytest.raises(ValueError):
+            parse_max_points(text)
+
+
+@pytest.fixture
+def client():
+    instr = MGC4000(mock=True, mock_seed=0)
+    for i in range(100):
+        instr.measured_data.append('CG1', float(i), i * SECOND)
+    app = dash.Dash(__name__)
+    app.layout = html.Div()
+    register_query_route(app, [instr])
+    return app.server.test_client(), instr
+
+
+def test_query_window(client):
+    client, instr = client
+    answer = client.get(
+        '/_query/%s/CG1?start=10000&stop=20000' % instr.instr_key
+    )
+    assert answer.status_code == 200
+    data = answer.get_json()
+    assert data['count'] == 10
+    assert data['times'][0] == 10000.
+    assert data['values'][-1] == 19.
+
+
+def test_query_decimated(client):
+    client, instr = client
+    data = client.get(
+        '/_query/%s/CG1?max_points=10' % instr.instr_key
+    ).get_json()
+    assert data['decimated']
+    assert data['count'] == 100
+    assert len(data['times']) <= 12
+
+
+@pytest.mark.parametrize('query', [
+    'start=inf', 'stop=nan', 'start=99999-01-01', 'start=garbage',
+    'max_points=-1', 'max_points=0', 'max_points=ten'
+])
+def test_invalid_queries(client, query):
+    client, instr = client
+    answer = client.get('/_query/%s/CG1?%s' % (instr.instr_key, query))
+    assert answer.status_code == 400
+    assert 'error' in answer.get_json()
+
+
+def test_unknown_channel(client):
+    client, instr = client
+    assert client.get('/_query/%s/XX9' % instr.instr_key).status_code == 404
+    assert client.get('/_query/unknown/CG1').status_code == 404
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the priority scheduling of the commands sent on a port
+"""
+
+import threading
+import time
+
+import pytest
+
+from dash_daq_drivers import scheduler
+from dash_daq_drivers.scheduler import PortScheduler, StaleRequestError, \
+    PRIORITY_BULK, PRIORITY_READ, PRIORITY_STATUS
+
+
+def block(port_scheduler):
+    """keeps the thread of a scheduler busy until the returned event is set"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def busy():
+        started.set()
+        release.wait(5.)
+
+    request = port_scheduler.submit(busy)
+    assert started.wait(5.)
+    return release, request
+
+
+def test_requests_are_run_by_priority():
+    port_scheduler = PortScheduler()
+    release, busy = block(port_scheduler)
+
+    order = []
+    requests = [
+        port_scheduler.submit(order.append, (priority,), priority)
+        for priority in (PRIORITY_BULK, PRIORITY_STATUS, PRIORITY_READ)
+    ]
+    release.set()
+    for request in [busy] + requests:
+        request.wait(5.)
+
+    assert order == [PRIORITY_READ, PRIORITY_STATUS, PRIORITY_BULK]
+
+
+def test_request_past_its_deadline_is_dropped():
+    port_scheduler = PortScheduler()
+    release, busy = block(port_scheduler)
+
+    calls = []
+    request = port_scheduler.submit(calls.append, (1,), deadline=0.01)
+    time.sleep(0.05)
+    release.set()
+
+    with pytest.raises(StaleRequestError):
+        request.wait(5.)
+    assert calls == []
+
+
+def test_call_from_a_request_runs_at_once():
+    port_scheduler = PortScheduler()
+
+    def nested():
+        return port_scheduler.call(lambda: 'inner')
+
+    assert port_scheduler.call(nested) == 'inner'
+
+
+def test_measure_returns_nan_when_the_port_is_busy(monkeypatch):
+    simulator = pytest.importorskip('dash_daq_drivers.simulator')
+    from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+
+    monkeypatch.setitem(scheduler.DEADLINES, PRIORITY_READ, 0.01)
+    monkeypatch.setitem(scheduler.DEADLINES, PRIORITY_STATUS, 0.01)
+
+    link = simulator.MGC4000Simulator(baud_rate=0, processing_time=0.)
+    link.start()
+    instr = MGC4000(link.port_name, timeout=1.)
+    try:
+        release, busy = block(instr.get_scheduler())
+        results = []
+        measuring = threading.Thread(
+            target=lambda: results.append(instr.measure('CG1'))
+        )
+        measuring.start()
+        time.sleep(0.05)
+        release.set()
+        measuring.join(5.)
+    finally:
+        instr.disconnect()
+        link.stop(1.)
+
+    # the dropped request does not escape to the callers of measure
+    assert len(results) == 1
+    assert results[0] != results[0]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ring buffers shared between processes through memory-mapped files
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from dash_daq_drivers import shared_store
+from dash_daq_drivers.kurtjlesker_instruments import MGC4000
+from dash_daq_drivers.shared_store import SharedChannelStore, \
+    SharedPortRequests, plane_directory
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'channels.ring')
+
+
+def test_reader_sees_writer_samples(store_path):
+    writer = SharedChannelStore(store_path, ['CG1', 'CG2'], 4, writable=True)
+    reader = SharedChannelStore(store_path, ['CG1', 'CG2'], 4)
+
+    writer['CG1'].extend([1., 2., 3.], [10, 20, 30])
+    writer.append('CG2', 5., 15)
+
+    assert reader['CG1'].count == 3
+    times, values = reader.latest('CG1')
+    assert times.tolist() == [10, 20, 30]
+    assert values.tolist() == [1., 2., 3.]
+    assert reader['CG2'].last() == (15, 5.)
+
+
+def test_reader_gets_copies(store_path):
+    writer = SharedChannelStore(store_path, ['CG1'], 4, writable=True)
+    reader = SharedChannelStore(store_path, ['CG1'], 4)
+
+    writer['CG1'].extend([1., 2., 3., 4.], [1, 2, 3, 4])
+    times, values = reader.latest('CG1')
+    window_times, window_values = reader.window('CG1', 2, 4)
+    writer['CG1'].append(5., 5)
+
+    # the samples got earlier are not overwritten by the next lap
+    assert times.tolist() == [1, 2, 3, 4]
+    assert values.tolist() == [1., 2., 3., 4.]
+    assert window_times.tolist() == [2, 3]
+    assert reader.latest('CG1')[0].tolist() == [2, 3, 4, 5]
+
+
+def test_since(store_path):
+    writer = SharedChannelStore(store_path, ['CG1'], 4, writable=True)
+    reader = SharedChannelStore(store_path, ['CG1'], 4)
+
+    writer['CG1'].extend([1., 2., 3.], [1, 2, 3])
+    times, values, cursor = reader['CG1'].since(1)
+    assert times.tolist() == [2, 3]
+    assert cursor == 3
+
+
+def test_stopped_writer_does_not_block_readers(store_path, monkeypatch):
+    monkeypatch.setattr(shared_store, 'SEQLOCK_TIMEOUT', 0.01)
+    writer = SharedChannelStore(store_path, ['CG1'], 4, writable=True)
+    reader = SharedChannelStore(store_path, ['CG1'], 4)
+    writer['CG1'].extend([1., 2.], [1, 2])
+
+    # a writer killed in the middle of an update leaves the sequence odd
+    writer['CG1']._header[0] += 1
+    start = time.time()
+    assert reader['CG1'].count == 2
+    assert reader.latest('CG1')[1].tolist() == [1., 2.]
+    assert time.time() - start < 1.
+
+    # the next writer ends the update
+    SharedChannelStore(store_path, ['CG1'], 4, writable=True)
+    assert writer['CG1']._header[0] % 2 == 0
+    assert reader['CG1'].count == 2
+
+
+def test_plane_directories_differ_per_app():
+    assert plane_directory('app') != plane_directory('app_mock')
+    assert '/' not in plane_directory('a/b').rsplit('-', 1)[-1]
+
+
+def test_nan_values(store_path):
+    writer = SharedChannelStore(store_path, ['CG1'], 4, writable=True)
+    writer.append('CG1', np.nan, 1)
+    reader = SharedChannelStore(store_path, ['CG1'], 4)
+    assert np.isnan(reader['CG1'].last()[1])
+
+
+def test_port_requests_are_shared(tmp_path):
+    instr = MGC4000(mock=True)
+    path = str(tmp_path / 'ports')
+    requests = SharedPortRequests(path, [instr])
+    other = SharedPortRequests(path, [instr])
+
+    assert other.get(instr.instr_key) == (0, None)
+    requests.request(instr.instr_key, '/dev/ttyUSB1')
+    assert other.get(instr.instr_key) == (1, '/dev/ttyUSB1')
+    # the same port requested again reconnects the instrument
+    other.request(instr.instr_key, '/dev/ttyUSB1')
+    assert requests.get(instr.instr_key) == (2, '/dev/ttyUSB1')
+    assert requests.get('unknown') == (0, None)
+
+
+def test_leases_are_shared(tmp_path):
+    rack = [MGC4000(mock=True)]
+    path = str(tmp_path / 'selection')
+    first = shared_store.SharedSelection(path, rack)
+    second = shared_store.SharedSelection(path, rack)
+
+    first.lease(rack[0].instr_key, ['CG1'], time.time() + 10.)
+    second.lease(rack[0].instr_key, ['CG2'], time.time() + 10.)
+    assert first[rack[0].instr_key] == ['CG1', 'CG2']
+    # the channels unknown to the rack are ignored
+    second[rack[0].instr_key] = ['CG3', 'unknown']
+    assert first.items() == [(rack[0].instr_key, ['CG1', 'CG2', 'CG3'])]
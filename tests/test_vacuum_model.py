@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the model of the vacuum chamber measured by the mock instruments
+"""
+
+import numpy as np
+
+from dash_daq_drivers.vacuum_model import GAUGE_RANGES, P_ATM, \
+    VacuumSystem, gauge_decades, significant_digits
+
+DAY_NS = 86400 * 10 ** 9
+
+
+def test_scenario_only_depends_on_the_seed():
+    quiet = VacuumSystem(seed=4, start_time=0)
+    quiet.pressure([2 * DAY_NS])
+
+    busy = VacuumSystem(seed=4, start_time=0)
+    # interleaved reads draw noise, they must not change the events
+    for hour in range(100):
+        busy.read(['CG1', 'IG1'], [hour * 10 ** 9])
+    busy.pressure([2 * DAY_NS])
+
+    count = min(len(quiet.segment_starts), len(busy.segment_starts))
+    assert count > 2
+    assert quiet.segment_starts[:count] == busy.segment_starts[:count]
+    assert quiet.leaks[:1] == busy.leaks[:1]
+
+
+def test_calibrations_only_depend_on_the_seed():
+    first = VacuumSystem(seed=1, start_time=0)
+    first.read(['CG1'], [DAY_NS])
+    second = VacuumSystem(seed=1, start_time=0)
+    assert first.calibrations(['CG1', 'CG2']) == \
+        second.calibrations(['CG1', 'CG2'])
+
+
+def test_pump_down_from_the_atmosphere():
+    chamber = VacuumSystem(seed=0, start_time=0, vent_interval=1e9)
+    pressure = chamber.pressure(np.arange(0, 3600, 60) * 10 ** 9)
+    assert pressure[0] == P_ATM
+    assert np.all(np.diff(pressure) <= 0)
+    assert pressure[-1] < 1e-3
+
+
+def test_readings_within_the_gauge_ranges():
+    chamber = VacuumSystem(seed=2, start_time=0)
+    times = np.arange(0, DAY_NS, 60 * 10 ** 9)
+    cg, ig = chamber.read(['CG1', 'IG1'], times)
+
+    low, high = GAUGE_RANGES['CG']
+    # within the rounding to 3 digits
+    assert np.all((cg >= low * 0.999) & (cg <= high * 1.001))
+    # the ion gauge is off above its range
+    valid = ~np.isnan(ig)
+    assert valid.any() and not valid.all()
+    assert np.all(ig[valid] <= GAUGE_RANGES['IG'][1] * 1.01)
+
+
+def test_significant_digits():
+    values = significant_digits([1.23456e-5, 987.65, 0., np.nan])
+    assert np.allclose(values[:3], [1.23e-5, 988., 0.])
+    assert np.isnan(values[3])
+
+
+def test_gauge_decades():
+    assert gauge_decades('CG1') == (-4, 4)
+    assert gauge_decades('IG2') == (-10, -2)